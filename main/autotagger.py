@@ -0,0 +1,102 @@
+import http.client, io, json, logging, socket
+
+import PIL.Image
+
+from . import metrics
+
+
+# Address of the runautotagger process: a Unix socket path prefixed with
+# "unix:" or a local "host:port"
+AUTOTAG_SERVER = 'unix:/tmp/imagesite-autotag.sock'
+AUTOTAG_TIMEOUT = 60
+
+# Edge of the copies sent by bulk jobs, as the model sees 384px images
+PREVIEW_SIZE = 384
+
+logger = logging.getLogger(__name__)
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """Speak HTTP over a Unix domain socket"""
+
+    def __init__(self, path: str, timeout: float):
+        super().__init__('localhost', timeout=timeout)
+        self.path = path
+
+    def connect(self) -> None:
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+def parseAddress(address: str) -> tuple[str, int] | str:
+    """Split a server address into a socket path or a host and port"""
+
+    if (address.startswith('unix:')):
+        return address[len('unix:'):]
+    host, port = address.rsplit(':', 1)
+    return host, int(port)
+
+
+def connect(timeout: float = AUTOTAG_TIMEOUT) -> http.client.HTTPConnection:
+    """Open a connection to the tagging server"""
+
+    address = parseAddress(AUTOTAG_SERVER)
+    if (isinstance(address, str)):
+        return UnixHTTPConnection(address, timeout)
+    return http.client.HTTPConnection(*address, timeout=timeout)
+
+
+def request(method: str, url: str, body: bytes | None = None) -> dict:
+    """Send a request to the tagging server and decode its JSON reply"""
+
+    connection = connect()
+    try:
+        # The reply only comes once the model has run, so this is the
+        # inference time as seen from the web worker
+        with metrics.timed('inference'):
+            connection.request(method, url, body=body)
+            response = connection.getresponse()
+            data = json.loads(response.read())
+        if (response.status != 200):
+            raise ValueError(data.get('error', response.reason))
+        return data
+    finally:
+        connection.close()
+
+
+def suggestTags(data: bytes) -> list[str]:
+    """Suggest tags for an encoded image, raising if the server fails"""
+
+    return request('POST', '/tag', data)['tags']
+
+
+def tagImage(data: bytes) -> list[str]:
+    """Suggest tags for an encoded image, or none if the server fails"""
+
+    try:
+        return suggestTags(data)
+    except (OSError, ValueError) as error:
+        logger.warning('Autotagging failed: %s', error)
+        return []
+
+
+def preview(path: str) -> bytes:
+    """Encode a small copy of a stored image, which is cheaper to send"""
+
+    with PIL.Image.open(path) as im:
+        im.draft('RGB', (PREVIEW_SIZE, PREVIEW_SIZE))
+        small = im.convert('RGB')
+    small.thumbnail((PREVIEW_SIZE, PREVIEW_SIZE))
+    output = io.BytesIO()
+    small.save(output, 'JPEG', quality=90)
+    return output.getvalue()
+
+
+def stats() -> dict:
+    """Get the server's queueing and batching statistics"""
+
+    try:
+        return request('GET', '/stats')
+    except (OSError, ValueError) as error:
+        return {'error': str(error)}
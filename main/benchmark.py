@@ -0,0 +1,346 @@
+import json, logging, math, platform, random, statistics, time
+from datetime import timedelta
+from pathlib import Path
+from unittest import mock
+
+import django
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.db import connection
+from django.db.models import Max, Min
+from django.db.models import DateTimeField, ExpressionWrapper, F, Value
+from django.db.models.functions import Now
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+import numpy as np
+import PIL.Image, PIL.ImageDraw
+
+from . import autotagger, renditions, tasks
+from .models import Image, Tag, normalizeTitle
+from .tagging import reconcileTagCounts, setTags
+
+
+# Distinct image files shared by the rows; decoding cost depends on the file
+# dimensions, not on how many rows point at it
+FILE_COUNT = 12
+FILE_SIZES = [(4032, 3024), (1920, 1080), (1080, 1350), (3000, 2000)]
+
+INSERT_BATCH_SIZE = 5000
+
+SYLLABLES = ['ka', 'lo', 'mi', 'ne', 'ru', 'sa', 'ti', 'vo', 'ze', 'an', 'el',
+             'or', 'us', 'pri', 'sto', 'bel', 'dra', 'fen', 'gor', 'hul']
+
+# A scenario is slower than its baseline when a percentile grows by more
+# than this fraction and by more than MIN_REGRESSION_MS
+REGRESSION_THRESHOLD = 0.2
+MIN_REGRESSION_MS = 1.0
+
+
+def word(index: int) -> str:
+    """Build a distinct pronounceable word for an index"""
+
+    letters = []
+    while (True):
+        letters.append(SYLLABLES[index % len(SYLLABLES)])
+        index //= len(SYLLABLES)
+        if (index == 0):
+            return ''.join(letters)
+
+
+def zipfWeights(count: int, exponent: float) -> np.ndarray:
+    weights = 1 / np.arange(1, count + 1) ** exponent
+    return weights / weights.sum()
+
+
+def writeFiles(seed: int) -> list[str]:
+    """Generate photo-sized image files in the media directory"""
+
+    rng = random.Random(seed)
+    names = []
+    for i in range(FILE_COUNT):
+        width, height = FILE_SIZES[i % len(FILE_SIZES)]
+        name = f'images/benchmark-{i}.jpg'
+        path = Path(default_storage.path(name))
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        # Gradients and shapes compress like a photo rather than flat color
+        im = PIL.Image.linear_gradient('L').resize((width, height)) \
+            .convert('RGB')
+        draw = PIL.ImageDraw.Draw(im)
+        for _ in range(40):
+            x, y = rng.randrange(width), rng.randrange(height)
+            radius = rng.randrange(20, max(width, height) // 6)
+            draw.ellipse((x - radius, y - radius, x + radius, y + radius),
+                fill=tuple(rng.randrange(256) for _ in range(3)))
+        im.save(path, 'JPEG', quality=90)
+        names.append(name)
+    return names
+
+
+def buildLibrary(images: int, tags: int, tags_per_image: int,
+                 exponent: float, seed: int, log=print) -> dict:
+    """Fill the database with a synthetic library of images and tags"""
+
+    rng = np.random.default_rng(seed)
+    files = writeFiles(seed)
+    tagNames = [word(i) for i in range(tags)]
+    vocabulary = [word(i) for i in range(tags, tags + 2000)]
+
+    Tag.objects.bulk_create([Tag(name=name) for name in tagNames],
+        batch_size=INSERT_BATCH_SIZE)
+    tagIds = dict(Tag.objects.values_list('name', 'id'))
+
+    ImageTag = Image.tags.through
+    weights = zipfWeights(tags, exponent)
+    for start in range(0, images, INSERT_BATCH_SIZE):
+        count = min(INSERT_BATCH_SIZE, images - start)
+        titleWords = rng.integers(0, len(vocabulary), (count, 3))
+        descriptionWords = rng.integers(0, len(vocabulary), (count, 8))
+
+        batch = []
+        for i in range(count):
+            title = ' '.join(vocabulary[w] for w in titleWords[i]).title()
+            batch.append(Image(
+                title=title,
+                title_normalized=normalizeTitle(title),
+                description=' '.join(vocabulary[w]
+                    for w in descriptionWords[i]),
+                file=files[(start + i) % len(files)],
+            ))
+        Image.objects.bulk_create(batch)
+
+        # Popular tags are drawn far more often, as in a real library
+        sampled = rng.choice(tags, (count, tags_per_image), p=weights)
+        ImageTag.objects.bulk_create([
+            ImageTag(image_id=image.id, tag_id=tagIds[tagNames[tag]])
+            for image, row in zip(batch, sampled) for tag in set(row)
+        ], batch_size=INSERT_BATCH_SIZE)
+        log(f'{start + count}/{images} images')
+
+    # Spread the upload dates so date ordering and seeking are realistic
+    Image.objects.update(date=ExpressionWrapper(
+        Now() - Value(timedelta(minutes=7)) * F('id'),
+        output_field=DateTimeField()))
+    Image.updateSearchVectors()
+    reconcileTagCounts()
+
+    return {'tag_names': tagNames, 'vocabulary': vocabulary,
+            'weights': weights}
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, math.ceil(fraction * len(ordered)) - 1)
+    return ordered[max(index, 0)]
+
+
+def summarize(latencies: list[float], queries: list[int]) -> dict:
+    """Reduce raw timings to the numbers stored in a result file"""
+
+    return {
+        'requests': len(latencies),
+        'p50_ms': percentile(latencies, 0.5),
+        'p90_ms': percentile(latencies, 0.9),
+        'p99_ms': percentile(latencies, 0.99),
+        'mean_ms': statistics.fmean(latencies),
+        'max_ms': max(latencies),
+        'queries_mean': statistics.fmean(queries),
+        'queries_max': max(queries),
+        # Requests per second for one client issuing them back to back
+        'throughput_rps': 1000 * len(latencies) / sum(latencies),
+    }
+
+
+class Benchmark:
+    """Time the request hot paths against a synthetic library"""
+
+    def __init__(self, library: dict, iterations: int, seed: int,
+                 log=print):
+        self.library = library
+        self.log = log
+        self.iterations = iterations
+        self.random = random.Random(seed)
+        self.client = Client()
+        self.results = {}
+        self.cumulative = np.cumsum(library['weights'])
+        self.ids = Image.objects.aggregate(low=Min('id'), high=Max('id'))
+
+    def tag(self) -> str:
+        """Pick a tag the way users would, favouring popular ones"""
+
+        index = int(np.searchsorted(self.cumulative,
+            self.random.random() * self.cumulative[-1]))
+        tagNames = self.library['tag_names']
+        return tagNames[min(index, len(tagNames) - 1)]
+
+    def measure(self, name: str, request, setup=None, cold: bool = True):
+        """Run a request repeatedly, recording latency and query counts"""
+
+        latencies, queries = [], []
+        for _ in range(self.iterations):
+            arguments = setup() if setup else ()
+            if (cold):
+                cache.clear()
+            with CaptureQueriesContext(connection) as captured:
+                before = time.perf_counter()
+                request(*arguments)
+                latencies.append((time.perf_counter() - before) * 1000)
+            queries.append(len(captured))
+        self.results[name] = summarize(latencies, queries)
+        self.log(f'{name}: p50 {self.results[name]["p50_ms"]:.1f} ms')
+
+    def get(self, url: str, params: dict | None = None) -> None:
+        response = self.client.get(url, params or {})
+        if (response.status_code != 200):
+            raise RuntimeError(f'{url} returned {response.status_code}')
+        if (response.streaming):
+            for _ in response.streaming_content:
+                pass
+
+    def search(self, **params) -> None:
+        self.get(reverse('home'), params)
+
+    def run(self) -> dict:
+        tag = self.tag
+        word = lambda: self.random.choice(self.library['vocabulary'])
+
+        for sort_by in ['date', 'title', 'relevance']:
+            for reverse_sort in ['on', 'off']:
+                self.measure(f'search/{sort_by}/reverse-{reverse_sort}',
+                    lambda q: self.search(q=q, sort_by=sort_by,
+                        reverse_sort=reverse_sort),
+                    lambda: (tag(),))
+
+        self.measure('search/empty', lambda: self.search())
+        self.measure('search/two-tags',
+            lambda q: self.search(q=q), lambda: (f'{tag()} {tag()}',))
+        self.measure('search/three-tags',
+            lambda q: self.search(q=q), lambda: (f'{tag()} {tag()} {tag()}',))
+        self.measure('search/negative',
+            lambda q: self.search(q=q), lambda: (f'{tag()} -{tag()}',))
+        self.measure('search/title-word',
+            lambda q: self.search(q=q, include_tags='off'),
+            lambda: (word(),))
+        cursor = self.deepCursor(20)
+        self.measure('search/deep-page',
+            lambda: self.search(cursor=cursor))
+        # The same query over and over, so only the first request misses
+        popular = self.library['tag_names'][0]
+        self.measure('search/cached',
+            lambda: self.search(q=popular), cold=False)
+
+        self.measure('autocomplete',
+            lambda q: self.get(reverse('autocomplete'), {'q': q}),
+            lambda: (tag()[:self.random.randint(1, 3)],), cold=False)
+        self.measure('tags/name', lambda: self.get(reverse('tags')))
+        self.measure('tags/count',
+            lambda: self.get(reverse('tags'), {'sort_by': 'count'}))
+
+        image = Image.objects.order_by('id').first()
+        url = reverse('image', kwargs={'image_id': image.id})
+        self.measure('image/original', lambda: self.get(url))
+        for format in renditions.RENDITION_SIZES:
+            self.measure(f'image/{format}/cold',
+                lambda: self.get(url, {'format': format}),
+                lambda: renditions.deleteRenditions(image.id) or ())
+            self.measure(f'image/{format}/cached',
+                lambda: self.get(url, {'format': format}))
+
+        self.measure('set-tags', setTags, self.randomImage)
+
+        # Uploads queue background work that would only log failures here
+        quiet = [logging.getLogger(name) for name in ['main.tasks',
+                 'main.embeddings']]
+        levels = [logger.level for logger in quiet]
+        for logger in quiet:
+            logger.setLevel(logging.CRITICAL)
+        # Never send the uploads to a tagging server that may be running: it
+        # would time the model rather than the site, and load it for nothing
+        offline = mock.patch.object(autotagger, 'request',
+            side_effect=ConnectionRefusedError('Not used by the benchmark'))
+        try:
+            with offline:
+                self.measure('upload', self.upload, self.uploadFile)
+
+                # Let the queued work finish while its database and files
+                # exist
+                tasks.executor.shutdown(wait=True)
+        finally:
+            for logger, level in zip(quiet, levels):
+                logger.setLevel(level)
+
+        return self.results
+
+    def deepCursor(self, pages: int) -> str:
+        """Walk forward through the results to find a deep page's cursor"""
+
+        cursor = None
+        for _ in range(pages):
+            response = self.client.get(reverse('home'),
+                {'cursor': cursor} if cursor else {})
+            cursor = response.context['page'].next_cursor
+        return cursor
+
+    def randomImage(self) -> tuple[Image, list[str]]:
+        image_id = self.random.randint(self.ids['low'], self.ids['high'])
+        image = Image.objects.filter(id__gte=image_id).order_by('id').first()
+        return image, [self.tag() for _ in range(5)]
+
+    def uploadFile(self) -> tuple[Path]:
+        name = f'images/benchmark-{self.random.randrange(FILE_COUNT)}.jpg'
+        return (Path(default_storage.path(name)),)
+
+    def upload(self, path: Path) -> None:
+        with open(path, 'rb') as file:
+            response = self.client.post(reverse('upload'), {
+                'file': file,
+                'title': 'Benchmark upload',
+                'tags': f'{self.tag()} {self.tag()}',
+                'description': '',
+            })
+        if (response.status_code != 302):
+            raise RuntimeError(f'Upload returned {response.status_code}')
+
+
+def environment() -> dict:
+    return {
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'database': f'{connection.vendor} {connection.pg_version}'
+            if connection.vendor == 'postgresql' else connection.vendor,
+        'machine': platform.machine(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+    }
+
+
+def compare(baseline: dict, current: dict,
+            threshold: float = REGRESSION_THRESHOLD) -> list[str]:
+    """Describe every scenario that got slower or ran more queries"""
+
+    regressions = []
+    for name, result in current['scenarios'].items():
+        before = baseline['scenarios'].get(name)
+        if (before == None):
+            continue
+        for metric in ['p50_ms', 'p90_ms']:
+            growth = result[metric] - before[metric]
+            if (growth > MIN_REGRESSION_MS and
+                    result[metric] > before[metric] * (1 + threshold)):
+                regressions.append(f'{name}: {metric} {before[metric]:.1f} '
+                    f'-> {result[metric]:.1f}')
+        if (result['queries_max'] > before['queries_max']):
+            regressions.append(f'{name}: queries {before["queries_max"]} '
+                f'-> {result["queries_max"]}')
+    return regressions
+
+
+def loadResults(path: str) -> dict:
+    with open(path) as file:
+        return json.load(file)
+
+
+def saveResults(path: str, results: dict) -> None:
+    with open(path, 'w') as file:
+        json.dump(results, file, indent=2)
@@ -0,0 +1,77 @@
+import hashlib, json, time
+
+from django.core.cache import cache
+from django.db import transaction
+
+
+# How long rendered fragments are kept. Changes never wait for this: they
+# bump a version that is part of every affected key, which only reaches
+# every process when the cache backend is shared (see CACHES).
+FRAGMENT_TIMEOUT = 24 * 60 * 60
+
+CATALOG_VERSION = 'catalog:version'
+TAGS_VERSION = 'tags:version'
+NEIGHBORS_VERSION = 'neighbors:version'
+
+
+def imageVersionKey(image_id: int) -> str:
+    return f'image:{image_id}:version'
+
+
+def neighborsVersionKey(image_id: int) -> str:
+    return f'image:{image_id}:neighbors:version'
+
+
+def versions(*keys: str) -> list[int]:
+    """Get the current value of some version counters in one round trip"""
+
+    found = cache.get_many(keys)
+    missing = {key: time.time_ns() for key in keys if key not in found}
+    if (missing):
+        # Start from a fresh value rather than 0, so a counter that was
+        # evicted can never come back to a value used by old fragments
+        for key, value in missing.items():
+            cache.add(key, value, timeout=None)
+        found.update(cache.get_many(list(missing)))
+    return [found.get(key, 0) for key in keys]
+
+
+def bump(*keys: str) -> None:
+    """Invalidate everything cached under some version counters"""
+
+    for key in keys:
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, time.time_ns(), timeout=None)
+
+
+def bumpOnCommit(*keys: str) -> None:
+    # Waiting for the commit means a fragment built from the old data can
+    # only be stored under the old version
+    transaction.on_commit(lambda: bump(*keys))
+
+
+def imageChanged(image_id: int) -> None:
+    """Invalidate the pages showing an image once the change commits"""
+
+    bumpOnCommit(CATALOG_VERSION, imageVersionKey(image_id))
+
+
+def tagsChanged(image_id: int) -> None:
+    """Invalidate the pages showing an image's tags once the change commits"""
+
+    bumpOnCommit(CATALOG_VERSION, TAGS_VERSION, imageVersionKey(image_id))
+
+
+def neighborsChanged(image_id: int) -> None:
+    """Invalidate the similar images shown for an image"""
+
+    bumpOnCommit(neighborsVersionKey(image_id))
+
+
+def fragmentKey(name: str, *parts) -> str:
+    """Build a fragment key from its versions and normalized parameters"""
+
+    digest = hashlib.sha1(json.dumps(parts, default=str).encode()).hexdigest()
+    return f'{name}:{digest}'
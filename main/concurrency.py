@@ -0,0 +1,64 @@
+import asyncio, contextvars, functools, threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from django.http import HttpResponse
+
+
+# Work that would block the event loop runs in these pools. Resizing with
+# PIL releases the GIL, and tagging waits on the model server, so threads
+# are enough for both.
+RENDITION_WORKERS = 4
+AUTOTAG_WORKERS = 8
+
+# Requests allowed to wait on each pool at once; beyond this they are
+# turned away with 503 rather than queueing without bound
+RENDITION_CONCURRENCY = 16
+AUTOTAG_CONCURRENCY = 16
+
+# Seconds a turned away client is told to wait before retrying
+RETRY_AFTER = 5
+
+renditionPool = ThreadPoolExecutor(max_workers=RENDITION_WORKERS,
+    thread_name_prefix='resize')
+autotagPool = ThreadPoolExecutor(max_workers=AUTOTAG_WORKERS,
+    thread_name_prefix='autotag')
+
+renditionSlots = threading.BoundedSemaphore(RENDITION_CONCURRENCY)
+autotagSlots = threading.BoundedSemaphore(AUTOTAG_CONCURRENCY)
+
+
+class Saturated(Exception):
+    """Raised when a concurrency limit has no free slot"""
+
+
+@contextmanager
+def slot(semaphore: threading.BoundedSemaphore):
+    """Hold a slot of a concurrency limit without waiting for one"""
+
+    # A semaphore that never blocks works from both threads and coroutines
+    if (not semaphore.acquire(blocking=False)):
+        raise Saturated
+    try:
+        yield
+    finally:
+        semaphore.release()
+
+
+async def run(pool: ThreadPoolExecutor, function, *args, **kwargs):
+    """Run a blocking function in a pool and wait for it without blocking"""
+
+    # Carry the context along so the work is timed as part of the request
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(pool,
+        functools.partial(context.run, function, *args, **kwargs))
+
+
+def unavailable() -> HttpResponse:
+    """Tell a client the server is saturated and when to try again"""
+
+    response = HttpResponse('Too many concurrent requests, try again later',
+        status=503, content_type='text/plain')
+    response.headers['Retry-After'] = str(RETRY_AFTER)
+    return response
@@ -0,0 +1,145 @@
+from django.db.models import Q
+
+import PIL.Image
+
+from .models import Image
+
+
+# A 64 bit difference hash compares each pixel of a 9x8 grayscale thumbnail
+# with its right neighbour
+HASH_WIDTH = 8
+HASH_BITS = HASH_WIDTH * HASH_WIDTH
+
+# Images whose hashes differ in at most this many bits are near-duplicates
+DUPLICATE_RADIUS = 3
+
+# Split each hash into radius + 1 chunks that are indexed separately. Two
+# hashes within the radius must then agree exactly on at least one chunk, so
+# candidates come from index lookups instead of a scan of the whole table.
+HASH_CHUNKS = 4
+CHUNK_BITS = HASH_BITS // HASH_CHUNKS
+CHUNK_FIELDS = [f'phash_{i}' for i in range(HASH_CHUNKS)]
+
+
+def differenceHash(im: PIL.Image.Image) -> int:
+    """Compute the 64 bit difference hash of an open image"""
+
+    # Let the JPEG decoder skip straight to a small grayscale image
+    im.draft('L', (HASH_WIDTH * 8, HASH_WIDTH * 8))
+    small = im.convert('L').resize((HASH_WIDTH + 1, HASH_WIDTH),
+        PIL.Image.Resampling.LANCZOS)
+    pixels = list(small.getdata())
+
+    value = 0
+    for row in range(HASH_WIDTH):
+        for column in range(HASH_WIDTH):
+            left = pixels[row * (HASH_WIDTH + 1) + column]
+            right = pixels[row * (HASH_WIDTH + 1) + column + 1]
+            value = value << 1 | (left > right)
+    return value
+
+
+def hashFile(file) -> int:
+    """Hash an image file or path"""
+
+    if (hasattr(file, 'seek')):
+        file.seek(0)
+    with PIL.Image.open(file) as im:
+        value = differenceHash(im)
+    if (hasattr(file, 'seek')):
+        file.seek(0)
+    return value
+
+
+def toSigned(value: int) -> int:
+    # A 64 bit hash only fits a bigint column as a signed value
+    return value - (1 << HASH_BITS) if value >= 1 << (HASH_BITS - 1) else value
+
+
+def toUnsigned(value: int) -> int:
+    return value & ((1 << HASH_BITS) - 1)
+
+
+def hashChunks(value: int) -> list[int]:
+    """Split a hash into the chunks stored in the indexed columns"""
+
+    value = toUnsigned(value)
+    mask = (1 << CHUNK_BITS) - 1
+    return [value >> (CHUNK_BITS * i) & mask for i in range(HASH_CHUNKS)]
+
+
+def distance(first: int, second: int) -> int:
+    """Count the bits that differ between two hashes"""
+
+    return (toUnsigned(first) ^ toUnsigned(second)).bit_count()
+
+
+def assignHash(image: Image, value: int | None) -> None:
+    """Store a hash and its chunks on an image without saving it"""
+
+    if (value == None):
+        image.phash = None
+        chunks = [None] * HASH_CHUNKS
+    else:
+        image.phash = toSigned(value)
+        chunks = hashChunks(value)
+
+    for field, chunk in zip(CHUNK_FIELDS, chunks):
+        setattr(image, field, chunk)
+
+
+def checkRadius(radius: int) -> None:
+    if (radius >= HASH_CHUNKS):
+        raise ValueError(f'The chunk index only covers a radius below '
+            f'{HASH_CHUNKS}')
+
+
+def findDuplicates(value: int, radius: int = DUPLICATE_RADIUS,
+                   exclude_id: int | None = None) -> list[Image]:
+    """Find the images whose hashes are within a radius of a hash"""
+
+    checkRadius(radius)
+
+    candidates = Q()
+    for field, chunk in zip(CHUNK_FIELDS, hashChunks(value)):
+        candidates |= Q(**{field: chunk})
+
+    images = Image.objects.filter(candidates).only('id', 'title', 'phash')
+    if (exclude_id != None):
+        images = images.exclude(id=exclude_id)
+
+    return [image for image in images
+            if distance(image.phash, value) <= radius]
+
+
+def findClusters(hashes: dict[int, int],
+                 radius: int = DUPLICATE_RADIUS) -> list[list[int]]:
+    """Group image ids into clusters of near-duplicates"""
+
+    checkRadius(radius)
+
+    # The same chunk index as findDuplicates, built in memory
+    buckets = [{} for _ in range(HASH_CHUNKS)]
+    for image_id, value in hashes.items():
+        for bucket, chunk in zip(buckets, hashChunks(value)):
+            bucket.setdefault(chunk, []).append(image_id)
+
+    parents = {image_id: image_id for image_id in hashes}
+
+    def find(image_id: int) -> int:
+        while (parents[image_id] != image_id):
+            parents[image_id] = parents[parents[image_id]]
+            image_id = parents[image_id]
+        return image_id
+
+    for bucket in buckets:
+        for ids in bucket.values():
+            for i, first in enumerate(ids):
+                for second in ids[i + 1:]:
+                    if (distance(hashes[first], hashes[second]) <= radius):
+                        parents[find(second)] = find(first)
+
+    clusters = {}
+    for image_id in sorted(hashes):
+        clusters.setdefault(find(image_id), []).append(image_id)
+    return [ids for ids in clusters.values() if len(ids) > 1]
@@ -0,0 +1,370 @@
+import base64, fcntl, hashlib, json, logging, os, tempfile, threading
+from contextlib import contextmanager
+from pathlib import Path
+
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+
+import numpy as np
+
+from . import autotagger
+
+
+EMBEDDINGS_DIRECTORY = 'embeddings'
+EMBEDDING_SIZE = 512
+
+# Each row holds an image id and its normalized float16 CLIP embedding. A
+# later row for the same id replaces the earlier ones.
+ROW_TYPE = np.dtype([
+    ('id', '<i8'),
+    ('vector', '<f2', (EMBEDDING_SIZE,)),
+])
+
+# Rows converted to float32 at a time while scoring, which bounds the memory
+# used by a query however large the library grows
+SEARCH_BLOCK_ROWS = 65536
+
+# An exact search reads every row: about 1 KB per image, so some 100 ms per
+# 100,000 images. Above IVF_MIN_ROWS embed_images also clusters the rows
+# into about sqrt(rows) lists, and a query only scores the IVF_PROBES lists
+# closest to it, plus rows appended since the index was built.
+IVF_MIN_ROWS = 100_000
+IVF_PROBES = 16
+IVF_TRAINING_ROWS = 50_000
+KMEANS_ITERATIONS = 10
+
+# How long an embedded text query is reused
+QUERY_CACHE_TIMEOUT = 60 * 60
+
+logger = logging.getLogger(__name__)
+
+
+@contextmanager
+def locked(path: Path):
+    """Hold an exclusive lock next to a file while changing it"""
+
+    with open(path.with_suffix('.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def kmeans(vectors: np.ndarray, count: int) -> np.ndarray:
+    """Cluster normalized vectors by cosine, returning the centroids"""
+
+    generator = np.random.default_rng(0)
+    centroids = vectors[generator.choice(len(vectors), count, replace=False)]
+    for _ in range(KMEANS_ITERATIONS):
+        assignment = np.argmax(vectors @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, vectors)
+        # A centroid nothing is closest to stays where it was
+        empty = ~sums.any(axis=1)
+        sums[empty] = centroids[empty]
+        centroids = sums / np.linalg.norm(sums, axis=1, keepdims=True)
+    return centroids
+
+
+class EmbeddingStore:
+    """Image embeddings in a memory-mapped file, scored with NumPy"""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.indexPath = path.with_suffix('.ivf.npz')
+        self.lock = threading.Lock()
+        self.signature = None
+        self.rows = np.zeros(0, ROW_TYPE)
+        self.live = np.zeros(0, bool)
+        # The row holding each id's current embedding
+        self.positions = {}
+        self.indexSignature = None
+        self.index = None
+
+    def load(self) -> tuple[np.ndarray, np.ndarray]:
+        """Map the file again if it was appended to or replaced"""
+
+        try:
+            stat = os.stat(self.path)
+            signature = (stat.st_ino, stat.st_size)
+        except FileNotFoundError:
+            signature = None
+
+        with self.lock:
+            if (signature != self.signature):
+                # A writer may be part way through a row; ignore the tail
+                count = signature[1] // ROW_TYPE.itemsize if signature else 0
+                if (count == 0):
+                    rows = np.zeros(0, ROW_TYPE)
+                else:
+                    rows = np.memmap(self.path, ROW_TYPE, 'r', shape=(count,))
+
+                # Only the last row written for each id counts. Appends only
+                # add rows, so just the new ones need looking at; a copy of
+                # the mask keeps it steady for readers still using the old one.
+                start = len(self.rows)
+                live = np.zeros(count, bool)
+                if (self.signature != None and signature != None and
+                        signature[0] == self.signature[0] and count >= start):
+                    live[:start] = self.live
+                    positions = self.positions
+                    for row, image_id in enumerate(
+                            rows['id'][start:].tolist(), start):
+                        replaced = positions.get(image_id)
+                        if (replaced != None):
+                            live[replaced] = False
+                        positions[image_id] = row
+                        live[row] = True
+                else:
+                    ids = np.asarray(rows['id'])
+                    _, last = np.unique(ids[::-1], return_index=True)
+                    live[count - 1 - last] = True
+                    current = np.flatnonzero(live)
+                    positions = dict(zip(ids[current].tolist(),
+                        current.tolist()))
+
+                self.rows, self.live, self.signature = rows, live, signature
+                self.positions = positions
+            return self.rows, self.live
+
+    def loadIndex(self) -> dict | None:
+        """Get the clustered index if it was built for the current file"""
+
+        try:
+            signature = os.stat(self.indexPath).st_mtime_ns
+        except FileNotFoundError:
+            signature = None
+
+        with self.lock:
+            if (signature != self.indexSignature):
+                index = None
+                if (signature != None):
+                    with np.load(self.indexPath) as data:
+                        index = {key: data[key] for key in data.files}
+                self.index, self.indexSignature = index, signature
+            index = self.index
+
+        # Compaction replaces the file, which moves rows and voids the index
+        if (index == None or self.signature == None or
+                int(index['inode']) != self.signature[0]):
+            return None
+        return index
+
+    def buildIndex(self) -> int:
+        """Cluster the rows so queries can skip most of them
+
+        Returns the number of lists, or 0 if the library is small enough
+        to search exactly."""
+
+        with locked(self.path):
+            rows, live = self.load()
+            if (int(live.sum()) < IVF_MIN_ROWS):
+                self.indexPath.unlink(missing_ok=True)
+                return 0
+
+            generator = np.random.default_rng(0)
+            liveRows = np.flatnonzero(live)
+            sample = generator.choice(liveRows,
+                min(IVF_TRAINING_ROWS, len(liveRows)), replace=False)
+            count = int(np.sqrt(len(liveRows)))
+            centroids = kmeans(
+                np.asarray(rows['vector'][np.sort(sample)], np.float32), count)
+
+            assignment = np.empty(len(rows), np.int64)
+            for start in range(0, len(rows), SEARCH_BLOCK_ROWS):
+                block = rows['vector'][start:start + SEARCH_BLOCK_ROWS]
+                assignment[start:start + len(block)] = np.argmax(
+                    block.astype(np.float32) @ centroids.T, axis=1)
+
+            # Rows grouped by list, with where each list starts
+            order = np.argsort(assignment, kind='stable')
+            offsets = np.searchsorted(assignment[order], np.arange(count + 1))
+
+            descriptor, temporary_path = tempfile.mkstemp(
+                dir=self.path.parent, suffix='.npz')
+            try:
+                with os.fdopen(descriptor, 'wb') as output:
+                    np.savez(output, centroids=centroids, order=order,
+                        offsets=offsets, indexed=len(rows),
+                        inode=os.stat(self.path).st_ino)
+                os.replace(temporary_path, self.indexPath)
+            except:
+                os.unlink(temporary_path)
+                raise
+        return count
+
+    def candidates(self, index: dict, vector: np.ndarray,
+                   total: int) -> np.ndarray:
+        """Get the rows worth scoring for a query from the index"""
+
+        probes = min(IVF_PROBES, len(index['centroids']))
+        closest = np.argpartition(-(index['centroids'] @ vector),
+            probes - 1)[:probes]
+        order, offsets = index['order'], index['offsets']
+        return np.concatenate(
+            [order[offsets[cluster]:offsets[cluster + 1]]
+             for cluster in closest] +
+            [np.arange(int(index['indexed']), total)])
+
+    def ids(self) -> set[int]:
+        rows, live = self.load()
+        return set(rows['id'][live].tolist())
+
+    def append(self, ids: list[int], vectors: np.ndarray) -> None:
+        """Add or replace the embeddings of some images"""
+
+        rows = np.zeros(len(ids), ROW_TYPE)
+        rows['id'] = ids
+        rows['vector'] = vectors
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with locked(self.path), open(self.path, 'ab') as file:
+            # Writes are whole rows, so readers never see a misaligned file
+            if (file.tell() % ROW_TYPE.itemsize != 0):
+                file.truncate(file.tell() - file.tell() % ROW_TYPE.itemsize)
+            file.write(rows.tobytes())
+
+    def compact(self, keep: set[int]) -> int:
+        """Rewrite the file without replaced rows or images not kept"""
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with locked(self.path):
+            rows, live = self.load()
+            keep = live & np.isin(rows['id'], list(keep))
+            descriptor, temporary_path = tempfile.mkstemp(dir=self.path.parent)
+            try:
+                with os.fdopen(descriptor, 'wb') as output:
+                    for start in range(0, len(rows), SEARCH_BLOCK_ROWS):
+                        block = slice(start, start + SEARCH_BLOCK_ROWS)
+                        output.write(rows[block][keep[block]].tobytes())
+                os.replace(temporary_path, self.path)
+                # The rows have moved, so the clustered index is stale
+                self.indexPath.unlink(missing_ok=True)
+            except:
+                os.unlink(temporary_path)
+                raise
+        return len(rows) - int(keep.sum())
+
+    def vector(self, image_id: int) -> np.ndarray | None:
+        """Get the current embedding of an image, if it has one"""
+
+        rows, live = self.load()
+        matches = np.flatnonzero((rows['id'] == image_id) & live)
+        return rows['vector'][matches[0]] if len(matches) else None
+
+    def nearest(self, vectors: np.ndarray,
+                limit: int) -> tuple[np.ndarray, np.ndarray]:
+        """Find the closest images to each of some query embeddings"""
+
+        rows, live = self.load()
+        limit = min(limit, int(live.sum()))
+        vectors = np.asarray(vectors, np.float32)
+
+        index = self.loadIndex()
+        if (index != None):
+            found = self.nearestIndexed(index, rows, live, vectors, limit)
+            if (found != None):
+                return found
+
+        # Keep a running top k per query while walking the file in blocks,
+        # so memory is bounded by the block size rather than the library
+        best_scores = np.zeros((len(vectors), 0), np.float32)
+        best_rows = np.zeros((len(vectors), 0), np.int64)
+        for start in range(0, len(rows), SEARCH_BLOCK_ROWS):
+            block = rows['vector'][start:start + SEARCH_BLOCK_ROWS]
+            # Vectors are normalized, so the dot product is the cosine
+            scores = vectors @ block.astype(np.float32).T
+            scores[:, ~live[start:start + len(block)]] = -np.inf
+            indexes = np.broadcast_to(np.arange(start, start + len(block)),
+                scores.shape)
+
+            scores = np.concatenate([best_scores, scores], axis=1)
+            indexes = np.concatenate([best_rows, indexes], axis=1)
+            if (scores.shape[1] > limit):
+                top = np.argpartition(-scores, limit - 1, axis=1)[:, :limit]
+                scores = np.take_along_axis(scores, top, axis=1)
+                indexes = np.take_along_axis(indexes, top, axis=1)
+            best_scores, best_rows = scores, indexes
+
+        order = np.argsort(-best_scores, axis=1, kind='stable')
+        best_scores = np.take_along_axis(best_scores, order, axis=1)
+        best_rows = np.take_along_axis(best_rows, order, axis=1)
+        return rows['id'][best_rows], best_scores
+
+    def nearestIndexed(self, index: dict, rows: np.ndarray, live: np.ndarray,
+                       vectors: np.ndarray,
+                       limit: int) -> tuple[np.ndarray, np.ndarray] | None:
+        """Find the closest images among the rows the index points to, or
+        None if the probed lists hold too few of them"""
+
+        ids = np.zeros((len(vectors), limit), np.int64)
+        best = np.zeros((len(vectors), limit), np.float32)
+        for query, vector in enumerate(vectors):
+            candidates = self.candidates(index, vector, len(rows))
+            # Sorted rows are read from the file in order
+            candidates = np.sort(candidates[live[candidates]])
+            if (len(candidates) < limit):
+                return None
+            scores = rows['vector'][candidates].astype(np.float32) @ vector
+            top = np.argsort(-scores, kind='stable')[:limit]
+            ids[query] = rows['id'][candidates[top]]
+            best[query] = scores[top]
+        return ids, best
+
+    def search(self, vector: np.ndarray, limit: int) -> list[int]:
+        """Get the ids of the images most similar to a query embedding"""
+
+        ids, _ = self.nearest(vector[None], limit)
+        return ids[0].tolist()
+
+
+stores = {}
+storesLock = threading.Lock()
+
+
+def getStore() -> EmbeddingStore:
+    """Get this process's view of the embeddings file"""
+
+    path = Path(default_storage.path(EMBEDDINGS_DIRECTORY)) / 'images.bin'
+    with storesLock:
+        if (path not in stores):
+            stores[path] = EmbeddingStore(path)
+        return stores[path]
+
+
+def decodeEmbedding(data: dict) -> np.ndarray:
+    return np.frombuffer(base64.b64decode(data['embedding']), np.float16)
+
+
+def embedImage(data: bytes) -> np.ndarray:
+    """Embed an encoded image with the model server"""
+
+    return decodeEmbedding(autotagger.request('POST', '/embed/image', data))
+
+
+def embedText(text: str) -> np.ndarray | None:
+    """Embed a text query, or return None if the model server fails"""
+
+    key = 'embedding:' + hashlib.sha1(text.encode()).hexdigest()
+    embedding = cache.get(key)
+    if (embedding is not None):
+        return embedding
+
+    try:
+        embedding = decodeEmbedding(autotagger.request('POST', '/embed/text',
+            json.dumps({'text': text}).encode()))
+    except (OSError, ValueError) as error:
+        logger.warning('Embedding the query failed: %s', error)
+        return None
+
+    cache.set(key, embedding, QUERY_CACHE_TIMEOUT)
+    return embedding
+
+
+def searchText(text: str, limit: int) -> list[int] | None:
+    """Rank images by similarity to a text query"""
+
+    embedding = embedText(text)
+    if (embedding is None):
+        return None
+    return getStore().search(embedding, limit)
@@ -1,8 +1,28 @@
 from django import forms
 
+from . import staging
+
 
 class ImageUploadForm(forms.Form):
-    file = forms.ImageField()
+    file = forms.ImageField(required=False)
     title = forms.CharField()
     tags = forms.CharField(widget=forms.Textarea, required=False)
     description = forms.CharField(widget=forms.Textarea, required=False)
+    staging_token = forms.CharField(widget=forms.HiddenInput, required=False)
+
+    def clean(self):
+        cleaned_data = super().clean()
+        if (cleaned_data.get('file') != None or 'file' in self.errors):
+            return cleaned_data
+
+        # Without a new copy, use the file staged when it was tagged
+        staged = staging.openStaged(cleaned_data.get('staging_token'))
+        if (staged == None):
+            self.add_error('file', 'Choose an image to upload.')
+        else:
+            try:
+                cleaned_data['file'] = self.fields['file'].clean(staged)
+            except forms.ValidationError as error:
+                staged.close()
+                self.add_error('file', error)
+        return cleaned_data
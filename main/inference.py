@@ -0,0 +1,342 @@
+import collections, queue, threading, time
+from concurrent.futures import Future
+from pathlib import Path
+
+import clip
+import numpy as np
+import torch
+import torch.nn.functional as F
+from ram.models import ram_plus
+from ram import get_transform
+
+
+IMAGE_SIZE = 384
+CHECKPOINT = 'pretrained/ram_plus_swin_large_14m.pth'
+
+# Inference backend used by the tagging server. Every backend except fp32
+# and compile needs its artifact built first with build_autotagger.
+BACKEND = 'fp32'
+BACKENDS = ['fp32', 'int8', 'torchscript', 'compile', 'onnx']
+ARTIFACT_SUFFIXES = {
+    'int8': '.int8.pt',
+    'torchscript': '.torchscript.pt',
+    'onnx': '.onnx',
+}
+
+# CLIP model used to embed images and text queries for semantic search
+CLIP_MODEL = 'ViT-B/32'
+
+# Trade latency for throughput: a batch runs as soon as it is full or the
+# oldest request in it has waited this long
+MAX_BATCH_SIZE = 8
+MAX_WAIT_MS = 25
+
+device = torch.device('cpu')
+transform = get_transform(image_size=IMAGE_SIZE)
+
+
+def loadModel(checkpoint: str = CHECKPOINT) -> torch.nn.Module:
+    """Load the image tagging model"""
+
+    model = ram_plus(pretrained=checkpoint, image_size=IMAGE_SIZE,
+        vit='swin_l')
+    model.eval()
+    return model.to(device)
+
+
+def parseTags(result: str) -> list[str]:
+    """Convert the model's output into tag names"""
+
+    return [token.strip().replace(' ', '-') for token in result.split('|')
+            if token.strip() != '']
+
+
+def artifactPath(backend: str, checkpoint: str = CHECKPOINT) -> Path:
+    """Get where the optimized artifact for a backend is stored"""
+
+    return Path(checkpoint).with_suffix(ARTIFACT_SUFFIXES[backend])
+
+
+def labelsPath(checkpoint: str = CHECKPOINT) -> Path:
+    """Get where the tag list and thresholds for exported models are stored"""
+
+    return Path(checkpoint).with_suffix('.labels.npz')
+
+
+class TagScorer(torch.nn.Module):
+    """Compute per-class tag probabilities with a traceable forward pass"""
+
+    # This follows ram_plus.generate_tag up to the sigmoid, with its per-image
+    # label reweighting loop vectorized so the graph can be exported
+
+    def __init__(self, model: torch.nn.Module):
+        super().__init__()
+        self.model = model
+
+    def forward(self, image: torch.Tensor) -> torch.Tensor:
+        model = self.model
+        image_embeds = model.image_proj(model.visual_encoder(image))
+        image_atts = torch.ones(image_embeds.size()[:-1], dtype=torch.long,
+            device=image.device)
+
+        image_cls_embeds = image_embeds[:, 0, :]
+        image_cls_embeds = image_cls_embeds / image_cls_embeds.norm(dim=-1,
+            keepdim=True)
+
+        des_per_class = model.label_embed.shape[0] // model.num_class
+        label_embed = model.label_embed.view(-1, des_per_class, 512)
+
+        logits_per_image = (model.reweight_scale.exp() * image_cls_embeds
+            @ model.label_embed.t())
+        weights = F.softmax(logits_per_image.view(image.shape[0], -1,
+            des_per_class), dim=2)
+        label_embed_reweight = torch.einsum('bcd,cde->bce', weights,
+            label_embed)
+        label_embed = F.relu(model.wordvec_proj(label_embed_reweight))
+
+        tagging_embed = model.tagging_head(
+            encoder_embeds=label_embed,
+            encoder_hidden_states=image_embeds,
+            encoder_attention_mask=image_atts,
+            return_dict=False,
+            mode='tagging',
+        )
+        return torch.sigmoid(model.fc(tagging_embed[0]).squeeze(-1))
+
+
+class EagerTagger:
+    """Tag images with an eager PyTorch model"""
+
+    def __init__(self, model: torch.nn.Module):
+        self.model = model
+
+    def tag(self, images: torch.Tensor) -> list[str]:
+        with torch.no_grad():
+            results, _ = self.model.generate_tag(images.to(device))
+        return results
+
+
+class ScoringTagger:
+    """Tag images with any backend that outputs per-class probabilities"""
+
+    def __init__(self, score, labels: dict):
+        self.score = score
+        self.tag_list = labels['tag_list']
+        self.threshold = labels['class_threshold']
+        self.delete_tag_index = labels['delete_tag_index']
+
+    def tag(self, images: torch.Tensor) -> list[str]:
+        scores = self.score(images)
+        selected = scores > self.threshold
+        selected[:, self.delete_tag_index] = False
+        return [' | '.join(self.tag_list[np.flatnonzero(row)])
+                for row in selected]
+
+
+def modelLabels(model: torch.nn.Module) -> dict:
+    """Get what a scoring backend needs to turn probabilities into tags"""
+
+    return {
+        'tag_list': np.asarray(model.tag_list),
+        'class_threshold': model.class_threshold.cpu().numpy(),
+        'delete_tag_index': np.asarray(model.delete_tag_index, dtype=np.int64),
+    }
+
+
+def saveLabels(model: torch.nn.Module, checkpoint: str = CHECKPOINT) -> None:
+    """Store the labels next to the checkpoint for exported models"""
+
+    np.savez(labelsPath(checkpoint), **modelLabels(model))
+
+
+def loadLabels(checkpoint: str = CHECKPOINT) -> dict:
+    """Load the labels stored by saveLabels"""
+
+    with np.load(labelsPath(checkpoint)) as labels:
+        return {name: labels[name] for name in labels.files}
+
+
+def buildArtifact(backend: str, checkpoint: str = CHECKPOINT) -> Path:
+    """Build the optimized model artifact for a backend from the checkpoint"""
+
+    model = loadModel(checkpoint)
+    path = artifactPath(backend, checkpoint)
+    example = torch.zeros(1, 3, IMAGE_SIZE, IMAGE_SIZE, device=device)
+
+    with torch.no_grad():
+        match backend:
+            case 'int8':
+                # Dynamic quantization covers the linear layers, which hold
+                # most of the weights in both the Swin and BERT parts
+                quantized = torch.ao.quantization.quantize_dynamic(
+                    model, {torch.nn.Linear}, dtype=torch.qint8)
+                torch.save(quantized, path)
+            case 'torchscript':
+                traced = torch.jit.trace(TagScorer(model), example)
+                torch.jit.save(torch.jit.freeze(traced.eval()), path)
+            case 'onnx':
+                torch.onnx.export(TagScorer(model), example, path,
+                    input_names=['image'], output_names=['scores'],
+                    dynamic_axes={'image': {0: 'batch'},
+                                  'scores': {0: 'batch'}},
+                    opset_version=17)
+            case _:
+                raise ValueError(f'No artifact to build for {backend}')
+
+    saveLabels(model, checkpoint)
+    return path
+
+
+def loadTagger(backend: str = BACKEND, checkpoint: str = CHECKPOINT):
+    """Load the tagger for an inference backend"""
+
+    match backend:
+        case 'fp32':
+            return EagerTagger(loadModel(checkpoint))
+        case 'int8':
+            model = torch.load(artifactPath(backend, checkpoint),
+                weights_only=False)
+            return EagerTagger(model.eval())
+        case 'torchscript':
+            scorer = torch.jit.load(artifactPath(backend, checkpoint),
+                map_location=device)
+            labels = loadLabels(checkpoint)
+        case 'compile':
+            model = loadModel(checkpoint)
+            scorer = torch.compile(TagScorer(model))
+            labels = modelLabels(model)
+        case 'onnx':
+            # Only needed for this backend, so it is not a hard requirement
+            import onnxruntime
+            session = onnxruntime.InferenceSession(
+                str(artifactPath(backend, checkpoint)),
+                providers=['CPUExecutionProvider'])
+            return ScoringTagger(
+                lambda images: session.run(None,
+                    {'image': images.cpu().numpy()})[0],
+                loadLabels(checkpoint))
+        case _:
+            raise ValueError(f'Unknown inference backend {backend}')
+
+    def score(images: torch.Tensor) -> np.ndarray:
+        with torch.no_grad():
+            return scorer(images.to(device)).cpu().numpy()
+
+    return ScoringTagger(score, labels)
+
+
+class ClipEmbedder:
+    """Embed images and text into CLIP's shared space"""
+
+    def __init__(self, name: str = CLIP_MODEL):
+        self.model, self.transform = clip.load(name, device=device)
+        self.model.eval()
+
+    def normalize(self, embeddings: torch.Tensor) -> np.ndarray:
+        embeddings = embeddings / embeddings.norm(dim=-1, keepdim=True)
+        return embeddings.cpu().numpy().astype(np.float16)
+
+    def embedImages(self, images: torch.Tensor) -> np.ndarray:
+        with torch.no_grad():
+            return self.normalize(self.model.encode_image(images.to(device)))
+
+    def embedText(self, text: str) -> np.ndarray:
+        tokens = clip.tokenize([text], truncate=True).to(device)
+        with torch.no_grad():
+            return self.normalize(self.model.encode_text(tokens))[0]
+
+
+class BatchScheduler:
+    """Group concurrent tagging requests into batched forward passes"""
+
+    def __init__(self, tagger: EagerTagger | ScoringTagger | ClipEmbedder,
+                 max_batch_size: int = MAX_BATCH_SIZE,
+                 max_wait_ms: float = MAX_WAIT_MS):
+        self.tagger = tagger
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.queue = queue.Queue()
+
+        self.lock = threading.Lock()
+        self.batch_sizes = collections.Counter()
+        self.images = 0
+        self.wait_time = 0.0
+        self.inference_time = 0.0
+
+        self.thread = threading.Thread(target=self.run, daemon=True,
+            name='autotag-scheduler')
+        self.thread.start()
+
+    def submit(self, image: torch.Tensor) -> Future:
+        """Queue a transformed image and get a future for its tags"""
+
+        future = Future()
+        self.queue.put((image, future, time.monotonic()))
+        return future
+
+    def run(self) -> None:
+        while (True):
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.max_wait
+
+            while (len(batch) < self.max_batch_size):
+                remaining = deadline - time.monotonic()
+                if (remaining <= 0):
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            self.process(batch)
+
+    def process(self, batch: list) -> None:
+        """Run one forward pass over a batch and resolve its futures"""
+
+        started = time.monotonic()
+        try:
+            images = torch.stack([image for image, _, _ in batch])
+            results = self.infer(images)
+        except Exception as error:
+            for _, future, _ in batch:
+                future.set_exception(error)
+            return
+        finished = time.monotonic()
+
+        with self.lock:
+            self.batch_sizes[len(batch)] += 1
+            self.images += len(batch)
+            self.wait_time += sum(started - queued for _, _, queued in batch)
+            self.inference_time += finished - started
+
+        for (_, future, _), result in zip(batch, results):
+            future.set_result(result)
+
+    def infer(self, images: torch.Tensor) -> list:
+        return [parseTags(result) for result in self.tagger.tag(images)]
+
+    def stats(self) -> dict:
+        """Summarize queueing and batching behavior since startup"""
+
+        with self.lock:
+            batches = sum(self.batch_sizes.values())
+            return {
+                'queue_depth': self.queue.qsize(),
+                'max_batch_size': self.max_batch_size,
+                'max_wait_ms': self.max_wait * 1000,
+                'batches': batches,
+                'images': self.images,
+                'batch_sizes': dict(sorted(self.batch_sizes.items())),
+                'mean_batch_size': self.images / batches if batches else 0,
+                'mean_wait_ms':
+                    1000 * self.wait_time / self.images if self.images else 0,
+                'mean_inference_ms':
+                    1000 * self.inference_time / batches if batches else 0,
+            }
+
+
+class EmbeddingScheduler(BatchScheduler):
+    """Batch image embedding requests the same way as tagging requests"""
+
+    def infer(self, images: torch.Tensor) -> list:
+        return list(self.tagger.embedImages(images))
@@ -0,0 +1,256 @@
+import base64, hashlib, io, os, tempfile, time
+from pathlib import Path
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+
+import PIL.ExifTags, PIL.Image, PIL.ImageOps
+
+from . import duplicates, metrics
+from .models import Image
+
+
+ORIGINALS_DIRECTORY = 'images'
+
+# Suffixes of originals being written and being removed
+PARTIAL_SUFFIX = '.part'
+SWEEP_SUFFIX = '.sweep'
+
+# Uploads beyond these limits are refused before anything is decoded
+MAX_UPLOAD_BYTES = 50 * 1024 * 1024
+MAX_PIXELS = 60_000_000
+
+# Longest edge an original is stored at, or None to keep the full size.
+# Shrunken and rotated originals are encoded again at ORIGINAL_QUALITY.
+MAX_EDGE = 4096
+ORIGINAL_QUALITY = 90
+
+# Edge of the image the dominant color is picked from, and of the blurry
+# placeholder shown while an image loads
+PREVIEW_SIZE = 64
+PLACEHOLDER_SIZE = 16
+PLACEHOLDER_QUALITY = 50
+DOMINANT_COLORS = 5
+
+# Image fields filled in by describe, which also computes the perceptual
+# hash from the same small copy
+DETAIL_FIELDS = ['width', 'height', 'mime_type', 'byte_size',
+                 'dominant_color', 'placeholder']
+
+# Seconds an unreferenced original is kept before sweepOriginals removes
+# it, which covers uploads that stored a file but haven't saved their row
+ORPHAN_MIN_AGE = 60 * 60
+
+# Formats stored as sent when nothing needs changing; others become PNG
+KEPT_FORMATS = {'JPEG': 'jpg', 'PNG': 'png', 'GIF': 'gif', 'WEBP': 'webp'}
+
+
+class IngestError(ValueError):
+    """Raised when an upload is refused"""
+
+
+def originalName(digest: str, extension: str) -> str:
+    """Get the content-addressed path of an original"""
+
+    return f'{ORIGINALS_DIRECTORY}/{digest[:2]}/{digest[2:4]}/{digest}.{extension}'
+
+
+def normalize(data: bytes) -> tuple[bytes, str]:
+    """Check an upload against the limits, rotating and shrinking it if needed"""
+
+    try:
+        im = PIL.Image.open(io.BytesIO(data))
+    except (OSError, PIL.Image.DecompressionBombError):
+        raise IngestError('The file is not an image that can be read.')
+
+    with im:
+        # Only the header has been read, so this costs nothing to check
+        if (im.width * im.height > MAX_PIXELS):
+            raise IngestError(f'Images can have at most '
+                f'{MAX_PIXELS // 1_000_000} million pixels.')
+
+        # Cameras often save JPEGs with an embedded preview as MPO
+        format = 'JPEG' if im.format == 'MPO' else im.format
+        orientation = im.getexif().get(PIL.ExifTags.Base.Orientation, 1)
+        oversized = MAX_EDGE != None and max(im.size) > MAX_EDGE
+
+        # Encoding again would drop every frame but the first of animations
+        animated = (format in ('GIF', 'PNG', 'WEBP') and
+            getattr(im, 'is_animated', False))
+        if (animated or (format in KEPT_FORMATS and orientation == 1 and
+                not oversized)):
+            return data, KEPT_FORMATS[format]
+
+        try:
+            with metrics.timed('ingest'):
+                return encode(im, format, oversized)
+        except (OSError, ValueError):
+            raise IngestError('The file is not an image that can be read.')
+
+
+def encode(im: PIL.Image.Image, format: str,
+           oversized: bool) -> tuple[bytes, str]:
+    if (oversized):
+        # Let JPEG decode at a reduced scale instead of at full size
+        im.draft(im.mode, (MAX_EDGE, MAX_EDGE))
+    im = PIL.ImageOps.exif_transpose(im)
+    if (oversized):
+        im.thumbnail((MAX_EDGE, MAX_EDGE))
+
+    output = io.BytesIO()
+    options = {'icc_profile': im.info.get('icc_profile')}
+    if (format == 'JPEG'):
+        if (im.mode not in ('RGB', 'L', 'CMYK')):
+            im = im.convert('RGB')
+        im.save(output, 'JPEG', quality=ORIGINAL_QUALITY, optimize=True,
+            exif=im.info.get('exif', b''), **options)
+        return output.getvalue(), 'jpg'
+    if (format == 'WEBP'):
+        im.save(output, 'WEBP', quality=ORIGINAL_QUALITY, **options)
+        return output.getvalue(), 'webp'
+
+    im.save(output, 'PNG', optimize=True, **options)
+    return output.getvalue(), 'png'
+
+
+def dominantColor(im: PIL.Image.Image) -> str:
+    """Get the most common color of a small image as a CSS hex color"""
+
+    quantized = im.quantize(DOMINANT_COLORS)
+    _, index = max(quantized.getcolors())
+    red, green, blue = quantized.getpalette()[index * 3:index * 3 + 3]
+    return f'#{red:02x}{green:02x}{blue:02x}'
+
+
+def placeholder(im: PIL.Image.Image) -> str:
+    """Encode a tiny, blurry copy of an image as a data URI"""
+
+    small = im.copy()
+    small.thumbnail((PLACEHOLDER_SIZE, PLACEHOLDER_SIZE))
+    output = io.BytesIO()
+    # WebP needs a tenth of the bytes JPEG spends on its headers alone
+    small.save(output, 'WEBP', quality=PLACEHOLDER_QUALITY)
+    return 'data:image/webp;base64,' + \
+        base64.b64encode(output.getvalue()).decode()
+
+
+def describe(data: bytes) -> dict:
+    """Get the values of the Image fields describing a stored file"""
+
+    with PIL.Image.open(io.BytesIO(data)) as im:
+        width, height = im.size
+        mime_type = im.get_format_mimetype()
+
+        # JPEGs can be decoded at a fraction of their size for this
+        im.draft('RGB', (PREVIEW_SIZE, PREVIEW_SIZE))
+        preview = im.convert('RGBA').convert('RGB')
+    preview.thumbnail((PREVIEW_SIZE, PREVIEW_SIZE))
+
+    return {
+        'width': width,
+        'height': height,
+        'mime_type': mime_type,
+        'byte_size': len(data),
+        'dominant_color': dominantColor(preview),
+        'placeholder': placeholder(preview),
+        'phash': duplicates.differenceHash(preview),
+    }
+
+
+def assignDetails(image: Image, details: dict) -> None:
+    """Store the description of a file on an image without saving it"""
+
+    for field in DETAIL_FIELDS:
+        setattr(image, field, details[field])
+    duplicates.assignHash(image, details['phash'])
+
+
+def ingest(file) -> tuple[str, dict]:
+    """Normalize an uploaded image and store it once per distinct content"""
+
+    if (file.size > MAX_UPLOAD_BYTES):
+        raise IngestError(f'Images can be at most '
+            f'{MAX_UPLOAD_BYTES // (1024 * 1024)} MB.')
+
+    file.seek(0)
+    data, extension = normalize(file.read())
+
+    # Identical bytes map to the same name, so they are only written once
+    name = originalName(hashlib.sha256(data).hexdigest(), extension)
+    store(name, data)
+    return name, describe(data)
+
+
+def store(name: str, data: bytes) -> None:
+    """Write an original unless a file with the same content is stored"""
+
+    path = Path(default_storage.path(name))
+    try:
+        # Mark the file as in use so the sweep leaves it alone until the
+        # row referencing it has been saved
+        os.utime(path)
+        return
+    except FileNotFoundError:
+        pass
+
+    # Concurrent uploads of the same bytes both write whole files, so
+    # whichever replaces the other leaves the same content behind
+    path.parent.mkdir(parents=True, exist_ok=True)
+    descriptor, temporary_path = tempfile.mkstemp(dir=path.parent,
+        suffix=PARTIAL_SUFFIX)
+    try:
+        with os.fdopen(descriptor, 'wb') as output:
+            output.write(data)
+        os.chmod(temporary_path, settings.FILE_UPLOAD_PERMISSIONS or 0o644)
+        os.replace(temporary_path, path)
+    except:
+        Path(temporary_path).unlink(missing_ok=True)
+        raise
+
+
+def sweepOriginals(min_age: float = ORPHAN_MIN_AGE) -> int:
+    """Remove originals no image uses, returning how many were removed
+
+    Originals are shared by every image with the same content, so they are
+    never removed while a request runs, only by this sweep."""
+
+    directory = Path(default_storage.path(ORIGINALS_DIRECTORY))
+    if (not directory.exists()):
+        return 0
+
+    used = set(Image.objects.values_list('file', flat=True))
+    cutoff = time.time() - min_age
+    removed = 0
+    for path in directory.glob('*/*/*'):
+        name = path.relative_to(directory.parent).as_posix()
+        if (name in used):
+            continue
+        if (path.name.endswith(SWEEP_SUFFIX)):
+            # Left behind by an interrupted sweep; the next one decides
+            original = path.with_name(path.name[:-len(SWEEP_SUFFIX)])
+            if (original.exists()):
+                path.unlink(missing_ok=True)
+            else:
+                os.replace(path, original)
+            continue
+        if (path.name.endswith(PARTIAL_SUFFIX)):
+            # Left behind by an upload that was interrupted while writing
+            if (path.stat().st_mtime < cutoff):
+                path.unlink(missing_ok=True)
+            continue
+
+        # Move the file aside first: an upload choosing it from now on
+        # writes a new copy, and one that chose it before has touched it
+        # or saved its row, which is checked after the move
+        quarantined = path.with_name(path.name + SWEEP_SUFFIX)
+        try:
+            os.rename(path, quarantined)
+        except FileNotFoundError:
+            continue
+        if (quarantined.stat().st_mtime >= cutoff or
+                Image.objects.filter(file=name).exists()):
+            os.replace(quarantined, path)
+        else:
+            quarantined.unlink()
+            removed += 1
+    return removed
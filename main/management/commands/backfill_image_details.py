@@ -0,0 +1,59 @@
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from main import caching, ingest
+from main.models import Image
+
+
+def describeImage(file_name: str) -> dict:
+    return ingest.describe(Path(default_storage.path(file_name)).read_bytes())
+
+
+class Command(BaseCommand):
+    help = 'Record the size, format and placeholder of images missing them'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count(),
+            help='Number of worker processes (default: one per core)')
+        parser.add_argument('--force', action='store_true',
+            help='Describe images that already have their details')
+
+    def handle(self, *args, **options):
+        images = Image.objects.order_by('id')
+        if (not options['force']):
+            images = images.filter(width=None)
+        images = list(images.values_list('id', 'file'))
+
+        # Worker processes only read files, so drop the connection before
+        # forking rather than sharing its socket with the children
+        connections.close_all()
+
+        described = []
+        with ProcessPoolExecutor(max_workers=options['workers']) as executor:
+            futures = {
+                executor.submit(describeImage, file_name): image_id
+                for image_id, file_name in images
+            }
+            for done, future in enumerate(as_completed(futures), 1):
+                try:
+                    image = Image(id=futures[future])
+                    ingest.assignDetails(image, future.result())
+                    described.append(image)
+                except Exception as error:
+                    self.stderr.write(f'Image {futures[future]}: {error}')
+                if (done % 100 == 0 or done == len(futures)):
+                    self.stdout.write(f'{done}/{len(futures)} images')
+
+        Image.objects.bulk_update(described, ingest.DETAIL_FIELDS,
+            batch_size=1000)
+        # Pages showing these images were rendered without the details
+        caching.bump(caching.CATALOG_VERSION,
+            *[caching.imageVersionKey(image.id) for image in described])
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Described {len(described)} images'))
@@ -0,0 +1,124 @@
+import tempfile
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import (override_settings, setup_test_environment,
+    teardown_test_environment)
+
+from main import benchmark
+
+
+# The benchmark clears the cache between requests, which must not reach the
+# cache the site is using
+BENCHMARK_CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'imagesite-benchmark',
+    },
+}
+
+class Command(BaseCommand):
+    help = ('Time the request hot paths against a synthetic library built '
+            'in a throwaway test database')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--images', type=int, default=1000,
+            help='Number of images in the synthetic library')
+        parser.add_argument('--tags', type=int, default=None,
+            help='Number of distinct tags (default: images / 20, at least 50)')
+        parser.add_argument('--tags-per-image', type=int, default=5,
+            help='Tags drawn for each image before removing repeats')
+        parser.add_argument('--zipf', type=float, default=1.1,
+            help='Exponent of the Zipf distribution of tag usage')
+        parser.add_argument('--iterations', type=int, default=30,
+            help='Requests timed per scenario')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', default=None,
+            help='Write the results to this JSON file')
+        parser.add_argument('--baseline', default=None,
+            help='Compare the results with this JSON file and fail on '
+                 'regressions')
+        parser.add_argument('--results', default=None,
+            help='Compare this JSON file with the baseline instead of '
+                 'running the benchmark')
+        parser.add_argument('--threshold', type=float,
+            default=benchmark.REGRESSION_THRESHOLD,
+            help='Fractional slowdown of p50 or p90 counted as a regression')
+
+    def handle(self, *args, **options):
+        if (options['results'] != None):
+            if (options['baseline'] == None):
+                raise CommandError('--results needs a --baseline to compare')
+            results = benchmark.loadResults(options['results'])
+        else:
+            results = self.run(options)
+
+        if (options['output'] != None):
+            benchmark.saveResults(options['output'], results)
+            self.stdout.write(f'Wrote {options["output"]}')
+
+        if (options['baseline'] != None):
+            baseline = benchmark.loadResults(options['baseline'])
+            if (baseline['library'] != results['library']):
+                self.stderr.write(self.style.WARNING(
+                    'The baseline was measured on a different library'))
+
+            regressions = benchmark.compare(baseline, results,
+                options['threshold'])
+            for regression in regressions:
+                self.stderr.write(self.style.ERROR(regression))
+            if (regressions):
+                raise CommandError(f'{len(regressions)} regressions')
+            self.stdout.write(self.style.SUCCESS('No regressions'))
+
+    def run(self, options: dict) -> dict:
+        if (connection.vendor != 'postgresql'):
+            # Search relies on PostgreSQL full text search and trigram
+            # indexes, so no other database can stand in for it
+            raise CommandError('The benchmark needs a PostgreSQL database')
+
+        library = {
+            'images': options['images'],
+            'tags': options['tags'] or max(50, options['images'] // 20),
+            'tags_per_image': options['tags_per_image'],
+            'zipf': options['zipf'],
+            'seed': options['seed'],
+        }
+
+        # Never touch real data: build everything in a test database, a
+        # temporary media directory and a private cache, all removed
+        # afterwards
+        setup_test_environment()
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            with tempfile.TemporaryDirectory() as media_root, \
+                    override_settings(MEDIA_ROOT=media_root,
+                        CACHES=BENCHMARK_CACHES):
+                self.stdout.write('Building the library...')
+                data = benchmark.buildLibrary(library['images'],
+                    library['tags'], library['tags_per_image'],
+                    library['zipf'], library['seed'], log=self.stdout.write)
+
+                scenarios = benchmark.Benchmark(data, options['iterations'],
+                    options['seed'], log=self.stdout.write).run()
+                environment = benchmark.environment()
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        self.report(scenarios)
+        return {
+            'environment': environment,
+            'library': library,
+            'iterations': options['iterations'],
+            'scenarios': scenarios,
+        }
+
+    def report(self, scenarios: dict) -> None:
+        self.stdout.write(f'{"scenario":32} {"p50":>8} {"p90":>8} {"p99":>8} '
+            f'{"queries":>8} {"req/s":>8}')
+        for name, result in scenarios.items():
+            self.stdout.write(f'{name:32} {result["p50_ms"]:8.1f} '
+                f'{result["p90_ms"]:8.1f} {result["p99_ms"]:8.1f} '
+                f'{result["queries_max"]:8} {result["throughput_rps"]:8.1f}')
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from main import inference
+
+
+class Command(BaseCommand):
+    help = 'Build the optimized model artifact for an autotagging backend'
+
+    def add_arguments(self, parser):
+        parser.add_argument('backend',
+            choices=list(inference.ARTIFACT_SUFFIXES))
+        parser.add_argument('--checkpoint', default=inference.CHECKPOINT,
+            help='RAM++ checkpoint to build from')
+
+    def handle(self, *args, **options):
+        path = inference.buildArtifact(options['backend'],
+            options['checkpoint'])
+        self.stdout.write(self.style.SUCCESS(f'Wrote {path}'))
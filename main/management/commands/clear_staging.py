@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from main import staging
+
+
+class Command(BaseCommand):
+    help = 'Remove staged uploads that were never submitted'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--max-age', type=float,
+            default=staging.STAGING_MAX_AGE / 3600,
+            help='Hours a staged file is kept (default: %(default)s)')
+
+    def handle(self, *args, **options):
+        removed = staging.clearExpired(options['max_age'] * 3600)
+        self.stdout.write(self.style.SUCCESS(
+            f'Removed {removed} staged uploads'))
@@ -0,0 +1,102 @@
+import multiprocessing, resource, statistics, time
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+
+import PIL.Image
+
+
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp'}
+
+
+def measure(backend: str, checkpoint: str, paths: list[str],
+            warmup: int) -> dict:
+    """Tag every image with one backend, run in a fresh process"""
+
+    from main import inference
+
+    started = time.perf_counter()
+    tagger = inference.loadTagger(backend, checkpoint)
+    load_time = time.perf_counter() - started
+
+    images = [inference.transform(PIL.Image.open(path)).unsqueeze(0)
+              for path in paths]
+    for image in images[:warmup]:
+        tagger.tag(image)
+
+    latencies = []
+    tags = []
+    for image in images:
+        started = time.perf_counter()
+        result = tagger.tag(image)[0]
+        latencies.append(time.perf_counter() - started)
+        tags.append(inference.parseTags(result))
+
+    return {
+        'load_time': load_time,
+        'latencies': latencies,
+        # ru_maxrss is reported in kilobytes on Linux
+        'peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        'tags': tags,
+    }
+
+
+def agreement(tags: list[list[str]], baseline: list[list[str]]) -> float:
+    """Mean Jaccard similarity of tag sets against the baseline"""
+
+    scores = []
+    for result, expected in zip(tags, baseline):
+        union = set(result) | set(expected)
+        scores.append(len(set(result) & set(expected)) / len(union)
+                      if union else 1.0)
+    return statistics.mean(scores)
+
+
+class Command(BaseCommand):
+    help = 'Compare autotagging backends against the fp32 baseline'
+
+    def add_arguments(self, parser):
+        from main import inference
+
+        parser.add_argument('directory', help='Directory of sample images')
+        parser.add_argument('--backends', nargs='+',
+            default=inference.BACKENDS, choices=inference.BACKENDS)
+        parser.add_argument('--checkpoint', default=inference.CHECKPOINT)
+        parser.add_argument('--limit', type=int, default=100,
+            help='Maximum number of images to use')
+        parser.add_argument('--warmup', type=int, default=3,
+            help='Untimed runs before measuring')
+
+    def handle(self, *args, **options):
+        directory = Path(options['directory'])
+        paths = sorted(str(path) for path in directory.rglob('*')
+                       if path.suffix.lower() in IMAGE_EXTENSIONS)
+        paths = paths[:options['limit']]
+        if (len(paths) == 0):
+            raise CommandError('No images found')
+
+        backends = options['backends']
+        if ('fp32' not in backends):
+            backends = ['fp32'] + backends
+
+        # A fresh process per backend keeps peak memory measurements apart
+        context = multiprocessing.get_context('spawn')
+        results = {}
+        for backend in backends:
+            self.stdout.write(f'Measuring {backend}...')
+            with context.Pool(1) as pool:
+                results[backend] = pool.apply(measure, (backend,
+                    options['checkpoint'], paths, options['warmup']))
+
+        baseline = results['fp32']['tags']
+        self.stdout.write(f'\n{len(paths)} images, batch size 1\n')
+        self.stdout.write(f'{"backend":<12}{"load s":>8}{"p50 ms":>9}'
+            f'{"p95 ms":>9}{"peak MB":>10}{"agreement":>11}')
+        for backend, result in results.items():
+            latencies = sorted(result['latencies'])
+            p50 = latencies[len(latencies) // 2] * 1000
+            p95 = latencies[min(int(len(latencies) * 0.95),
+                                len(latencies) - 1)] * 1000
+            self.stdout.write(f'{backend:<12}{result["load_time"]:>8.1f}'
+                f'{p50:>9.0f}{p95:>9.0f}{result["peak_rss"] / 2**20:>10.0f}'
+                f'{agreement(result["tags"], baseline):>11.3f}')
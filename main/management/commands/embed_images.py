@@ -0,0 +1,68 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import numpy as np
+
+from django.core.management.base import BaseCommand
+
+from main import embeddings
+from main.models import Image
+
+
+# Embeddings are appended to the store in groups of this many
+APPEND_BATCH_SIZE = 256
+
+
+def embed(file_name: str) -> np.ndarray:
+    with Image(file=file_name).file.open('rb') as file:
+        return embeddings.embedImage(file.read())
+
+
+class Command(BaseCommand):
+    help = 'Embed every image for semantic search with the model server'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=8,
+            help='Number of concurrent requests; the server batches them')
+        parser.add_argument('--force', action='store_true',
+            help='Embed images that already have an embedding')
+
+    def handle(self, *args, **options):
+        store = embeddings.getStore()
+        images = list(Image.objects.order_by('id').values_list('id', 'file'))
+        if (not options['force']):
+            embedded = store.ids()
+            images = [(image_id, file_name) for image_id, file_name in images
+                      if image_id not in embedded]
+
+        ids, vectors, failures = [], [], 0
+        with ThreadPoolExecutor(max_workers=options['workers']) as executor:
+            futures = {
+                executor.submit(embed, file_name): image_id
+                for image_id, file_name in images
+            }
+            for done, future in enumerate(as_completed(futures), 1):
+                try:
+                    vectors.append(future.result())
+                    ids.append(futures[future])
+                except Exception as error:
+                    failures += 1
+                    self.stderr.write(f'Image {futures[future]}: {error}')
+
+                if (len(ids) >= APPEND_BATCH_SIZE or done == len(futures)):
+                    if (ids):
+                        store.append(ids, np.stack(vectors))
+                    ids, vectors = [], []
+                if (done % 100 == 0 or done == len(futures)):
+                    self.stdout.write(f'{done}/{len(futures)} images')
+
+        # Drop replaced embeddings and those of deleted images
+        removed = store.compact(set(Image.objects.values_list('id', flat=True)))
+
+        # Compacting moved the rows, so the clustered index is built again
+        lists = store.buildIndex()
+        if (lists):
+            self.stdout.write(f'Clustered the embeddings into {lists} lists')
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Embedded {len(images) - failures} images, '
+            f'removed {removed} stale embeddings'))
@@ -0,0 +1,59 @@
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from main import renditions
+from main.models import Image
+
+
+def generate(image_id: int, file_name: str, width: int | None, force: bool,
+             encoding: str | None) -> None:
+    renditions.generateRenditions(
+        Image(id=image_id, file=file_name, width=width),
+        force=force, encoding=encoding)
+
+
+class Command(BaseCommand):
+    help = 'Generate the resized renditions of every image in the library'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count(),
+            help='Number of worker processes (default: one per core)')
+        parser.add_argument('--force', action='store_true',
+            help='Regenerate renditions that already exist')
+        parser.add_argument('--encoding',
+            default=renditions.preferredEncoding() or 'original',
+            choices=renditions.supportedEncodings() + ['original'],
+            help='Encoding of the renditions (default: %(default)s)')
+
+    def handle(self, *args, **options):
+        images = list(Image.objects.order_by('id')
+            .values_list('id', 'file', 'width'))
+        encoding = options['encoding']
+        if (encoding == 'original'):
+            encoding = None
+
+        # Worker processes only touch files, so drop the connection before
+        # forking rather than sharing its socket with the children
+        connections.close_all()
+
+        failures = 0
+        with ProcessPoolExecutor(max_workers=options['workers']) as executor:
+            futures = {
+                executor.submit(generate, image_id, file_name, width,
+                    options['force'], encoding): image_id
+                for image_id, file_name, width in images
+            }
+            for done, future in enumerate(as_completed(futures), 1):
+                try:
+                    future.result()
+                except Exception as error:
+                    failures += 1
+                    self.stderr.write(f'Image {futures[future]}: {error}')
+                if (done % 100 == 0 or done == len(futures)):
+                    self.stdout.write(f'{done}/{len(futures)} images')
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Generated renditions for {len(images) - failures} images'))
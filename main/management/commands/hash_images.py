@@ -0,0 +1,70 @@
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from main import duplicates, ingest
+from main.models import Image
+
+
+def hashImage(file_name: str) -> int:
+    # Hash the same preview uploads are hashed from, so a backfilled hash
+    # matches the one an upload of the file would get
+    data = Path(default_storage.path(file_name)).read_bytes()
+    return ingest.describe(data)['phash']
+
+
+class Command(BaseCommand):
+    help = 'Compute the perceptual hash of every image and report duplicates'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count(),
+            help='Number of worker processes (default: one per core)')
+        parser.add_argument('--force', action='store_true',
+            help='Rehash images that already have a hash')
+        parser.add_argument('--radius', type=int,
+            default=duplicates.DUPLICATE_RADIUS,
+            help='Maximum number of differing bits between duplicates')
+
+    def handle(self, *args, **options):
+        images = Image.objects.order_by('id')
+        if (not options['force']):
+            images = images.filter(phash=None)
+        images = list(images.values_list('id', 'file'))
+
+        # Worker processes only read files, so drop the connection before
+        # forking rather than sharing its socket with the children
+        connections.close_all()
+
+        hashed = []
+        with ProcessPoolExecutor(max_workers=options['workers']) as executor:
+            futures = {
+                executor.submit(hashImage, file_name): image_id
+                for image_id, file_name in images
+            }
+            for done, future in enumerate(as_completed(futures), 1):
+                try:
+                    image = Image(id=futures[future])
+                    duplicates.assignHash(image, future.result())
+                    hashed.append(image)
+                except Exception as error:
+                    self.stderr.write(f'Image {futures[future]}: {error}')
+                if (done % 100 == 0 or done == len(futures)):
+                    self.stdout.write(f'{done}/{len(futures)} images')
+
+        Image.objects.bulk_update(hashed,
+            ['phash'] + duplicates.CHUNK_FIELDS, batch_size=1000)
+        self.stdout.write(self.style.SUCCESS(f'Hashed {len(hashed)} images'))
+
+        hashes = dict(Image.objects.exclude(phash=None)
+            .values_list('id', 'phash'))
+        clusters = duplicates.findClusters(hashes, options['radius'])
+
+        for cluster in clusters:
+            self.stdout.write('Duplicates: ' +
+                ', '.join(str(image_id) for image_id in cluster))
+        self.stdout.write(f'{len(clusters)} clusters of duplicates, '
+            f'{sum(len(cluster) for cluster in clusters)} images')
@@ -0,0 +1,221 @@
+import hashlib, json, os, tempfile, time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import Path
+
+import PIL.Image
+
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+
+from main import autotagger, caching, ingest
+from main.models import Image, ImageTag, Tag, normalizeTitle
+from main.tagging import addTags
+
+
+# Tagging requests in flight at once; the server batches them
+TAGGING_CONCURRENCY = 16
+
+CHECKPOINT_DIRECTORY = 'imports'
+
+
+def walk(directory: Path, after: tuple[str, ...] = (),
+         parts: tuple[str, ...] = ()):
+    """Yield the image files under a directory in a stable order, lazily"""
+
+    try:
+        entries = sorted(os.scandir(directory), key=lambda entry: entry.name)
+    except OSError:
+        return
+
+    # Entries are visited sorted by name, so the walk follows the order of
+    # the relative path parts and a checkpoint is a single path
+    extensions = PIL.Image.registered_extensions()
+    for entry in entries:
+        entryParts = parts + (entry.name,)
+        if (entry.is_dir(follow_symlinks=False)):
+            # Skip whole directories that lie before the checkpoint
+            if (entryParts >= after[:len(entryParts)]):
+                yield from walk(Path(entry.path), after, entryParts)
+        elif (entry.is_file() and entryParts > after and
+                os.path.splitext(entry.name)[1].lower() in extensions):
+            yield Path(entry.path), entryParts
+
+
+def prepare(path: Path, tagging: bool) -> dict:
+    """Validate, normalize, store and describe one file in a worker"""
+
+    try:
+        with File(open(path, 'rb'), name=path.name) as file:
+            name, details = ingest.ingest(file)
+        preview = None
+        if (tagging):
+            preview = autotagger.preview(default_storage.path(name))
+        return {'name': name, 'details': details, 'preview': preview}
+    except (OSError, ValueError) as error:
+        return {'error': str(error)}
+
+
+def titleFromPath(path: Path) -> str:
+    words = path.stem.replace('_', ' ').replace('-', ' ').split()
+    return ' '.join(words)[:255] or path.name[:255]
+
+
+class Command(BaseCommand):
+    help = 'Import every image under a directory, tagging them in bulk'
+
+    def add_arguments(self, parser):
+        parser.add_argument('directory')
+        parser.add_argument('--workers', type=int, default=os.cpu_count(),
+            help='Number of worker processes (default: one per core)')
+        parser.add_argument('--batch-size', type=int, default=500,
+            help='Images written per transaction')
+        parser.add_argument('--tags', default='',
+            help='Tags added to every imported image, separated by spaces')
+        parser.add_argument('--no-autotag', action='store_true',
+            help='Only use --tags instead of asking the tagging model')
+        parser.add_argument('--checkpoint', default=None,
+            help='File recording progress (default: one per directory '
+                 'under MEDIA_ROOT/imports)')
+        parser.add_argument('--restart', action='store_true',
+            help='Ignore the checkpoint and walk the whole directory again')
+
+    def handle(self, *args, **options):
+        root = Path(options['directory']).resolve()
+        if (not root.is_dir()):
+            raise CommandError(f'{root} is not a directory')
+
+        self.extraTags = set(options['tags'].split())
+        maxLength = Tag._meta.get_field('name').max_length
+        if (any(len(name) > maxLength for name in self.extraTags)):
+            raise CommandError(f'Tags can be at most {maxLength} characters')
+
+        self.tagging = not options['no_autotag']
+        if (self.tagging and 'error' in autotagger.stats()):
+            self.stderr.write(self.style.WARNING(
+                'The tagging server is not running, importing without tags'))
+            self.tagging = False
+
+        digest = hashlib.sha1(str(root).encode()).hexdigest()[:12]
+        self.checkpointPath = Path(options['checkpoint'] or
+            default_storage.path(f'{CHECKPOINT_DIRECTORY}/{digest}.json'))
+        self.progress = {'directory': str(root), 'last': [], 'files': 0,
+                         'imported': 0, 'skipped': 0, 'failed': 0}
+        if (self.checkpointPath.exists() and not options['restart']):
+            with open(self.checkpointPath) as file:
+                self.progress = json.load(file)
+            if (self.progress['directory'] != str(root)):
+                raise CommandError(f'{self.checkpointPath} belongs to an '
+                    f'import of {self.progress["directory"]}')
+            self.stdout.write(
+                f'Resuming after {"/".join(self.progress["last"])}')
+
+        self.started = time.monotonic()
+        self.startImported = self.progress['imported']
+        paths = walk(root, tuple(self.progress['last']))
+
+        # Workers never use the database, so drop the connection before
+        # forking rather than sharing its socket with the children
+        connections.close_all()
+
+        with ProcessPoolExecutor(max_workers=options['workers']) as processes, \
+                ThreadPoolExecutor(max_workers=TAGGING_CONCURRENCY) as threads:
+            self.threads = threads
+
+            # Keep the next batch decoding while the current one is written
+            pending = deque()
+            while (True):
+                batch = [next(paths, None) for _ in range(options['batch_size'])]
+                batch = [item for item in batch if item != None]
+                if (batch):
+                    pending.append((batch, [
+                        processes.submit(prepare, path, self.tagging)
+                        for path, _ in batch]))
+                if (len(pending) > 1 or (pending and not batch)):
+                    self.write(*pending.popleft())
+                if (not batch and not pending):
+                    break
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Imported {self.progress["imported"]} images, skipped '
+            f'{self.progress["skipped"]} already in the library, '
+            f'{self.progress["failed"]} failed'))
+        self.stdout.write('Run generate_renditions, embed_images and '
+            'rebuild_neighbors to finish preparing the new images')
+
+    def write(self, batch: list, futures: list) -> None:
+        """Tag a prepared batch and write it in one transaction"""
+
+        prepared = []
+        for (path, _), future in zip(batch, futures):
+            result = future.result()
+            if ('error' in result):
+                self.progress['failed'] += 1
+                self.stderr.write(f'{path}: {result["error"]}')
+            else:
+                prepared.append((path, result))
+
+        tags = [set() for _ in prepared]
+        if (self.tagging):
+            suggested = self.threads.map(autotagger.tagImage,
+                [result['preview'] for _, result in prepared])
+            tags = [set(names) for names in suggested]
+
+        # Identical files share a name, so skip those already imported
+        existing = set(Image.objects.filter(
+            file__in=[result['name'] for _, result in prepared])
+            .values_list('file', flat=True))
+
+        images, suggestedNames = [], []
+        for (path, result), names in zip(prepared, tags):
+            if (result['name'] in existing):
+                self.progress['skipped'] += 1
+                continue
+            existing.add(result['name'])
+
+            title = titleFromPath(path)
+            image = Image(file=result['name'], title=title,
+                title_normalized=normalizeTitle(title), description='')
+            ingest.assignDetails(image, result['details'])
+            images.append(image)
+            # Tags given on the command line count as entered by a user
+            suggestedNames.append(names - self.extraTags)
+
+        with transaction.atomic():
+            Image.objects.bulk_create(images)
+            userTags = {image.id: self.extraTags
+                        for image in images if self.extraTags}
+            autoTags = {image.id: names
+                        for image, names in zip(images, suggestedNames) if names}
+            addTags(userTags, ImageTag.USER)
+            addTags(autoTags, ImageTag.AUTO)
+            Image.updateSearchVectors([image.id for image in images
+                if image.id not in userTags and image.id not in autoTags])
+
+            # bulk_create skips Image.save, which would invalidate the pages
+            if (images):
+                caching.bumpOnCommit(caching.CATALOG_VERSION,
+                    *[caching.imageVersionKey(image.id) for image in images])
+
+        self.progress['files'] += len(batch)
+        self.progress['imported'] += len(images)
+        self.progress['last'] = list(batch[-1][1])
+        self.saveCheckpoint()
+
+        elapsed = time.monotonic() - self.started
+        rate = (self.progress['imported'] - self.startImported) / elapsed
+        self.stdout.write(f'{self.progress["files"]} files, '
+            f'{self.progress["imported"]} imported, '
+            f'{self.progress["skipped"]} skipped, '
+            f'{self.progress["failed"]} failed, {rate:.1f} images/s')
+
+    def saveCheckpoint(self) -> None:
+        # Replace the file in one step so a crash never leaves half of it
+        self.checkpointPath.parent.mkdir(parents=True, exist_ok=True)
+        descriptor, temporary_path = tempfile.mkstemp(
+            dir=self.checkpointPath.parent)
+        with os.fdopen(descriptor, 'w') as file:
+            json.dump(self.progress, file)
+        os.replace(temporary_path, self.checkpointPath)
@@ -0,0 +1,78 @@
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+import numpy as np
+
+from django.core.management.base import BaseCommand
+from django.db import connections, transaction
+
+from main import caching, embeddings, neighbors
+from main.models import Image, ImageNeighbor
+
+
+def nearestBlock(path: Path, image_ids: list[int],
+                 count: int) -> tuple[list[int], np.ndarray, np.ndarray]:
+    """Find the nearest embeddings for a block of images in a worker"""
+
+    store = embeddings.EmbeddingStore(path)
+    rows, live = store.load()
+    index = {id: row for row, id in enumerate(rows['id'].tolist()) if live[row]}
+    vectors = rows['vector'][[index[id] for id in image_ids]]
+    ids, scores = store.nearest(vectors, count)
+    return image_ids, ids, scores
+
+
+class Command(BaseCommand):
+    help = 'Recompute the similar images of every image from scratch'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count(),
+            help='Number of worker processes (default: one per core)')
+        parser.add_argument('--block-size', type=int, default=1024,
+            help='Number of images each worker compares at a time')
+
+    def handle(self, *args, **options):
+        store = embeddings.getStore()
+        existing = set(Image.objects.values_list('id', flat=True))
+        embedded = sorted(store.ids() & existing)
+        unembedded = sorted(existing - set(embedded))
+        count = neighbors.NEIGHBOR_COUNT
+
+        # Workers only read the embeddings file, so drop the connection
+        # before forking rather than sharing its socket with the children
+        connections.close_all()
+
+        found = {}
+        blocks = [embedded[start:start + options['block_size']]
+                  for start in range(0, len(embedded), options['block_size'])]
+        with ProcessPoolExecutor(max_workers=options['workers']) as executor:
+            # Ask for spare rows to skip the image itself and deleted images
+            futures = [executor.submit(nearestBlock, store.path, block,
+                           count * 2 + 1)
+                       for block in blocks]
+            for done, future in enumerate(as_completed(futures), 1):
+                image_ids, ids, scores = future.result()
+                for image_id, row_ids, row_scores in zip(image_ids,
+                        ids.tolist(), scores.tolist()):
+                    found[image_id] = [
+                        (id, score) for id, score in zip(row_ids, row_scores)
+                        if id != image_id and id in existing][:count]
+                self.stdout.write(f'{done}/{len(blocks)} blocks')
+
+        for image_id in unembedded:
+            found[image_id] = neighbors.jaccardNeighbors(image_id)
+
+        with transaction.atomic():
+            ImageNeighbor.objects.all().delete()
+            ImageNeighbor.objects.bulk_create([
+                ImageNeighbor(image_id=image_id, neighbor_id=neighbor_id,
+                    rank=rank, score=score)
+                for image_id, similar in found.items()
+                for rank, (neighbor_id, score) in enumerate(similar)
+            ], batch_size=5000)
+            caching.bumpOnCommit(caching.NEIGHBORS_VERSION)
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Found neighbors for {len(embedded)} images by embedding and '
+            f'{len(unembedded)} by tags'))
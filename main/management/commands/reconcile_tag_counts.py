@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from main import caching, tagindex
+from main.models import Tag
+from main.tagging import reconcileTagCounts
+
+
+class Command(BaseCommand):
+    help = 'Recount the images using each tag and repair any drift'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--keep-unused', action='store_true',
+            help='Keep tags that no image uses instead of deleting them')
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            repaired = reconcileTagCounts()
+            deleted = 0
+            if (not options['keep_unused']):
+                deleted, _ = Tag.objects.filter(image_count=0).delete()
+
+        if (repaired or deleted):
+            tagindex.invalidate()
+            caching.bump(caching.TAGS_VERSION)
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Repaired {repaired} tag counts, deleted {deleted} unused tags'))
@@ -0,0 +1,155 @@
+import json, os, signal, tempfile, time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand, CommandError
+
+from main import autotagger
+from main.models import Image
+from main.tagging import applyMachineTags
+
+
+CHECKPOINT_NAME = 'retag/checkpoint.json'
+
+# Wait while more requests than this are queued at the tagging server, as
+# they are mostly uploads waiting behind the job
+MAX_QUEUE_DEPTH = 8
+BACKOFF_SECONDS = 1
+
+
+def suggest(file_name: str) -> set[str]:
+    return set(autotagger.suggestTags(
+        autotagger.preview(default_storage.path(file_name))))
+
+
+class Command(BaseCommand):
+    help = ('Tag every image again with the current tagging model, '
+            'leaving the tags users entered alone')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--mode', choices=['merge', 'replace'],
+            default='merge', help='Add new machine tags to the old ones, or '
+                                  'replace the old ones (default: merge)')
+        parser.add_argument('--workers', type=int, default=8,
+            help='Number of concurrent requests; the server batches them')
+        parser.add_argument('--chunk-size', type=int, default=256,
+            help='Images tagged and written per transaction')
+        parser.add_argument('--rate', type=float, default=0,
+            help='Most images tagged per second (default: no limit)')
+        parser.add_argument('--max-queue-depth', type=int,
+            default=MAX_QUEUE_DEPTH,
+            help='Wait while more requests are queued at the tagging server')
+        parser.add_argument('--checkpoint', default=None,
+            help='File recording progress (default: MEDIA_ROOT/'
+                 f'{CHECKPOINT_NAME})')
+        parser.add_argument('--restart', action='store_true',
+            help='Ignore the checkpoint and start from the first image')
+
+    def handle(self, *args, **options):
+        stats = autotagger.stats()
+        if ('error' in stats):
+            raise CommandError(
+                f'The tagging server is not running: {stats["error"]}')
+
+        self.checkpointPath = Path(options['checkpoint'] or
+            default_storage.path(CHECKPOINT_NAME))
+        progress = {'mode': options['mode'], 'last_id': 0, 'processed': 0,
+                    'changed': 0, 'failed_ids': []}
+        if (self.checkpointPath.exists() and not options['restart']):
+            with open(self.checkpointPath) as file:
+                progress = json.load(file)
+            if (progress['mode'] != options['mode']):
+                raise CommandError(f'The checkpoint is for --mode '
+                    f'{progress["mode"]}; pass --restart to start over')
+            self.stdout.write(f'Resuming after image {progress["last_id"]}')
+
+        # Stop between chunks when interrupted, so the job can be resumed
+        self.paused = False
+        handlers = {number: signal.signal(number, self.pause)
+                    for number in (signal.SIGINT, signal.SIGTERM)}
+        try:
+            with ThreadPoolExecutor(max_workers=options['workers']) as threads:
+                self.run(threads, progress, options)
+        finally:
+            for number, handler in handlers.items():
+                signal.signal(number, handler)
+
+        if (self.paused):
+            self.stdout.write(f'Paused after image {progress["last_id"]}; '
+                'run the command again to resume')
+            return
+
+        self.checkpointPath.unlink(missing_ok=True)
+        failed = progress['failed_ids']
+        if (failed):
+            self.stderr.write(self.style.WARNING(f'{len(failed)} images '
+                f'could not be tagged: {" ".join(map(str, failed))}'))
+        self.stdout.write(self.style.SUCCESS(
+            f'Tagged {progress["processed"]} images, changed the tags of '
+            f'{progress["changed"]}, {len(failed)} failed'))
+
+    def pause(self, number, frame) -> None:
+        if (self.paused):
+            raise KeyboardInterrupt
+        self.stderr.write('Pausing after the current chunk')
+        self.paused = True
+
+    def run(self, threads: ThreadPoolExecutor, progress: dict,
+            options: dict) -> None:
+        """Tag the images after the checkpoint one chunk at a time"""
+
+        total = Image.objects.filter(id__gt=progress['last_id']).count()
+        started = time.monotonic()
+        done = 0
+
+        while (not self.paused):
+            chunk = list(Image.objects.filter(id__gt=progress['last_id'])
+                .order_by('id').values_list('id', 'file')
+                [:options['chunk_size']])
+            if (not chunk):
+                break
+            self.waitForQueue(options['max_queue_depth'])
+
+            suggestions, failures = {}, []
+            futures = [(image_id, threads.submit(suggest, file_name))
+                       for image_id, file_name in chunk]
+            for image_id, future in futures:
+                try:
+                    suggestions[image_id] = future.result()
+                except Exception as error:
+                    # Any error is the image's alone, so the job carries on
+                    failures.append(image_id)
+                    self.stderr.write(f'Image {image_id}: {error}')
+
+            # Failed images keep their tags and are listed at the end, so
+            # one unreadable file can't hold the job at the same place
+            progress['changed'] += applyMachineTags(suggestions,
+                replace=options['mode'] == 'replace')
+            progress['processed'] += len(suggestions)
+            progress['failed_ids'] += failures
+            progress['last_id'] = chunk[-1][0]
+            self.saveCheckpoint(progress)
+
+            done += len(chunk)
+            self.stdout.write(f'{done}/{total} images, '
+                f'{progress["changed"]} changed')
+
+            # Sleep off any time the chunk finished ahead of the rate limit
+            if (options['rate'] > 0):
+                time.sleep(max(0, started + done / options['rate']
+                                  - time.monotonic()))
+
+    def waitForQueue(self, max_depth: int) -> None:
+        while (not self.paused and
+                autotagger.stats().get('queue_depth', 0) > max_depth):
+            time.sleep(BACKOFF_SECONDS)
+
+    def saveCheckpoint(self, progress: dict) -> None:
+        # Replace the file in one step so a crash never leaves half of it
+        self.checkpointPath.parent.mkdir(parents=True, exist_ok=True)
+        descriptor, temporary_path = tempfile.mkstemp(
+            dir=self.checkpointPath.parent)
+        with os.fdopen(descriptor, 'w') as file:
+            json.dump(progress, file)
+        os.replace(temporary_path, self.checkpointPath)
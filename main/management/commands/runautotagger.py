@@ -0,0 +1,130 @@
+import base64, io, json, os
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingMixIn, UnixStreamServer
+
+from django.core.management.base import BaseCommand
+
+import PIL.Image
+
+from main import autotagger
+
+
+class ThreadingUnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+
+class TaggingHandler(BaseHTTPRequestHandler):
+    """Answer tagging requests from the web workers"""
+
+    scheduler = None
+    transform = None
+    embedder = None
+    embedding_scheduler = None
+
+    def do_GET(self):
+        if (self.path == '/stats'):
+            stats = self.scheduler.stats()
+            if (self.embedding_scheduler != None):
+                stats['embeddings'] = self.embedding_scheduler.stats()
+            self.reply(200, stats)
+        else:
+            self.reply(404, {'error': 'Not found'})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        data = self.rfile.read(length)
+
+        match self.path:
+            case '/tag':
+                image = self.openImage(data, self.transform)
+                if (image != None):
+                    tags = self.scheduler.submit(image).result()
+                    self.reply(200, {'tags': tags})
+            case '/embed/image' | '/embed/text' if self.embedder == None:
+                self.reply(503, {'error': 'Embeddings are disabled'})
+            case '/embed/image':
+                image = self.openImage(data, self.embedder.transform)
+                if (image != None):
+                    embedding = self.embedding_scheduler.submit(image).result()
+                    self.replyEmbedding(embedding)
+            case '/embed/text':
+                try:
+                    text = json.loads(data)['text']
+                except (ValueError, KeyError, TypeError):
+                    self.reply(400, {'error': 'Invalid query'})
+                    return
+                self.replyEmbedding(self.embedder.embedText(text))
+            case _:
+                self.reply(404, {'error': 'Not found'})
+
+    def openImage(self, data: bytes, transform):
+        """Decode and transform an uploaded image, replying 400 if invalid"""
+
+        try:
+            return transform(PIL.Image.open(io.BytesIO(data)))
+        except Exception:
+            self.reply(400, {'error': 'Invalid image'})
+            return None
+
+    def replyEmbedding(self, embedding) -> None:
+        # Send the float16 vector as base64 rather than a long list of floats
+        self.reply(200, {
+            'embedding': base64.b64encode(embedding.tobytes()).decode()})
+
+    def reply(self, status: int, data: dict) -> None:
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self) -> str:
+        # Unix socket clients have no address to report
+        return self.client_address[0] if self.client_address else 'local'
+
+
+class Command(BaseCommand):
+    help = 'Serve image tag suggestions to the web workers from one process'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--address', default=autotagger.AUTOTAG_SERVER,
+            help='Unix socket ("unix:/path") or "host:port" to listen on')
+        parser.add_argument('--backend', default=None,
+            help='Inference backend (default: inference.BACKEND)')
+        parser.add_argument('--no-embeddings', action='store_true',
+            help='Do not load the CLIP model used for semantic search')
+
+    def handle(self, *args, **options):
+        # Only this process pays for importing torch and loading the weights
+        from main import inference
+
+        backend = options['backend'] or inference.BACKEND
+        self.stdout.write(f'Loading the {backend} tagging model...')
+        TaggingHandler.transform = staticmethod(inference.transform)
+        TaggingHandler.scheduler = inference.BatchScheduler(
+            inference.loadTagger(backend))
+
+        if (not options['no_embeddings']):
+            self.stdout.write(f'Loading the {inference.CLIP_MODEL} '
+                'embedding model...')
+            TaggingHandler.embedder = inference.ClipEmbedder()
+            TaggingHandler.embedding_scheduler = inference.EmbeddingScheduler(
+                TaggingHandler.embedder)
+
+        address = autotagger.parseAddress(options['address'])
+        if (isinstance(address, str)):
+            if (os.path.exists(address)):
+                os.unlink(address)
+            server = ThreadingUnixHTTPServer(address, TaggingHandler)
+        else:
+            server = ThreadingHTTPServer(address, TaggingHandler)
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Serving tag suggestions on {options["address"]}'))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from main import ingest
+
+
+class Command(BaseCommand):
+    help = 'Remove stored originals that no image uses any more'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--min-age', type=float,
+            default=ingest.ORPHAN_MIN_AGE / 3600,
+            help='Hours an unused original is kept (default: %(default)s)')
+
+    def handle(self, *args, **options):
+        removed = ingest.sweepOriginals(options['min_age'] * 3600)
+        self.stdout.write(self.style.SUCCESS(
+            f'Removed {removed} unused originals'))
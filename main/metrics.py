@@ -0,0 +1,261 @@
+import bisect, contextvars, logging, random, threading, time
+from contextlib import contextmanager
+
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+from django.template.backends.django import DjangoTemplates
+from django.utils.decorators import sync_and_async_middleware
+
+
+# Send a Server-Timing header with every response so the browser's network
+# panel shows where the time went. It tells clients how many queries a page
+# runs, so by default it is only sent when DEBUG is on.
+SERVER_TIMING = None
+
+# Addresses that may read /metrics/ without logging in as staff
+METRICS_ALLOWED_IPS = ['127.0.0.1', '::1']
+
+# Requests slower than this are written to the slow request log
+SLOW_REQUEST_MS = 500
+
+# Fraction of requests that keep their SQL so a slow one can be logged with
+# its statements, and the most statements kept for a request
+SQL_SAMPLE_RATE = 0.1
+SQL_SAMPLE_LIMIT = 100
+
+# Other methods share one label, so a client making up methods can't grow
+# the histograms without bound
+METHODS = {'GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS'}
+
+DURATION_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+QUERY_BUCKETS = [0, 1, 2, 3, 5, 10, 20, 50, 100]
+
+logger = logging.getLogger(__name__)
+
+
+class Timings:
+    """Time spent in each step of one request"""
+
+    def __init__(self, sample_sql: bool):
+        self.start = time.perf_counter()
+        self.steps = {}
+        self.statements = [] if sample_sql else None
+
+    def add(self, step: str, seconds: float) -> None:
+        total, count = self.steps.get(step, (0.0, 0))
+        self.steps[step] = (total + seconds, count + 1)
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.start
+
+
+# The request being handled. Pools that run work for a request copy the
+# context, so their steps are added to the same Timings.
+current = contextvars.ContextVar('timings', default=None)
+
+
+@contextmanager
+def timed(step: str):
+    """Add the time spent in a block to a step of the current request"""
+
+    timings = current.get()
+    if (timings == None):
+        yield
+        return
+
+    before = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.add(step, time.perf_counter() - before)
+
+
+def sqlWrapper(execute, sql, params, many, context):
+    """Time every statement a database connection runs for a request"""
+
+    timings = current.get()
+    if (timings == None):
+        return execute(sql, params, many, context)
+
+    before = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        seconds = time.perf_counter() - before
+        timings.add('db', seconds)
+        if (timings.statements != None and
+                len(timings.statements) < SQL_SAMPLE_LIMIT):
+            timings.statements.append((seconds, sql))
+
+
+def instrumentConnection(sender, connection, **kwargs) -> None:
+    """Install the SQL timer on a new database connection"""
+
+    # The wrapper object outlives reconnections, so only add it once
+    if (sqlWrapper not in connection.execute_wrappers):
+        connection.execute_wrappers.append(sqlWrapper)
+
+
+class Histogram:
+    """A Prometheus histogram with labels, shared by every thread"""
+
+    def __init__(self, name: str, help: str, labels: list[str],
+                 buckets: list[float]):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value: float, *labels: str) -> None:
+        with self.lock:
+            counts, total = self.series.get(labels,
+                ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.series[labels] = (counts, total + value)
+
+    def render(self) -> list[str]:
+        lines = [f'# HELP {self.name} {self.help}',
+                 f'# TYPE {self.name} histogram']
+        with self.lock:
+            series = {labels: (list(counts), total)
+                      for labels, (counts, total) in self.series.items()}
+
+        for labels, (counts, total) in sorted(series.items()):
+            names = ''.join(f'{name}="{escape(value)}",'
+                            for name, value in zip(self.labels, labels))
+            cumulative = 0
+            for bound, count in zip(self.buckets + ['+Inf'], counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{names}le="{bound}"}} '
+                             f'{cumulative}')
+            names = names.rstrip(',')
+            lines.append(f'{self.name}_sum{{{names}}} {total}')
+            lines.append(f'{self.name}_count{{{names}}} {cumulative}')
+        return lines
+
+
+def escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+requestDuration = Histogram('imagesite_request_duration_seconds',
+    'Time to produce a response, not counting a streamed body',
+    ['view', 'method'], DURATION_BUCKETS)
+requestQueries = Histogram('imagesite_request_queries',
+    'Database queries run by a request', ['view'], QUERY_BUCKETS)
+stepDuration = Histogram('imagesite_step_duration_seconds',
+    'Time a request spent in each step', ['view', 'step'], DURATION_BUCKETS)
+
+# Each worker process keeps its own histograms, and a scrape only reads the
+# process that answered it. Scrape every worker separately when running more
+# than one.
+histograms = [requestDuration, requestQueries, stepDuration]
+
+
+def exposition() -> str:
+    """Render every histogram in the Prometheus text format"""
+
+    return '\n'.join(line for histogram in histograms
+                     for line in histogram.render()) + '\n'
+
+
+def canRead(request) -> bool:
+    """Check whether a request may read the metrics"""
+
+    return (request.META.get('REMOTE_ADDR') in METRICS_ALLOWED_IPS or
+        request.user.is_staff)
+
+
+def methodName(request) -> str:
+    return request.method if request.method in METHODS else 'other'
+
+
+def viewName(request) -> str:
+    match = request.resolver_match
+    if (match == None):
+        return 'unmatched'
+    return match.url_name or match.view_name
+
+
+def begin() -> tuple[Timings, contextvars.Token]:
+    timings = Timings(random.random() < SQL_SAMPLE_RATE)
+    return timings, current.set(timings)
+
+
+def finish(request, response, timings: Timings, token: contextvars.Token):
+    """Record a request's timings and report them to the client"""
+
+    current.reset(token)
+    seconds = timings.elapsed()
+    view = viewName(request)
+    queries = timings.steps.get('db', (0.0, 0))[1]
+
+    requestDuration.observe(seconds, view, methodName(request))
+    requestQueries.observe(queries, view)
+    for step, (total, _) in timings.steps.items():
+        stepDuration.observe(total, view, step)
+
+    if (SERVER_TIMING or (SERVER_TIMING == None and settings.DEBUG)):
+        entries = [f'{step};dur={total * 1000:.1f};desc="{count}x"'
+                   for step, (total, count) in timings.steps.items()]
+        entries.append(f'total;dur={seconds * 1000:.1f}')
+        response.headers['Server-Timing'] = ', '.join(entries)
+
+    if (seconds * 1000 >= SLOW_REQUEST_MS):
+        logSlowRequest(request, response, timings, seconds)
+
+    return response
+
+
+def logSlowRequest(request, response, timings: Timings,
+                   seconds: float) -> None:
+    steps = ', '.join(f'{step} {total * 1000:.1f}ms/{count}'
+                      for step, (total, count) in timings.steps.items())
+    lines = [f'Slow request: {request.method} {request.get_full_path()} '
+             f'{response.status_code} in {seconds * 1000:.1f}ms ({steps})']
+    if (timings.statements != None):
+        lines += [f'  {statement_seconds * 1000:.1f}ms {sql}'
+                  for statement_seconds, sql in timings.statements]
+    logger.warning('\n'.join(lines))
+
+
+@sync_and_async_middleware
+def timingMiddleware(get_response):
+    """Time each request and the steps it spent its time in"""
+
+    if (iscoroutinefunction(get_response)):
+        async def middleware(request):
+            timings, token = begin()
+            response = await get_response(request)
+            return finish(request, response, timings, token)
+    else:
+        def middleware(request):
+            timings, token = begin()
+            response = get_response(request)
+            return finish(request, response, timings, token)
+
+    return middleware
+
+
+class TimedTemplate:
+    """A template that adds its rendering time to the current request"""
+
+    def __init__(self, template):
+        self.template = template
+        self.origin = template.origin
+
+    def render(self, context=None, request=None):
+        with timed('template'):
+            return self.template.render(context, request)
+
+
+class TimedTemplates(DjangoTemplates):
+    """The Django template engine, timing every template it renders"""
+
+    def from_string(self, template_code):
+        return TimedTemplate(super().from_string(template_code))
+
+    def get_template(self, template_name):
+        return TimedTemplate(super().get_template(template_name))
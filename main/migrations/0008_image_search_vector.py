@@ -0,0 +1,57 @@
+# Generated by Django 5.1.3 on 2026-10-18 16:12
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+import django.db.models.functions.text
+from django.contrib.postgres.aggregates import StringAgg
+from django.contrib.postgres.operations import TrigramExtension
+from django.contrib.postgres.search import SearchVector
+from django.db import migrations
+from django.db.models import OuterRef, Subquery, TextField, Value
+from django.db.models.functions import Coalesce
+
+
+def populate_search_vectors(apps, schema_editor):
+    Image = apps.get_model('main', 'Image')
+    Tag = apps.get_model('main', 'Tag')
+
+    tag_names = Tag.objects.filter(image=OuterRef('pk')).order_by() \
+        .values('image').annotate(names=StringAgg('name', ' ')) \
+        .values('names')
+
+    Image.objects.update(search_vector=(
+        SearchVector('title', weight='A', config='simple') +
+        SearchVector(Coalesce(Subquery(tag_names), Value(''),
+            output_field=TextField()),
+            weight='B', config='simple') +
+        SearchVector('description', weight='C', config='simple')
+    ))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0007_alter_tag_options_alter_tag_name'),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        migrations.AddField(
+            model_name='image',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='image',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='image_search_vector'),
+        ),
+        migrations.AddIndex(
+            model_name='image',
+            index=django.contrib.postgres.indexes.GinIndex(django.contrib.postgres.indexes.OpClass(django.db.models.functions.text.Upper('title'), name='gin_trgm_ops'), name='image_title_trgm'),
+        ),
+        migrations.AddIndex(
+            model_name='image',
+            index=django.contrib.postgres.indexes.GinIndex(django.contrib.postgres.indexes.OpClass(django.db.models.functions.text.Upper('description'), name='gin_trgm_ops'), name='image_description_trgm'),
+        ),
+        migrations.RunPython(populate_search_vectors, migrations.RunPython.noop),
+    ]
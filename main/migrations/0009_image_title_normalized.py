@@ -0,0 +1,42 @@
+# Generated by Django 5.1.3 on 2026-10-18 17:02
+
+from django.db import migrations, models
+
+
+def populate_title_normalized(apps, schema_editor):
+    Image = apps.get_model('main', 'Image')
+
+    images = list(Image.objects.only('id', 'title'))
+    for image in images:
+        title = image.title.lower()
+        for article in ('a ', 'an ', 'the '):
+            if title.startswith(article):
+                title = title[len(article):]
+                break
+        image.title_normalized = title
+    Image.objects.bulk_update(images, ['title_normalized'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0008_image_search_vector'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='title_normalized',
+            field=models.CharField(default='', editable=False, max_length=255),
+            preserve_default=False,
+        ),
+        migrations.RunPython(populate_title_normalized, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='image',
+            index=models.Index(fields=['date', 'id'], name='image_date_id'),
+        ),
+        migrations.AddIndex(
+            model_name='image',
+            index=models.Index(fields=['title_normalized', 'id'], name='image_title_normalized_id'),
+        ),
+    ]
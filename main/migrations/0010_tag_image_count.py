@@ -0,0 +1,34 @@
+# Generated by Django 5.1.3 on 2026-10-18 18:40
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+
+def populate_image_count(apps, schema_editor):
+    Tag = apps.get_model('main', 'Tag')
+    ImageTag = apps.get_model('main', 'Image').tags.through
+
+    counts = ImageTag.objects.filter(tag_id=OuterRef('pk')).order_by() \
+        .values('tag_id').annotate(count=Count('*')).values('count')
+    Tag.objects.update(image_count=Coalesce(Subquery(counts), Value(0)))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0009_image_title_normalized'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tag',
+            name='image_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(populate_image_count, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='tag',
+            index=models.Index(fields=['image_count'], name='tag_image_count'),
+        ),
+    ]
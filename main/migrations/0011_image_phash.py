@@ -0,0 +1,54 @@
+# Generated by Django 5.1.3 on 2026-10-18 16:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0010_tag_image_count'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='phash',
+            field=models.BigIntegerField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='phash_0',
+            field=models.IntegerField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='phash_1',
+            field=models.IntegerField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='phash_2',
+            field=models.IntegerField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='phash_3',
+            field=models.IntegerField(editable=False, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='image',
+            index=models.Index(fields=['phash_0'], name='image_phash_0'),
+        ),
+        migrations.AddIndex(
+            model_name='image',
+            index=models.Index(fields=['phash_1'], name='image_phash_1'),
+        ),
+        migrations.AddIndex(
+            model_name='image',
+            index=models.Index(fields=['phash_2'], name='image_phash_2'),
+        ),
+        migrations.AddIndex(
+            model_name='image',
+            index=models.Index(fields=['phash_3'], name='image_phash_3'),
+        ),
+    ]
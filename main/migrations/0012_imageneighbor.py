@@ -0,0 +1,28 @@
+# Generated by Django 5.1.3 on 2026-10-18 16:28
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0011_image_phash'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImageNeighbor',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('rank', models.PositiveSmallIntegerField()),
+                ('score', models.FloatField()),
+                ('image', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='neighbors', to='main.image')),
+                ('neighbor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='main.image')),
+            ],
+            options={
+                'ordering': ['image', 'rank'],
+                'constraints': [models.UniqueConstraint(fields=('image', 'rank'), name='unique_image_neighbor_rank')],
+            },
+        ),
+    ]
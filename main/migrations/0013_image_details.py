@@ -0,0 +1,43 @@
+# Generated by Django 5.1.3 on 2026-10-18 16:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0012_imageneighbor'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='byte_size',
+            field=models.PositiveBigIntegerField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='dominant_color',
+            field=models.CharField(default='', editable=False, max_length=7),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='height',
+            field=models.PositiveIntegerField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='mime_type',
+            field=models.CharField(default='', editable=False, max_length=64),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='placeholder',
+            field=models.TextField(default='', editable=False),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='width',
+            field=models.PositiveIntegerField(editable=False, null=True),
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 5.1.3 on 2026-10-18 19:05
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0013_image_details'),
+    ]
+
+    operations = [
+        # Describe the table the plain many-to-many field already created
+        # as a model, without touching the database
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.CreateModel(
+                    name='ImageTag',
+                    fields=[
+                        ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                        ('image', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='main.image')),
+                        ('tag', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='main.tag')),
+                    ],
+                    options={
+                        'db_table': 'main_image_tags',
+                        'unique_together': {('image', 'tag')},
+                    },
+                ),
+                migrations.AlterField(
+                    model_name='image',
+                    name='tags',
+                    field=models.ManyToManyField(through='main.ImageTag', to='main.tag'),
+                ),
+            ],
+        ),
+        # Existing tags can't be told apart, so they are kept as the user's
+        migrations.AddField(
+            model_name='imagetag',
+            name='source',
+            field=models.CharField(choices=[('user', 'Entered by a user'), ('auto', 'Suggested by the model')], default='user', max_length=4),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.1.3 on 2026-10-18 16:59
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0014_imagetag_source'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='image',
+            name='image_search_vector',
+        ),
+    ]
@@ -1,4 +1,26 @@
+from django.contrib.postgres.aggregates import StringAgg
+from django.contrib.postgres.indexes import GinIndex, OpClass
+from django.contrib.postgres.search import SearchVector, SearchVectorField
 from django.db import models
+from django.db.models import OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce, Upper
+
+from . import caching
+
+
+# Text search configuration for the search vector. 'simple' does no stemming,
+# which keeps matching close to the substring search it ranks.
+SEARCH_CONFIG = 'simple'
+
+
+def normalizeTitle(title: str) -> str:
+    """Lowercase a title and drop a leading article for sorting"""
+
+    lowered = title.lower()
+    for article in ('a ', 'an ', 'the '):
+        if (lowered.startswith(article)):
+            return lowered[len(article):]
+    return lowered
 
 
 class Tag(models.Model):
@@ -6,9 +28,15 @@ class Tag(models.Model):
 
     name = models.CharField(max_length=25)
 
+    # Number of images using this tag, kept up to date by setTags so listing
+    # and ranking tags never needs to aggregate the through table
+    image_count = models.PositiveIntegerField(default=0, editable=False)
+
     class Meta:
         constraints = [
             models.UniqueConstraint(fields=['name'], name="unique_name")]
+        indexes = [
+            models.Index(fields=['image_count'], name='tag_image_count')]
         ordering = ['name']
 
     def __str__(self):
@@ -21,8 +49,115 @@ class Image(models.Model):
     title = models.CharField(max_length=255)
     description = models.CharField(max_length=1023)
     date = models.DateTimeField(auto_now_add=True)
-    tags = models.ManyToManyField(Tag)
+    tags = models.ManyToManyField(Tag, through='ImageTag')
     file = models.ImageField(upload_to='images')
+    # Only used to rank matches, which the trigram indexes find, so it is
+    # not indexed itself
+    search_vector = SearchVectorField(null=True, editable=False)
+    title_normalized = models.CharField(max_length=255, editable=False)
+
+    # Perceptual hash of the file and its 16 bit chunks, each indexed so
+    # near-duplicates can be looked up (see duplicates.py)
+    phash = models.BigIntegerField(null=True, editable=False)
+    phash_0 = models.IntegerField(null=True, editable=False)
+    phash_1 = models.IntegerField(null=True, editable=False)
+    phash_2 = models.IntegerField(null=True, editable=False)
+    phash_3 = models.IntegerField(null=True, editable=False)
+
+    # Facts about the file recorded when it is stored, so pages can lay out
+    # and describe an image without opening it (see ingest.describe)
+    width = models.PositiveIntegerField(null=True, editable=False)
+    height = models.PositiveIntegerField(null=True, editable=False)
+    mime_type = models.CharField(max_length=64, default='', editable=False)
+    byte_size = models.PositiveBigIntegerField(null=True, editable=False)
+    dominant_color = models.CharField(max_length=7, default='',
+        editable=False)
+    placeholder = models.TextField(default='', editable=False)
+
+    class Meta:
+        indexes = [
+            # Keyset pagination seeks on (sort key, id) for each sort order
+            models.Index(fields=['date', 'id'], name='image_date_id'),
+            models.Index(fields=['title_normalized', 'id'],
+                name='image_title_normalized_id'),
+            # Serve title__icontains and description__icontains, which
+            # compare UPPER(column) with LIKE '%...%'
+            GinIndex(OpClass(Upper('title'), name='gin_trgm_ops'),
+                name='image_title_trgm'),
+            GinIndex(OpClass(Upper('description'), name='gin_trgm_ops'),
+                name='image_description_trgm'),
+            models.Index(fields=['phash_0'], name='image_phash_0'),
+            models.Index(fields=['phash_1'], name='image_phash_1'),
+            models.Index(fields=['phash_2'], name='image_phash_2'),
+            models.Index(fields=['phash_3'], name='image_phash_3'),
+        ]
+
+    @staticmethod
+    def searchVector() -> SearchVector:
+        """Build the weighted search document: title > tags > description"""
+
+        tagNames = Tag.objects.filter(image=OuterRef('pk')).order_by() \
+            .values('image').annotate(names=StringAgg('name', ' ')) \
+            .values('names')
+
+        return (
+            SearchVector('title', weight='A', config=SEARCH_CONFIG) +
+            SearchVector(Coalesce(Subquery(tagNames), Value(''),
+                output_field=models.TextField()),
+                weight='B', config=SEARCH_CONFIG) +
+            SearchVector('description', weight='C', config=SEARCH_CONFIG)
+        )
+
+    @staticmethod
+    def updateSearchVectors(ids: list[int] | None = None) -> None:
+        """Recompute the stored search documents of some images, or all"""
+
+        images = Image.objects.all() if ids == None else \
+            Image.objects.filter(id__in=ids)
+        images.update(search_vector=Image.searchVector())
+
+    def updateSearchVector(self) -> None:
+        """Recompute the stored search document from the current row"""
+
+        Image.updateSearchVectors([self.pk])
+
+    def save(self, *args, **kwargs):
+        self.title_normalized = normalizeTitle(self.title)
+        super().save(*args, **kwargs)
+        self.updateSearchVector()
+        caching.imageChanged(self.id)
+
+    def delete(self, *args, **kwargs):
+        caching.imageChanged(self.id)
+        return super().delete(*args, **kwargs)
+
+    def renditionSizes(self) -> dict[str, tuple[int, int]]:
+        """Get the size of each rendition, if the original's size is known"""
+
+        # Imported here because renditions needs the models
+        from .renditions import RENDITION_SIZES, renditionSize
+
+        if (self.width == None or self.height == None):
+            return {}
+        return {format: renditionSize(self.width, self.height, format)
+                for format in RENDITION_SIZES}
+
+    def srcsetWidths(self) -> list[tuple[int, int]]:
+        """Get the widths to request for a srcset and the width each gets"""
+
+        from .renditions import RENDITION_WIDTHS
+
+        if (self.width == None):
+            return []
+
+        # Stop at the first width covering the original, as larger ones
+        # would only be copies of it
+        widths = []
+        for width in RENDITION_WIDTHS:
+            widths.append((width, min(width, self.width)))
+            if (width >= self.width):
+                break
+        return widths
 
     def slug(self):
         return self.title.strip().lower().replace(' ', '-')
@@ -32,3 +167,46 @@ class Image(models.Model):
 
     def __str__(self):
         return self.title
+
+
+class ImageTag(models.Model):
+    """Link an image to a tag, recording who added it"""
+
+    USER = 'user'
+    AUTO = 'auto'
+    SOURCES = [(USER, 'Entered by a user'), (AUTO, 'Suggested by the model')]
+
+    image = models.ForeignKey(Image, on_delete=models.CASCADE)
+    tag = models.ForeignKey(Tag, on_delete=models.CASCADE)
+
+    # Machine tags can be replaced by a later model (see retag_images), but
+    # a tag a user typed in is never touched by it
+    source = models.CharField(max_length=4, choices=SOURCES, default=USER)
+
+    class Meta:
+        # Keep the table Django created for the plain many-to-many field
+        db_table = 'main_image_tags'
+        unique_together = [('image', 'tag')]
+
+    def __str__(self):
+        return f'{self.image_id} -> {self.tag_id} ({self.source})'
+
+
+class ImageNeighbor(models.Model):
+    """Store one of the precomputed most similar images to an image"""
+
+    image = models.ForeignKey(Image, on_delete=models.CASCADE,
+        related_name='neighbors')
+    neighbor = models.ForeignKey(Image, on_delete=models.CASCADE,
+        related_name='+')
+    rank = models.PositiveSmallIntegerField()
+    score = models.FloatField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['image', 'rank'],
+                name='unique_image_neighbor_rank')]
+        ordering = ['image', 'rank']
+
+    def __str__(self):
+        return f'{self.image_id} -> {self.neighbor_id}'
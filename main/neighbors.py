@@ -0,0 +1,102 @@
+from django.db import transaction
+from django.db.models import Count
+
+import numpy as np
+
+from . import caching, embeddings
+from .models import Image, ImageNeighbor
+
+
+# How many similar images are kept for each image
+NEIGHBOR_COUNT = 8
+
+# Images sharing the most tags that are scored for the tag similarity
+# fallback; only these can be neighbors of an image without an embedding
+JACCARD_CANDIDATES = 200
+
+
+def embeddingNeighbors(image_id: int, vector: np.ndarray,
+                       count: int = NEIGHBOR_COUNT) -> list[tuple[int, float]]:
+    """Find the images whose embeddings are closest to an image's"""
+
+    # Ask for extra rows to make up for the image itself and deleted images
+    ids, scores = embeddings.getStore().nearest(vector[None], count * 2 + 1)
+    existing = set(Image.objects.filter(id__in=ids[0].tolist())
+        .values_list('id', flat=True))
+    return [(id, float(score))
+            for id, score in zip(ids[0].tolist(), scores[0].tolist())
+            if id != image_id and id in existing][:count]
+
+
+def jaccardNeighbors(image_id: int,
+                     count: int = NEIGHBOR_COUNT) -> list[tuple[int, float]]:
+    """Find the images whose tag sets overlap most with an image's"""
+
+    ImageTag = Image.tags.through
+    tagIds = list(ImageTag.objects.filter(image_id=image_id)
+        .values_list('tag_id', flat=True))
+    if (not tagIds):
+        return []
+
+    shared = dict(ImageTag.objects.filter(tag_id__in=tagIds)
+        .exclude(image_id=image_id).values('image_id')
+        .annotate(shared=Count('*')).order_by('-shared', 'image_id')
+        .values_list('image_id', 'shared')[:JACCARD_CANDIDATES])
+    sizes = dict(ImageTag.objects.filter(image_id__in=shared)
+        .values('image_id').annotate(size=Count('*')).order_by()
+        .values_list('image_id', 'size'))
+
+    scores = [(id, shared[id] / (len(tagIds) + sizes[id] - shared[id]))
+              for id in shared]
+    scores.sort(key=lambda item: (-item[1], item[0]))
+    return scores[:count]
+
+
+def findNeighbors(image_id: int) -> list[tuple[int, float]]:
+    """Find an image's neighbors by embedding, or by tags without one"""
+
+    vector = embeddings.getStore().vector(image_id)
+    if (vector is not None):
+        return embeddingNeighbors(image_id, vector, NEIGHBOR_COUNT)
+    return jaccardNeighbors(image_id, NEIGHBOR_COUNT)
+
+
+@transaction.atomic
+def saveNeighbors(image_id: int, neighbors: list[tuple[int, float]]) -> None:
+    """Replace the stored neighbors of an image"""
+
+    ImageNeighbor.objects.filter(image_id=image_id).delete()
+    ImageNeighbor.objects.bulk_create([
+        ImageNeighbor(image_id=image_id, neighbor_id=neighbor_id,
+            rank=rank, score=score)
+        for rank, (neighbor_id, score) in enumerate(neighbors)
+    ])
+    caching.neighborsChanged(image_id)
+
+
+def referencingImages(image_id: int) -> list[int]:
+    """Get the images that list an image among their neighbors"""
+
+    return list(ImageNeighbor.objects.filter(neighbor_id=image_id)
+        .values_list('image_id', flat=True))
+
+
+def refreshNeighbors(image_id: int, propagate: bool = True) -> None:
+    """Update the neighbors of an image and of the images near it"""
+
+    if (not Image.objects.filter(id=image_id).exists()):
+        return
+    if (not propagate):
+        saveNeighbors(image_id, findNeighbors(image_id))
+        return
+
+    # Similarity is symmetric, so the images close to this one are the ones
+    # whose lists it may now enter, and those that listed it may need to
+    # drop it. Refreshing just those keeps an update to O(k) searches.
+    before = referencingImages(image_id)
+    neighbors = findNeighbors(image_id)
+    saveNeighbors(image_id, neighbors)
+
+    affected = set(before) | {id for id, _ in neighbors}
+    for id in sorted(affected):
+        saveNeighbors(id, findNeighbors(id))
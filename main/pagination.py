@@ -0,0 +1,212 @@
+import base64, datetime, json
+
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import F, Field, Func, Q, QuerySet, Value
+from django.db.models.lookups import GreaterThan, LessThan
+from django.utils.functional import cached_property
+
+
+# Count exactly up to this many results, then fall back to the planner's
+# estimate so broad queries never scan every match just to be counted
+EXACT_COUNT_LIMIT = 1000
+
+
+def countResults(queryset: QuerySet) -> tuple[int, bool]:
+    """Count a result set, returning the count and whether it is exact"""
+
+    queryset = queryset.order_by()
+    count = queryset[:EXACT_COUNT_LIMIT + 1].count()
+    if (count <= EXACT_COUNT_LIMIT):
+        return count, True
+
+    plan = json.loads(queryset.explain(format='json'))
+    estimate = int(plan[0]['Plan']['Plan Rows'])
+    return max(estimate, count), False
+
+
+def encodeValue(value):
+    # Keep full precision; DjangoJSONEncoder would drop the microseconds
+    # that make seeking on a timestamp exact
+    if (isinstance(value, (datetime.date, datetime.datetime))):
+        return value.isoformat()
+    raise TypeError(f'Cannot encode {type(value).__name__} in a cursor')
+
+
+def encodeCursor(fields: list[str], values: list, backwards: bool) -> str:
+    # The fields are kept so a cursor from another ordering is refused
+    # rather than compared with the wrong columns
+    data = json.dumps([fields, values, backwards], default=encodeValue)
+    return base64.urlsafe_b64encode(data.encode()).decode()
+
+
+def decodeCursor(cursor: str) -> tuple[list[str], list, bool]:
+    fields, values, backwards = json.loads(
+        base64.urlsafe_b64decode(cursor.encode()))
+    return fields, values, backwards
+
+
+class Row(Func):
+    """A row value such as (a, b), compared column by column in SQL"""
+
+    template = '(%(expressions)s)'
+    output_field = Field()
+
+
+class KeysetPaginator:
+    """Paginate by seeking past the last row seen instead of using OFFSET"""
+
+    def __init__(self, queryset: QuerySet, per_page: int):
+        # Resolve the ordering, including any reverse(), into explicit
+        # (field, descending) pairs with the primary key as a tie breaker
+        ordering = []
+        for field in queryset.query.order_by:
+            descending = field.startswith('-')
+            if (not queryset.query.standard_ordering):
+                descending = not descending
+            ordering.append((field.lstrip('-'), descending))
+        if ('id' not in [field for field, _ in ordering]):
+            ordering.append(('id', ordering[-1][1] if ordering else False))
+
+        # Directions are now explicit, so undo any reverse() before reordering
+        queryset = queryset.all()
+        queryset.query.standard_ordering = True
+
+        self.queryset = queryset
+        self.per_page = per_page
+        self.ordering = ordering
+
+    @cached_property
+    def counted(self) -> tuple[int, bool]:
+        return countResults(self.queryset)
+
+    @property
+    def count(self) -> int:
+        return self.counted[0]
+
+    @property
+    def count_is_exact(self) -> bool:
+        return self.counted[1]
+
+    def orderBy(self, backwards: bool) -> QuerySet:
+        fields = []
+        for field, descending in self.ordering:
+            fields.append(('-' if descending != backwards else '') + field)
+        return self.queryset.order_by(*fields)
+
+    def seek(self, queryset: QuerySet, values: list,
+             backwards: bool) -> QuerySet:
+        """Keep the rows strictly after a cursor in the walking direction"""
+
+        columns = [(field, descending != backwards)
+                   for field, descending in self.ordering]
+
+        # With every column in one direction, (a, b) > (x, y) is a single
+        # comparison the database can turn into an index range
+        if (len({descending for _, descending in columns}) == 1):
+            lookup = LessThan if columns[0][1] else GreaterThan
+            return queryset.filter(lookup(
+                Row(*[F(field) for field, _ in columns]),
+                Row(*[Value(value) for value in values])))
+
+        # Otherwise spell it out as a > x OR (a = x AND b > y), with each
+        # comparison flipped for descending columns. The leading column's
+        # bound is implied, but stated on its own it can still use an index.
+        condition = Q()
+        equal = Q()
+        for (field, descending), value in zip(columns, values):
+            lookup = 'lt' if descending else 'gt'
+            condition |= equal & Q(**{f'{field}__{lookup}': value})
+            equal &= Q(**{field: value})
+        field, descending = columns[0]
+        bound = Q(**{f'{field}__{"lte" if descending else "gte"}': values[0]})
+        return queryset.filter(bound & condition)
+
+    def parseValues(self, values: list) -> list:
+        """Convert cursor values back into the types of their fields"""
+
+        model = self.queryset.model
+        parsed = []
+        for (field, _), value in zip(self.ordering, values):
+            try:
+                parsed.append(model._meta.get_field(field).to_python(value))
+            except FieldDoesNotExist:
+                parsed.append(value)
+        return parsed
+
+    def page(self, cursor: str | None) -> 'KeysetPage':
+        """Get the page after (or before) a cursor, or the first page"""
+
+        values, backwards = None, False
+        if (cursor):
+            try:
+                fields, values, backwards = decodeCursor(cursor)
+                if (fields != self.fields() or
+                        len(values) != len(self.ordering)):
+                    raise ValueError
+                values = self.parseValues(values)
+            except Exception:
+                values, backwards = None, False
+
+        queryset = self.orderBy(backwards)
+        if (values != None):
+            queryset = self.seek(queryset, values, backwards)
+
+        # Fetch one extra row to learn whether there is another page
+        rows = list(queryset[:self.per_page + 1])
+        has_more = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+        if (backwards):
+            rows.reverse()
+
+        if (backwards):
+            has_next, has_previous = values != None, has_more
+        else:
+            has_next, has_previous = has_more, values != None
+
+        return KeysetPage(self, rows, has_next, has_previous)
+
+    def fields(self) -> list[str]:
+        return [('-' if descending else '') + field
+                for field, descending in self.ordering]
+
+    def cursorFor(self, row, backwards: bool) -> str:
+        values = [getattr(row, field) for field, _ in self.ordering]
+        return encodeCursor(self.fields(), values, backwards)
+
+
+class KeysetPage:
+    """One page of results with cursors to its neighbours"""
+
+    def __init__(self, paginator: KeysetPaginator, object_list: list,
+                 has_next: bool, has_previous: bool):
+        self.paginator = paginator
+        self.object_list = object_list
+        self._has_next = has_next
+        self._has_previous = has_previous
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self) -> bool:
+        return self._has_next
+
+    def has_previous(self) -> bool:
+        return self._has_previous
+
+    def has_other_pages(self) -> bool:
+        return self._has_next or self._has_previous
+
+    @property
+    def next_cursor(self) -> str | None:
+        if (not self._has_next or not self.object_list):
+            return None
+        return self.paginator.cursorFor(self.object_list[-1], False)
+
+    @property
+    def previous_cursor(self) -> str | None:
+        if (not self._has_previous or not self.object_list):
+            return None
+        return self.paginator.cursorFor(self.object_list[0], True)
@@ -0,0 +1,219 @@
+import functools, hashlib, os, shutil, tempfile
+from pathlib import Path
+
+from django.core.files.storage import default_storage
+
+import PIL.features, PIL.Image
+
+from . import metrics
+from .models import Image
+
+
+RENDITIONS_DIRECTORY = 'renditions'
+
+# Map each resize format to the bounding box of its longest edge
+RENDITION_SIZES = {
+    'thumbnail': 128,
+    'search': 512,
+    'theater': 1080,
+}
+
+# Widths a page can ask for with ?w= to build a srcset. Anything else is
+# refused so clients can't fill the cache with one rendition per pixel.
+RENDITION_WIDTHS = [256, 384, 512, 768, 1080, 1440, 1920]
+
+# Height bound of width renditions, which only limit the width
+UNBOUNDED = 1 << 16
+
+# Encodings sent to clients that list them in Accept, best first. Others
+# get renditions in the format of the original.
+NEGOTIATED_ENCODINGS = ['avif', 'webp']
+
+# Encoder settings by file extension. 'method' (WebP) and 'speed' (AVIF)
+# trade encoding time for smaller files.
+ENCODER_OPTIONS = {
+    'avif': {'quality': 55, 'speed': 6},
+    'webp': {'quality': 80, 'method': 4},
+    'jpeg': {'quality': 80, 'optimize': True},
+    'png': {'optimize': True},
+}
+
+
+def sourceKey(image: Image) -> str:
+    """Identify the original file a rendition was generated from"""
+
+    return hashlib.sha1(image.file.name.encode()).hexdigest()[:12]
+
+
+def widthFormat(width: int) -> str:
+    """Name the rendition format for one of the allowed widths"""
+
+    return f'w{width}'
+
+
+def boundingBox(format: str) -> tuple[int, int]:
+    if (format in RENDITION_SIZES):
+        return RENDITION_SIZES[format], RENDITION_SIZES[format]
+    return int(format[1:]), UNBOUNDED
+
+
+def renditionSize(width: int, height: int, format: str) -> tuple[int, int]:
+    """Get the size of a rendition of an original of some size"""
+
+    # Renditions only ever shrink, like PIL's thumbnail
+    box_width, box_height = boundingBox(format)
+    scale = min(1, box_width / width, box_height / height)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+@functools.cache
+def supportedEncodings() -> list[str]:
+    return [encoding for encoding in NEGOTIATED_ENCODINGS
+            if PIL.features.check(encoding)]
+
+
+def negotiate(accept: str) -> str | None:
+    """Pick the best encoding a client accepts, or None for the original's"""
+
+    accepted = set()
+    for media_range in accept.split(','):
+        media_type, *parameters = [part.strip()
+                                   for part in media_range.split(';')]
+        quality = next((parameter[2:] for parameter in parameters
+                        if parameter.startswith('q=')), '1')
+        try:
+            if (float(quality) > 0):
+                accepted.add(media_type.lower())
+        except ValueError:
+            continue
+
+    # Wildcards don't count: browsers send image/* for formats they can't
+    # decode, so only an explicit type is trusted
+    for encoding in supportedEncodings():
+        if (f'image/{encoding}' in accepted):
+            return encoding
+    return None
+
+
+def preferredEncoding() -> str | None:
+    """Get the encoding most clients negotiate, to generate ahead of time"""
+
+    encodings = supportedEncodings()
+    return encodings[0] if encodings else None
+
+
+def renditionDirectory(image_id: int) -> Path:
+    """Get the directory holding every rendition of an image"""
+
+    return Path(default_storage.path(RENDITIONS_DIRECTORY)) / str(image_id)
+
+
+def findRendition(image: Image, format: str,
+                  encoding: str | None = None) -> Path | None:
+    """Get the path of a cached rendition if it has been generated"""
+
+    directory = renditionDirectory(image.id) / sourceKey(image)
+    if (encoding == None and image.mime_type != ''):
+        encoding = image.mime_type.split('/')[1]
+    if (encoding != None):
+        # The file name is known, so no listing is needed
+        path = directory / f'{format}.{encoding}'
+        return path if path.exists() else None
+
+    # Without the original's format, any rendition not in a negotiated
+    # encoding must be in it
+    return next((path for path in directory.glob(f'{format}.*')
+                 if path.suffix[1:] not in NEGOTIATED_ENCODINGS), None)
+
+
+def saveRendition(im: PIL.Image.Image, directory: Path, format: str,
+                  file_extension: str) -> Path:
+    """Resize an open image in place and store it in the cache"""
+
+    # Opening only reads the header, so decoding is counted with the resize
+    with metrics.timed('resize'):
+        im.thumbnail(boundingBox(format))
+
+    # The modern encoders only take color images with optional alpha
+    encoded = im
+    if (file_extension in NEGOTIATED_ENCODINGS and
+            im.mode not in ('RGB', 'RGBA')):
+        encoded = im.convert('RGBA' if im.has_transparency_data else 'RGB')
+
+    # Write to a temporary file first so readers never see a partial file
+    descriptor, temporary_path = tempfile.mkstemp(dir=directory)
+    try:
+        with os.fdopen(descriptor, 'wb') as output, metrics.timed('encode'):
+            encoded.save(output, file_extension,
+                **ENCODER_OPTIONS.get(file_extension, {}))
+        path = directory / f'{format}.{file_extension}'
+        os.replace(temporary_path, path)
+    except:
+        os.unlink(temporary_path)
+        raise
+
+    return path
+
+
+def generateRenditions(image: Image, formats: list[str] | None = None,
+                       force: bool = False,
+                       encoding: str | None = None) -> list[Path]:
+    """Generate missing renditions of an image from a single decode"""
+
+    # By default, everything the pages will ask for: the fixed sizes and,
+    # when the original's width is known, each width in its srcset
+    if (formats == None):
+        formats = list(RENDITION_SIZES) + [
+            widthFormat(width) for width, _ in image.srcsetWidths()]
+    if (not force):
+        formats = [f for f in formats
+                   if findRendition(image, f, encoding) == None]
+    if (len(formats) == 0):
+        return []
+
+    directory = renditionDirectory(image.id) / sourceKey(image)
+    directory.mkdir(parents=True, exist_ok=True)
+
+    with image.file.open('rb') as file:
+        with metrics.timed('open'):
+            im = PIL.Image.open(file)
+        with im:
+            # Shrink from the largest size down so each step resizes the
+            # last one
+            formats = sorted(formats,
+                key=lambda f: renditionSize(*im.size, f), reverse=True)
+            file_extension = encoding or \
+                im.get_format_mimetype().split('/')[1]
+            return [saveRendition(im, directory, format, file_extension)
+                    for format in formats]
+
+
+def getRendition(image: Image, format: str,
+                 encoding: str | None = None) -> Path:
+    """Get the path of a rendition, generating it on first use"""
+
+    path = findRendition(image, format, encoding)
+    if (path == None):
+        [path] = generateRenditions(image, [format], force=True,
+            encoding=encoding)
+    return path
+
+
+def deleteRenditions(image_id: int) -> None:
+    """Remove every cached rendition of an image"""
+
+    shutil.rmtree(renditionDirectory(image_id), ignore_errors=True)
+
+
+def etag(image: Image, format: str, encoding: str | None = None) -> str:
+    """Build an entity tag that changes whenever the original is replaced"""
+
+    if (encoding != None):
+        return f'"{sourceKey(image)}-{format}-{encoding}"'
+    return f'"{sourceKey(image)}-{format}"'
+
+
+def lastModified(image: Image) -> int:
+    """Get the modification time of the original file as a timestamp"""
+
+    return int(default_storage.get_modified_time(image.file.name).timestamp())
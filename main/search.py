@@ -0,0 +1,86 @@
+from functools import reduce
+from operator import or_
+
+from django.contrib.postgres.search import SearchQuery, SearchRank
+from django.db.models import Exists, F, FloatField, OuterRef, Q, QuerySet
+from django.db.models.functions import Cast
+
+from .models import SEARCH_CONFIG, Image
+
+
+def tokenQuery(token: str, include_tags: str, include_titles: str,
+               include_descriptions: str) -> Q:
+    """Match images containing a token in any of the enabled fields"""
+
+    query = Q()
+    if (include_tags == 'on'):
+        # A correlated subquery instead of a join keeps one row per image,
+        # however many tag tokens there are, so no DISTINCT is needed
+        query |= Q(Exists(Image.tags.through.objects.filter(
+            image_id=OuterRef('pk'), tag__name=token)))
+    if (include_titles == 'on'):
+        query |= Q(title__icontains=token)
+    if (include_descriptions == 'on'):
+        query |= Q(description__icontains=token)
+    return query
+
+
+def rankWeights(include_tags: str, include_titles: str,
+                include_descriptions: str) -> list[float]:
+    """Weight the search document by field, ignoring excluded fields"""
+
+    # ts_rank takes weights in D, C, B, A order: unused, description, tags,
+    # title
+    return [
+        0.0,
+        0.2 if include_descriptions == 'on' else 0.0,
+        0.4 if include_tags == 'on' else 0.0,
+        1.0 if include_titles == 'on' else 0.0,
+    ]
+
+
+def searchImages(query: str, include_tags: str = 'on',
+                 include_titles: str = 'on', include_descriptions: str = 'on',
+                 sort_by: str = 'date', reverse_sort: str = 'on') -> QuerySet:
+    """Build the result set for a search query"""
+
+    tokens = query.split()
+
+    positiveTokens = [t for t in tokens if not t.startswith('-')]
+    negativeTokens = [t[1:] for t in tokens if t.startswith('-')]
+
+    # The search document is only needed inside the database
+    images = Image.objects.defer('search_vector')
+
+    # Add positive filters
+    for token in positiveTokens:
+        images = images.filter(tokenQuery(token, include_tags, include_titles,
+            include_descriptions))
+
+    # Add negative filters
+    for token in negativeTokens:
+        images = images.exclude(tokenQuery(token, include_tags,
+            include_titles, include_descriptions))
+
+    # Add sorting, with the id as a tie breaker so pages are stable
+    if (sort_by == 'title'):
+        images = images.order_by('title_normalized', 'id')
+    elif (sort_by == 'relevance' and len(positiveTokens) > 0):
+        searchQuery = reduce(or_, [SearchQuery(token, config=SEARCH_CONFIG)
+                                   for token in positiveTokens])
+        weights = rankWeights(include_tags, include_titles,
+            include_descriptions)
+        # ts_rank returns a real, which comes back rounded; widen it so a
+        # pagination cursor can compare ranks exactly
+        images = images.annotate(rank=Cast(
+            SearchRank(F('search_vector'), searchQuery, weights=weights),
+            FloatField()))
+        images = images.order_by('rank', 'date', 'id')
+    elif (sort_by in ('date', 'relevance')):
+        images = images.order_by('date', 'id')
+
+    # Reverse sort
+    if (reverse_sort == 'on'):
+        images = images.reverse()
+
+    return images
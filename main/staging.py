@@ -0,0 +1,127 @@
+import hashlib, os, re, secrets, shutil, tempfile, time
+from pathlib import Path
+
+from django.core.cache import cache
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.utils.text import get_valid_filename
+
+
+STAGING_DIRECTORY = 'staging'
+
+# Seconds a staged file and its suggested tags are kept for the form that
+# picked it to be submitted
+STAGING_MAX_AGE = 24 * 60 * 60
+
+CHUNK_SIZE = 64 * 1024
+
+TOKEN_PATTERN = re.compile(r'^[0-9a-f]{64}-[0-9a-f]{16}$')
+
+
+class StagedFile(File):
+    """A staged file that form fields can validate without copying it"""
+
+    def __init__(self, path: Path):
+        super().__init__(open(path, 'rb'), path.name)
+        self.path = path
+
+    def temporary_file_path(self) -> str:
+        return str(self.path)
+
+
+def stagingDirectory() -> Path:
+    return Path(default_storage.path(STAGING_DIRECTORY))
+
+
+def stage(file) -> str:
+    """Store an uploaded file and return a token for it"""
+
+    directory = stagingDirectory()
+    directory.mkdir(parents=True, exist_ok=True)
+
+    # Hash while copying so the upload is only read once
+    digest = hashlib.sha256()
+    descriptor, temporary_path = tempfile.mkstemp(dir=directory)
+    try:
+        with os.fdopen(descriptor, 'wb') as output:
+            for chunk in file.chunks(CHUNK_SIZE):
+                digest.update(chunk)
+                output.write(chunk)
+
+        # The content hash shares suggested tags between copies of a file,
+        # and the random part keeps each copy apart, so one tab submitting
+        # the form never removes the file another tab is still using
+        token = f'{digest.hexdigest()}-{secrets.token_hex(8)}'
+        target = directory / token
+        target.mkdir()
+        name = get_valid_filename(Path(file.name).name) or 'upload'
+        os.replace(temporary_path, target / name)
+    except:
+        if (os.path.exists(temporary_path)):
+            os.unlink(temporary_path)
+        raise
+
+    return token
+
+
+def find(token: str) -> Path | None:
+    """Get the path of a staged file if the token is valid and unexpired"""
+
+    if (not TOKEN_PATTERN.match(token or '')):
+        return None
+    directory = stagingDirectory() / token
+
+    # An expired file may not have been cleared yet, but is already gone as
+    # far as the forms are concerned
+    try:
+        if (directory.stat().st_mtime < time.time() - STAGING_MAX_AGE):
+            return None
+    except FileNotFoundError:
+        return None
+    return next((path for path in directory.glob('*') if path.is_file()),
+        None)
+
+
+def openStaged(token: str) -> StagedFile | None:
+    path = find(token)
+    return StagedFile(path) if path != None else None
+
+
+def discard(token: str) -> None:
+    """Remove a staged file once an image has been saved from it"""
+
+    if (TOKEN_PATTERN.match(token or '')):
+        shutil.rmtree(stagingDirectory() / token, ignore_errors=True)
+
+
+def tagsKey(token: str) -> str:
+    return f'autotag:{token.split("-")[0]}'
+
+
+def cachedTags(token: str) -> list[str] | None:
+    return cache.get(tagsKey(token))
+
+
+def cacheTags(token: str, tags: list[str]) -> None:
+    # The tags are kept for the content hash, so they can never go stale
+    cache.set(tagsKey(token), tags, timeout=STAGING_MAX_AGE)
+
+
+def clearExpired(max_age: float = STAGING_MAX_AGE) -> int:
+    """Remove files staged longer ago than a number of seconds"""
+
+    directory = stagingDirectory()
+    if (not directory.exists()):
+        return 0
+
+    cutoff = time.time() - max_age
+    removed = 0
+    for path in directory.iterdir():
+        if (path.stat().st_mtime < cutoff):
+            if (path.is_dir()):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                # A temporary file left behind by an interrupted upload
+                path.unlink(missing_ok=True)
+            removed += 1
+    return removed
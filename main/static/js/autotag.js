@@ -4,6 +4,7 @@
     // Get the DOM elements
     var fileInputElement = document.querySelector('[name=file]');
     var tagsInputElement = document.querySelector('[name=tags]');
+    var tokenInputElement = document.querySelector('[name=staging_token]');
 
     // Select or create the preview image element
     var previewImage = document.querySelector('.image-preview');
@@ -20,6 +21,7 @@
     // Change the preview image on a file change
     fileInputElement.addEventListener('change', async () => {
         var [file] = fileInputElement.files;
+        tokenInputElement.value = '';
 
         if (!file) {
             previewImage.src = initialSource;
@@ -28,6 +30,10 @@
 
         controller.abort();
         controller = new AbortController();
+
+        // The size in the markup belongs to the image being replaced
+        previewImage.removeAttribute('width');
+        previewImage.removeAttribute('height');
         previewImage.src = URL.createObjectURL(file);
 
         // Set up the loading icon
@@ -58,14 +64,25 @@
         })
         .then(response => response.json())
         .then(json => {
+            // The server kept the file, so the form only needs to send this
+            tokenInputElement.value = json.token;
+
+            if (json.tags.length == 0) return;
             if (tagsInputElement.value != '') {
                 tagsInputElement.value += ' ';
             }
-            tagsInputElement.value += json.join(' ');
+            tagsInputElement.value += json.tags.join(' ');
         })
         .finally(() => {
             clearInterval(loadingInterval);
             loadingIndicator.remove();
         });
     });
+
+    // Don't send the file a second time if the server already has it
+    fileInputElement.form.addEventListener('submit', () => {
+        if (tokenInputElement.value != '') {
+            fileInputElement.disabled = true;
+        }
+    });
 })()
@@ -0,0 +1,140 @@
+import asyncio, os, re
+from pathlib import Path
+from urllib.parse import quote
+
+from django.core.files.storage import default_storage
+from django.core.handlers.asgi import ASGIRequest
+from django.http import (FileResponse, HttpRequest, HttpResponse,
+    StreamingHttpResponse)
+from django.utils.http import parse_etags, parse_http_date_safe
+
+
+# Hand the transfer to the front-end server instead of Python by setting this
+# to 'X-Accel-Redirect' (nginx) or 'X-Sendfile' (Apache, lighttpd)
+SENDFILE_HEADER = None
+
+# Internal nginx location that maps onto MEDIA_ROOT for X-Accel-Redirect
+SENDFILE_PREFIX = '/protected/'
+
+CHUNK_SIZE = 64 * 1024
+
+RANGE_PATTERN = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def parseRange(header: str, size: int) -> tuple[int, int] | None:
+    """Parse a single byte range into inclusive bounds"""
+
+    # Unsupported syntax, including multiple ranges, means the whole file is
+    # sent. Bounds past the end are returned as is so the caller can send 416.
+    match = RANGE_PATTERN.match(header.strip())
+    if (match == None):
+        return None
+
+    start, end = match.groups()
+    if (start == '' and end == ''):
+        return None
+
+    if (start == ''):
+        # A suffix range such as "bytes=-500" asks for the last 500 bytes
+        suffix = int(end)
+        return (max(size - suffix, 0) if suffix > 0 else size), size - 1
+
+    start = int(start)
+    if (end == ''):
+        return start, size - 1
+    if (int(end) < start):
+        return None
+    return start, min(int(end), size - 1)
+
+
+def rangeApplies(request: HttpRequest, etag: str, last_modified: int) -> bool:
+    """Check an If-Range precondition so stale partial downloads restart"""
+
+    if_range = request.headers.get('If-Range')
+    if (if_range == None):
+        return True
+    if (if_range.startswith('"') or if_range.startswith('W/')):
+        return parse_etags(if_range) == [etag]
+    return parse_http_date_safe(if_range) == last_modified
+
+
+def readRange(path: Path, start: int, length: int):
+    """Yield a slice of a file in fixed size chunks"""
+
+    with open(path, 'rb') as file:
+        file.seek(start)
+        while (length > 0):
+            chunk = file.read(min(CHUNK_SIZE, length))
+            if (not chunk):
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+async def readRangeAsync(path: Path, start: int, length: int):
+    """Yield a slice of a file without blocking the event loop"""
+
+    file = await asyncio.to_thread(open, path, 'rb')
+    try:
+        await asyncio.to_thread(file.seek, start)
+        while (length > 0):
+            chunk = await asyncio.to_thread(file.read,
+                min(CHUNK_SIZE, length))
+            if (not chunk):
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        await asyncio.to_thread(file.close)
+
+
+def fileResponse(request: HttpRequest, path: Path, content_type: str,
+                 etag: str, last_modified: int) -> HttpResponse:
+    """Stream a file from disk without loading it into memory"""
+
+    if (SENDFILE_HEADER != None):
+        # The front-end server handles ranges and the transfer itself
+        response = HttpResponse(content_type=content_type)
+        if (SENDFILE_HEADER == 'X-Accel-Redirect'):
+            relative_path = os.path.relpath(path, default_storage.location)
+            response.headers[SENDFILE_HEADER] = quote(
+                SENDFILE_PREFIX + relative_path)
+        else:
+            response.headers[SENDFILE_HEADER] = str(path)
+        return response
+
+    size = os.path.getsize(path)
+    range_header = request.headers.get('Range')
+
+    if (range_header != None and rangeApplies(request, etag, last_modified)):
+        bounds = parseRange(range_header, size)
+    else:
+        bounds = None
+
+    if (bounds != None and bounds[0] >= size):
+        response = HttpResponse(status=416)
+        response.headers['Content-Range'] = f'bytes */{size}'
+        return response
+
+    # Under ASGI a synchronous iterator would be drained in the one thread
+    # shared by every synchronous view, so read in the background instead
+    asynchronous = isinstance(request, ASGIRequest)
+    read = readRangeAsync if asynchronous else readRange
+
+    if (bounds != None):
+        start, end = bounds
+        length = end - start + 1
+        response = StreamingHttpResponse(read(path, start, length),
+            status=206, content_type=content_type)
+        response.headers['Content-Length'] = str(length)
+        response.headers['Content-Range'] = f'bytes {start}-{end}/{size}'
+    elif (asynchronous):
+        response = StreamingHttpResponse(read(path, 0, size),
+            content_type=content_type)
+        response.headers['Content-Length'] = str(size)
+    else:
+        # FileResponse lets the WSGI server use sendfile when it can
+        response = FileResponse(open(path, 'rb'), content_type=content_type)
+
+    response.headers['Accept-Ranges'] = 'bytes'
+    return response
@@ -0,0 +1,188 @@
+from collections import Counter, defaultdict
+
+from django.db import transaction
+from django.db.models import Count, Exists, F, OuterRef, Q, Subquery, Value
+from django.db.models.functions import Coalesce
+
+from . import caching, tagindex
+from .models import Image, ImageTag, Tag
+
+
+def lockTags(names: set[str], ids: list[int] = ()) -> dict[str, int]:
+    """Create any missing named tags and lock them and the given ids
+
+    Returns the ids of the locked tags by name."""
+
+    # Another upload may create the same tag concurrently, so let the unique
+    # constraint settle it rather than checking first
+    Tag.objects.bulk_create([Tag(name=name) for name in names],
+        ignore_conflicts=True)
+
+    # Locking in id order keeps two edits from waiting on each other. A tag
+    # deleted by the transaction we waited for is missing, so make it again.
+    while (True):
+        tagIds = dict(Tag.objects.select_for_update()
+            .filter(Q(name__in=names) | Q(id__in=ids)).order_by('id')
+            .values_list('name', 'id'))
+        missing = set(names) - tagIds.keys()
+        if (not missing):
+            return tagIds
+        Tag.objects.bulk_create([Tag(name=name) for name in missing],
+            ignore_conflicts=True)
+
+
+def deleteUnusedTags(ids: list[int]) -> None:
+    """Delete the tags among some locked ones that no image uses"""
+
+    # The lock keeps new links out; checking the links as well as the count
+    # means a count that has drifted can never cascade to real links
+    Tag.objects.filter(id__in=ids, image_count=0) \
+        .filter(~Exists(ImageTag.objects.filter(tag_id=OuterRef('pk')))) \
+        .delete()
+
+
+@transaction.atomic
+def setTags(image: Image, tagNames: list[str],
+            suggestedNames: set[str] = frozenset()) -> None:
+    """Set the tags for a given image
+
+    Added tags the tagging model suggested are recorded as machine tags;
+    tags the image keeps keep the source they had."""
+
+    # Work on sets so the number of queries does not depend on the tag count
+    tagNames = set(tagNames)
+
+    # Serialize changes to the same image so the difference computed below,
+    # and so the counts adjusted from it, cannot be applied twice
+    Image.objects.select_for_update().filter(pk=image.pk).exists()
+
+    current = dict(Tag.objects.filter(image=image).values_list('name', 'id'))
+    addedNames = tagNames - current.keys()
+    removedNames = [name for name in current if name not in tagNames]
+    removedIds = [current[name] for name in removedNames]
+
+    # Lock the tags first, so one losing its last image can't be deleted
+    # while this image starts using it
+    if (addedNames or removedIds):
+        tagIds = lockTags(addedNames, removedIds)
+
+    if (addedNames):
+        addedIds = {name: tagIds[name] for name in addedNames}
+        ImageTag.objects.bulk_create([
+            ImageTag(image_id=image.id, tag_id=id, source=ImageTag.AUTO
+                if name in suggestedNames else ImageTag.USER)
+            for name, id in addedIds.items()])
+        Tag.objects.filter(id__in=addedIds.values()) \
+            .update(image_count=F('image_count') + 1)
+
+    if (removedIds):
+        ImageTag.objects.filter(image_id=image.id, tag_id__in=removedIds) \
+            .delete()
+        Tag.objects.filter(id__in=removedIds) \
+            .update(image_count=F('image_count') - 1)
+
+        # Remove the tags no other image uses
+        deleteUnusedTags(removedIds)
+
+    if (addedNames or removedIds):
+        image.updateSearchVector()
+        caching.tagsChanged(image.id)
+        transaction.on_commit(lambda: tagindex.tagsChanged(
+            list(addedNames), removedNames))
+
+
+def adjustCounts(deltas: Counter) -> None:
+    """Change the image counts of many tags, one update per distinct change"""
+
+    byDelta = defaultdict(list)
+    for tagId, delta in deltas.items():
+        if (delta != 0):
+            byDelta[delta].append(tagId)
+    for delta, ids in byDelta.items():
+        Tag.objects.filter(id__in=ids) \
+            .update(image_count=F('image_count') + delta)
+
+
+def addTags(tagNamesByImage: dict[int, set[str]],
+            source: str = ImageTag.USER) -> None:
+    """Add tags the images don't have yet, in a fixed number of queries"""
+
+    names = set().union(*tagNamesByImage.values())
+    if (len(names) == 0):
+        return
+
+    tagIds = lockTags(names)
+    ImageTag.objects.bulk_create([
+        ImageTag(image_id=image_id, tag_id=tagIds[name], source=source)
+        for image_id, tagNames in tagNamesByImage.items()
+        for name in tagNames
+    ], batch_size=5000)
+    adjustCounts(Counter(tagIds[name] for tagNames in tagNamesByImage.values()
+                         for name in tagNames))
+
+    Image.updateSearchVectors(list(tagNamesByImage))
+    caching.bumpOnCommit(caching.CATALOG_VERSION, caching.TAGS_VERSION,
+        *[caching.imageVersionKey(image_id) for image_id in tagNamesByImage])
+    transaction.on_commit(tagindex.invalidate)
+
+
+@transaction.atomic
+def applyMachineTags(suggestions: dict[int, set[str]], replace: bool) -> int:
+    """Merge or replace the machine tags of many images, keeping user tags
+
+    Returns the number of images whose tags changed."""
+
+    # Serialize with setTags on the same images, like setTags itself does
+    imageIds = list(Image.objects.select_for_update()
+        .filter(id__in=list(suggestions)).values_list('id', flat=True))
+
+    current = defaultdict(dict)
+    for linkId, imageId, tagId, name, source in ImageTag.objects \
+            .filter(image_id__in=imageIds) \
+            .values_list('id', 'image_id', 'tag_id', 'tag__name', 'source'):
+        current[imageId][name] = (linkId, tagId, source)
+
+    added, removed = {}, []
+    for imageId in imageIds:
+        links = current[imageId]
+        newNames = suggestions[imageId] - links.keys()
+        if (newNames):
+            added[imageId] = newNames
+        if (replace):
+            removed += [(imageId, linkId, tagId)
+                        for name, (linkId, tagId, source) in links.items()
+                        if source == ImageTag.AUTO and
+                            name not in suggestions[imageId]]
+
+    # Lock every tag involved at once, in the same order setTags does
+    lockTags(set().union(*added.values()), [tagId for _, _, tagId in removed])
+
+    # Add first, so a tag moving between images never drops to zero uses
+    addTags(added, ImageTag.AUTO)
+
+    if (removed):
+        ImageTag.objects.filter(id__in=[linkId for _, linkId, _ in removed]) \
+            .delete()
+        removedIds = Counter(tagId for _, _, tagId in removed)
+        adjustCounts(Counter({tagId: -count
+                              for tagId, count in removedIds.items()}))
+        deleteUnusedTags(list(removedIds))
+
+        changedIds = {imageId for imageId, _, _ in removed}
+        Image.updateSearchVectors(list(changedIds))
+        caching.bumpOnCommit(caching.CATALOG_VERSION, caching.TAGS_VERSION,
+            *[caching.imageVersionKey(imageId) for imageId in changedIds])
+        transaction.on_commit(tagindex.invalidate)
+
+    return len(added.keys() | {imageId for imageId, _, _ in removed})
+
+
+def reconcileTagCounts() -> int:
+    """Recount the images using every tag, returning how many were wrong"""
+
+    counts = ImageTag.objects.filter(tag_id=OuterRef('pk')).order_by() \
+        .values('tag_id').annotate(count=Count('*')).values('count')
+    actual = Coalesce(Subquery(counts), Value(0))
+
+    return Tag.objects.alias(actual=actual) \
+        .exclude(image_count=F('actual')).update(image_count=actual)
@@ -0,0 +1,183 @@
+import bisect, heapq, threading, time
+
+from django.core.cache import cache
+
+from .models import Tag
+
+
+# How many ranked names to keep per prefix; more than a page of suggestions
+# so excluding the tags already typed rarely needs a rescan
+RANKED_PER_PREFIX = 32
+
+# Rebuild at least this often, so changes made by other processes show up
+# even when the cache backend is not shared between them
+INDEX_MAX_AGE = 60
+
+# Look at the shared version at most this often, rather than on every
+# keystroke
+VERSION_CHECK_INTERVAL = 2
+
+# Tag changes are shared for this long; a process further behind than the
+# changes still kept, or than MAX_CHANGES, rebuilds instead of catching up
+CHANGE_TIMEOUT = 10 * 60
+MAX_CHANGES = 1000
+
+VERSION_KEY = 'autocomplete:version'
+
+
+class PrefixIndex:
+    """Sorted tag names with usage counts, answering top-k prefix queries"""
+
+    def __init__(self, counts: dict[str, int]):
+        self.counts = dict(counts)
+        self.names = sorted(self.counts)
+        self.ranked = {}
+        self.lock = threading.Lock()
+
+    def rank(self, prefix: str, limit: int) -> list[str]:
+        """Find the most used names starting with a prefix"""
+
+        start = bisect.bisect_left(self.names, prefix)
+        end = bisect.bisect_left(self.names, prefix + '\U0010ffff', start)
+        return heapq.nsmallest(limit, self.names[start:end],
+            key=lambda name: (-self.counts[name], name))
+
+    def suggest(self, prefix: str, limit: int,
+                exclude: set[str] = frozenset()) -> list[str]:
+        """Get up to limit names for a prefix, most used first"""
+
+        with self.lock:
+            ranked = self.ranked.get(prefix)
+            if (ranked == None):
+                ranked = self.rank(prefix, RANKED_PER_PREFIX)
+                self.ranked[prefix] = ranked
+
+            suggestions = [name for name in ranked if name not in exclude]
+            if (len(suggestions) < limit and len(ranked) == RANKED_PER_PREFIX):
+                ranked = self.rank(prefix, limit + len(exclude))
+                suggestions = [name for name in ranked if name not in exclude]
+
+        return suggestions[:limit]
+
+    def adjust(self, name: str, delta: int) -> None:
+        """Change a name's usage count, adding or dropping it as needed"""
+
+        with self.lock:
+            count = self.counts.get(name, 0) + delta
+            if (name not in self.counts and count > 0):
+                bisect.insort(self.names, name)
+            elif (name in self.counts and count <= 0):
+                del self.names[bisect.bisect_left(self.names, name)]
+
+            if (count > 0):
+                self.counts[name] = count
+            else:
+                self.counts.pop(name, None)
+
+            # Only the ranked lists for this name's prefixes can change
+            for length in range(len(name) + 1):
+                self.ranked.pop(name[:length], None)
+
+
+index = None
+indexVersion = None
+indexBuilt = 0.0
+versionChecked = 0.0
+indexLock = threading.Lock()
+
+
+def changeKey(version: int) -> str:
+    return f'autocomplete:change:{version}'
+
+
+def currentVersion() -> int:
+    cache.add(VERSION_KEY, 0, timeout=None)
+    return cache.get(VERSION_KEY, 0)
+
+
+def catchUp(version: int) -> bool:
+    """Apply the changes made since the index's version, if all are known"""
+
+    global indexVersion
+
+    if (indexVersion == None or not
+            0 <= version - indexVersion <= MAX_CHANGES):
+        return False
+
+    # A version bumped by invalidate() has no change, so forces a rebuild
+    keys = [changeKey(number)
+            for number in range(indexVersion + 1, version + 1)]
+    changes = cache.get_many(keys)
+    if (len(changes) != len(keys)):
+        return False
+
+    for key in keys:
+        added, removed = changes[key]
+        for name in added:
+            index.adjust(name, 1)
+        for name in removed:
+            index.adjust(name, -1)
+    indexVersion = version
+    return True
+
+
+def getIndex() -> PrefixIndex:
+    """Get this process's index, updating it if it is out of date"""
+
+    global index, indexVersion, indexBuilt, versionChecked
+
+    with indexLock:
+        now = time.monotonic()
+        fresh = index != None and now - indexBuilt <= INDEX_MAX_AGE
+        if (fresh and now - versionChecked < VERSION_CHECK_INTERVAL):
+            return index
+
+        version = currentVersion()
+        versionChecked = now
+        if (fresh and catchUp(version)):
+            return index
+
+        counts = Tag.objects.filter(image_count__gt=0) \
+            .values_list('name', 'image_count')
+        index = PrefixIndex(dict(counts))
+        indexVersion = version
+        indexBuilt = now
+        return index
+
+
+def tagsChanged(added: list[str], removed: list[str]) -> None:
+    """Apply one image's tag changes here and share them with the others"""
+
+    global index
+
+    with indexLock:
+        version = invalidate()
+        if (version != None):
+            cache.set(changeKey(version), (added, removed), CHANGE_TIMEOUT)
+
+        # Picks up this change along with any made elsewhere since the last
+        # check; if some are unknown, rebuild on the next suggestion
+        if (index != None and (version == None or not catchUp(version))):
+            index = None
+
+
+def invalidate() -> int | None:
+    """Make every process rebuild its index when it next checks the version"""
+
+    global versionChecked
+
+    # This process checks on its next suggestion
+    versionChecked = 0.0
+    try:
+        return cache.incr(VERSION_KEY)
+    except ValueError:
+        return None
+
+
+def suggest(prefix: str, limit: int,
+            exclude: set[str] = frozenset()) -> list[tuple[str, int]]:
+    """Get the most used tag names starting with a prefix with their counts"""
+
+    tagIndex = getIndex()
+    names = tagIndex.suggest(prefix, limit, exclude)
+    return [(name, tagIndex.counts.get(name, 0)) for name in names]
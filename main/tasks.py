@@ -0,0 +1,83 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import close_old_connections, transaction
+
+from . import embeddings, neighbors, renditions
+from .models import Image
+
+
+BACKGROUND_WORKERS = 2
+
+logger = logging.getLogger(__name__)
+
+# Background workers shared by every request handled in this process
+executor = ThreadPoolExecutor(max_workers=BACKGROUND_WORKERS,
+    thread_name_prefix='background')
+
+
+def generateRenditions(image_id: int, file_name: str,
+                       width: int | None) -> None:
+    """Generate the missing renditions of an image, logging any failure"""
+
+    try:
+        renditions.generateRenditions(
+            Image(id=image_id, file=file_name, width=width),
+            encoding=renditions.preferredEncoding())
+    except Exception:
+        logger.exception('Could not generate renditions for image %s',
+            image_id)
+
+
+def queueRenditions(image: Image) -> None:
+    """Generate the renditions of an image once the upload is committed"""
+
+    image_id = image.id
+    file_name = image.file.name
+    width = image.width
+    transaction.on_commit(lambda: executor.submit(generateRenditions,
+        image_id, file_name, width))
+
+
+def embedImage(image_id: int, file_name: str) -> None:
+    """Add the embedding of an image to the search index, logging failure"""
+
+    try:
+        with Image(id=image_id, file=file_name).file.open('rb') as file:
+            embedding = embeddings.embedImage(file.read())
+        embeddings.getStore().append([image_id], embedding[None])
+    except Exception:
+        logger.exception('Could not embed image %s', image_id)
+
+    # Fall back to tag similarity if the image could not be embedded
+    updateNeighbors([image_id], True)
+
+
+def queueEmbedding(image: Image) -> None:
+    """Embed an image for semantic search once the upload is committed"""
+
+    image_id = image.id
+    file_name = image.file.name
+    transaction.on_commit(
+        lambda: executor.submit(embedImage, image_id, file_name))
+
+
+def updateNeighbors(image_ids: list[int], propagate: bool) -> None:
+    """Refresh the similar images of some images, logging any failure"""
+
+    close_old_connections()
+    for image_id in image_ids:
+        try:
+            neighbors.refreshNeighbors(image_id, propagate)
+        except Exception:
+            logger.exception('Could not update the neighbors of image %s',
+                image_id)
+    close_old_connections()
+
+
+def queueNeighbors(image_ids: list[int], propagate: bool = True) -> None:
+    """Refresh the similar images of some images once the change commits"""
+
+    image_ids = list(image_ids)
+    transaction.on_commit(
+        lambda: executor.submit(updateNeighbors, image_ids, propagate))
@@ -1,3 +1,1480 @@
-from django.test import TestCase
+import http.client, io, json, os, signal, socket, tempfile, threading, time
+from pathlib import Path
+from unittest import mock, skipIf
 
-# Create your tests here.
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.db import connection, connections
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+import numpy as np
+import PIL.ExifTags, PIL.Image, PIL.ImageDraw
+
+from . import (autotagger, benchmark, concurrency, duplicates, embeddings,
+    ingest, metrics, neighbors, pagination, renditions, staging, streaming,
+    tagindex, tasks)
+from .models import Image, ImageNeighbor, ImageTag, Tag
+from .pagination import KeysetPaginator
+from .tagindex import PrefixIndex
+from .search import searchImages
+from .tagging import addTags, setTags
+
+
+# The tagging server's packages are only installed where it runs
+try:
+    from . import inference
+except ImportError:
+    inference = None
+
+# Tests clear the cache and fill it with fragments of the test database, so
+# they must never touch the site's own cache
+TEST_CACHES = {'default': {
+    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    'LOCATION': 'imagesite-tests',
+}}
+
+
+@override_settings(CACHES=TEST_CACHES)
+class SiteTestCase(TestCase):
+    """Start each test with an empty cache, as versions only move on commit"""
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+
+        # Never suggest tags from an index built on another test's data
+        tagindex.index = None
+
+
+class QueryBudgetTests(SiteTestCase):
+    """Keep the number of queries per page independent of the data size"""
+
+    @classmethod
+    def setUpTestData(cls):
+        for i in range(25):
+            image = Image.objects.create(title=f'Image {i}',
+                description='A picture', file=f'images/{i}.jpg')
+            setTags(image, ['common', f'tag-{i}', f'group-{i % 3}'])
+        cls.image = image
+
+    def test_search(self):
+        # Count, page rows and the page's tags, then nothing once cached
+        for query in ['', 'common', 'picture -group-1']:
+            for sort_by in ['date', 'title', 'relevance']:
+                with self.subTest(query=query, sort_by=sort_by):
+                    cache.clear()
+                    with self.assertNumQueries(3):
+                        response = self.client.get(reverse('home'),
+                            {'q': query, 'sort_by': sort_by})
+                    self.assertEqual(response.status_code, 200)
+
+                    with self.assertNumQueries(0):
+                        cached = self.client.get(reverse('home'),
+                            {'q': f' {query} ', 'sort_by': sort_by})
+                    self.assertEqual(cached.context['results'],
+                        response.context['results'])
+
+    def test_search_deep_page(self):
+        cursor = None
+        for _ in range(2):
+            page = self.client.get(reverse('home'),
+                {'cursor': cursor} if cursor else {}).context['page']
+            cursor = page.next_cursor
+
+        with self.assertNumQueries(3):
+            response = self.client.get(reverse('home'), {'cursor': cursor})
+        self.assertEqual(len(response.context['page'].object_list), 5)
+
+    def test_detail(self):
+        # The image, its tags and its similar images
+        with self.assertNumQueries(3):
+            response = self.client.get(reverse('detail', kwargs={
+                'image_id': self.image.id, 'slug': self.image.slug()
+            }))
+        self.assertEqual(response.status_code, 200)
+
+    def test_tags(self):
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('tags'))
+        self.assertContains(response, '29 tags')
+
+    def test_tags_by_usage(self):
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('tags'),
+                {'sort_by': 'count', 'min_count': 2})
+        self.assertEqual([tag.name for tag in response.context['tags']],
+            ['common', 'group-0', 'group-1', 'group-2'])
+
+
+class SearchTests(SiteTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.sunset = Image.objects.create(title='Sunset over the sea',
+            description='Taken from the pier', file='images/a.jpg')
+        cls.beach = Image.objects.create(title='Beach',
+            description='A sunny day by the sea', file='images/b.jpg')
+        cls.harbour = Image.objects.create(title='Harbour',
+            description='Boats', file='images/c.jpg')
+        setTags(cls.sunset, ['orange'])
+        setTags(cls.beach, ['sea', 'sand'])
+        setTags(cls.harbour, ['sea', 'boat'])
+
+    def ids(self, query: str, **options) -> list[int]:
+        return [image.id for image in searchImages(query, **options)]
+
+    def test_tokens_must_all_match(self):
+        self.assertEqual(set(self.ids('sea')),
+            {self.sunset.id, self.beach.id, self.harbour.id})
+        self.assertEqual(self.ids('sea sand'), [self.beach.id])
+        self.assertEqual(set(self.ids('sea -sand')),
+            {self.sunset.id, self.harbour.id})
+
+    def test_substrings_match_titles_and_descriptions_only(self):
+        # Titles and descriptions match any substring, whatever the case,
+        # which the trigram indexes serve; tags match whole names
+        self.assertEqual(set(self.ids('SUN')), {self.sunset.id, self.beach.id})
+        self.assertEqual(self.ids('pie'), [self.sunset.id])
+        self.assertEqual(self.ids('oran'), [])
+        self.assertEqual(self.ids('orange'), [self.sunset.id])
+
+    def test_switches_limit_the_fields_searched(self):
+        self.assertEqual(set(self.ids('sea', include_tags='off')),
+            {self.sunset.id, self.beach.id})
+        self.assertEqual(self.ids('sea', include_tags='off',
+            include_descriptions='off'), [self.sunset.id])
+        self.assertEqual(self.ids('boats', include_descriptions='off'), [])
+
+        # A negative token only looks at the enabled fields too
+        self.assertEqual(set(self.ids('-sea', include_tags='off',
+            include_titles='off')), {self.sunset.id, self.harbour.id})
+
+    def test_relevance_ranks_title_over_tags_over_description(self):
+        waves = Image.objects.create(title='Waves',
+            description='The sea at dusk', file='images/d.jpg')
+        ranked = self.ids('sea', sort_by='relevance')
+        self.assertEqual(ranked[0], self.sunset.id)
+        self.assertEqual(set(ranked[1:3]), {self.beach.id, self.harbour.id})
+        self.assertEqual(ranked[3], waves.id)
+
+        # Matches the search document doesn't contain as a word still show,
+        # ranked last
+        ranked = self.ids('sun', sort_by='relevance')
+        self.assertEqual(set(ranked), {self.sunset.id, self.beach.id})
+
+    def test_search_document_follows_edits(self):
+        setTags(self.harbour, ['lighthouse'])
+        self.assertEqual(self.ids('lighthouse', sort_by='relevance'),
+            [self.harbour.id])
+        rank = searchImages('lighthouse', sort_by='relevance').get().rank
+        self.assertGreater(rank, 0)
+
+
+class KeysetPaginationTests(SiteTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        # Repeat titles so the id has to break ties
+        for i in range(23):
+            Image.objects.create(title=f'The Title {i % 4}',
+                description='', file=f'images/{i}.jpg')
+
+    def walk(self, images, per_page=5):
+        """Follow next cursors to the end, then previous cursors back"""
+
+        paginator = KeysetPaginator(images, per_page)
+        pages = [paginator.page(None)]
+        while (pages[-1].next_cursor):
+            pages.append(paginator.page(pages[-1].next_cursor))
+
+        backwards = [pages[-1]]
+        while (backwards[-1].previous_cursor):
+            backwards.append(paginator.page(backwards[-1].previous_cursor))
+
+        forward_ids = [image.id for page in pages for image in page]
+        backward_ids = [image.id for page in reversed(backwards)
+                        for image in page]
+        return forward_ids, backward_ids
+
+    def test_walk_matches_offset_order(self):
+        for sort_by in ['date', 'title', 'relevance']:
+            for reverse_sort in ['on', 'off']:
+                with self.subTest(sort_by=sort_by, reverse_sort=reverse_sort):
+                    images = searchImages('title 2', sort_by=sort_by,
+                        reverse_sort=reverse_sort)
+                    expected = list(images.values_list('id', flat=True))
+                    forward_ids, backward_ids = self.walk(images)
+                    self.assertEqual(forward_ids, expected)
+                    self.assertEqual(backward_ids, expected)
+
+    def test_mixed_directions_walk_in_order(self):
+        images = Image.objects.order_by('title_normalized', '-id')
+        expected = list(images.values_list('id', flat=True))
+        forward_ids, backward_ids = self.walk(images)
+        self.assertEqual(forward_ids, expected)
+        self.assertEqual(backward_ids, expected)
+
+    def test_cursor_query_uses_index(self):
+        for sort_by, index in [('date', 'image_date_id'),
+                               ('title', 'image_title_normalized_id')]:
+            with self.subTest(sort_by=sort_by):
+                paginator = KeysetPaginator(searchImages('', sort_by=sort_by),
+                    5)
+                _, values, backwards = pagination.decodeCursor(
+                    paginator.page(None).next_cursor)
+                queryset = paginator.seek(paginator.orderBy(backwards),
+                    paginator.parseValues(values), backwards)
+
+                # The table is tiny, so make a sequential scan unattractive
+                # and check the seek condition is what reaches the index
+                with connection.cursor() as cursor:
+                    cursor.execute('SET LOCAL enable_seqscan = off')
+                plan = queryset[:6].explain()
+                self.assertIn(index, plan)
+                self.assertIn('Index Cond: (ROW(', plan)
+
+    def test_invalid_cursor_shows_first_page(self):
+        paginator = KeysetPaginator(searchImages(''), 5)
+        first = [image.id for image in paginator.page(None)]
+        self.assertEqual([image.id for image in paginator.page('junk')],
+            first)
+
+    def test_empty_and_exactly_full_results(self):
+        page = KeysetPaginator(searchImages('nothing'), 5).page(None)
+        self.assertEqual(list(page), [])
+        self.assertFalse(page.has_other_pages())
+        self.assertEqual((page.next_cursor, page.previous_cursor),
+            (None, None))
+
+        # No empty page follows when the results fill the last page exactly
+        images = searchImages('title', sort_by='title')[:20]
+        paginator = KeysetPaginator(searchImages('title', sort_by='title')
+            .filter(id__in=[image.id for image in images]), 5)
+        page = paginator.page(None)
+        for _ in range(3):
+            page = paginator.page(page.next_cursor)
+        self.assertEqual(len(page), 5)
+        self.assertFalse(page.has_next())
+        self.assertEqual(page.next_cursor, None)
+
+    def test_cursor_survives_deleted_row(self):
+        images = searchImages('', sort_by='title', reverse_sort='off')
+        expected = list(images.values_list('id', flat=True))
+        paginator = KeysetPaginator(images, 5)
+        first = paginator.page(None)
+
+        # The row the cursor points at is gone, but seeking still starts
+        # right after where it was
+        Image.objects.filter(id=first.object_list[-1].id).delete()
+        second = paginator.page(first.next_cursor)
+        self.assertEqual([image.id for image in second], expected[5:10])
+
+    def test_cursor_from_another_ordering_is_ignored(self):
+        byDate = KeysetPaginator(searchImages(''), 5)
+        cursor = byDate.page(None).next_cursor
+        byTitle = KeysetPaginator(searchImages('', sort_by='title'), 10)
+        response = self.client.get(reverse('home'),
+            {'sort_by': 'title', 'cursor': cursor})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(list(response.context['page']),
+            list(byTitle.page(None)))
+
+    def test_count_is_estimated_above_limit(self):
+        paginator = KeysetPaginator(searchImages(''), 5)
+        self.assertEqual(paginator.count, 23)
+        self.assertTrue(paginator.count_is_exact)
+
+        with mock.patch.object(pagination, 'EXACT_COUNT_LIMIT', 10):
+            paginator = KeysetPaginator(searchImages(''), 5)
+            self.assertGreater(paginator.count, 10)
+            self.assertFalse(paginator.count_is_exact)
+
+
+class PrefixIndexTests(SiteTestCase):
+
+    def test_suggestions_are_ranked_by_usage(self):
+        index = PrefixIndex({'cat': 2, 'car': 5, 'cart': 5, 'dog': 9})
+        self.assertEqual(index.suggest('ca', 7), ['car', 'cart', 'cat'])
+        self.assertEqual(index.suggest('ca', 2, {'car'}), ['cart', 'cat'])
+        self.assertEqual(index.suggest('x', 7), [])
+
+    def test_adjust_invalidates_prefixes(self):
+        index = PrefixIndex({'cat': 2, 'car': 5})
+        self.assertEqual(index.suggest('c', 7), ['car', 'cat'])
+
+        index.adjust('cat', 4)
+        index.adjust('cab', 1)
+        self.assertEqual(index.suggest('c', 7), ['cat', 'car', 'cab'])
+
+        index.adjust('car', -5)
+        self.assertEqual(index.suggest('ca', 7), ['cat', 'cab'])
+        self.assertNotIn('car', index.names)
+
+    def test_changes_elsewhere_are_applied_in_place(self):
+        image = Image.objects.create(title='A', description='',
+            file='images/a.jpg')
+        setTags(image, ['sunset'])
+        built = tagindex.getIndex()
+
+        # Another process publishes a change; the database is left alone,
+        # so only catching up can know about it
+        with mock.patch.object(tagindex, 'index', None):
+            tagindex.tagsChanged(['sunrise'], [])
+        self.assertEqual(tagindex.suggest('sun', 7),
+            [('sunrise', 1), ('sunset', 1)])
+        self.assertIs(tagindex.getIndex(), built)
+
+        # A change without a published delta forces a rebuild
+        tagindex.invalidate()
+        self.assertIsNot(tagindex.getIndex(), built)
+        self.assertEqual(tagindex.suggest('sun', 7), [('sunset', 1)])
+
+    def test_version_is_checked_at_most_once_per_interval(self):
+        with mock.patch.object(tagindex, 'currentVersion',
+                wraps=tagindex.currentVersion) as currentVersion:
+            for prefix in ['s', 'su', 'sun', 'suns']:
+                tagindex.suggest(prefix, 7)
+            self.assertEqual(currentVersion.call_count, 1)
+
+            with mock.patch.object(tagindex, 'VERSION_CHECK_INTERVAL', 0):
+                tagindex.suggest('sunse', 7)
+            self.assertEqual(currentVersion.call_count, 2)
+
+    def test_view_follows_tag_changes(self):
+        image = Image.objects.create(title='A', description='',
+            file='images/a.jpg')
+        with self.captureOnCommitCallbacks(execute=True):
+            setTags(image, ['sunset', 'sunrise'])
+        other = Image.objects.create(title='B', description='',
+            file='images/b.jpg')
+        with self.captureOnCommitCallbacks(execute=True):
+            setTags(other, ['sunrise'])
+
+        response = self.client.get(reverse('autocomplete'),
+            {'q': 'beach sun', 'format': 'json'})
+        self.assertEqual(json.loads(response.content)['suggestions'], [
+            {'name': 'sunrise', 'count': 2},
+            {'name': 'sunset', 'count': 1},
+        ])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            setTags(image, [])
+        response = self.client.get(reverse('autocomplete'), {'q': 'sun'})
+        self.assertEqual(response.context['suggestions'], ['rise'])
+
+
+class TagCountTests(SiteTestCase):
+
+    def counts(self):
+        return dict(Tag.objects.values_list('name', 'image_count'))
+
+    def test_counts_follow_tag_changes(self):
+        first = Image.objects.create(title='A', description='',
+            file='images/a.jpg')
+        second = Image.objects.create(title='B', description='',
+            file='images/b.jpg')
+
+        setTags(first, ['sky', 'sea'])
+        setTags(second, ['sky', 'sand'])
+        self.assertEqual(self.counts(), {'sky': 2, 'sea': 1, 'sand': 1})
+
+        setTags(first, ['sky', 'sand'])
+        self.assertEqual(self.counts(), {'sky': 2, 'sand': 2})
+
+        setTags(second, [])
+        self.assertEqual(self.counts(), {'sky': 1, 'sand': 1})
+
+    def test_queries_do_not_grow_with_the_tag_count(self):
+        def queries(count: int) -> list[int]:
+            image = Image.objects.create(title='A', description='',
+                file=f'images/{count}.jpg')
+            names = [f'tag{count}-{i}' for i in range(count)]
+            used = []
+            for tagNames in [names, names[:count // 2], []]:
+                with CaptureQueriesContext(connection) as captured:
+                    setTags(image, tagNames)
+                used.append(len(captured))
+            return used
+
+        self.assertEqual(queries(2), queries(40))
+
+    def test_unused_tags_are_only_deleted_without_links(self):
+        first = Image.objects.create(title='A', description='',
+            file='images/a.jpg')
+        second = Image.objects.create(title='B', description='',
+            file='images/b.jpg')
+        setTags(first, ['sky'])
+        setTags(second, ['sky'])
+
+        # A drifted count must not take another image's link with it
+        Tag.objects.filter(name='sky').update(image_count=1)
+        setTags(first, [])
+        self.assertEqual(list(second.tags.values_list('name', flat=True)),
+            ['sky'])
+
+    def test_reconcile_repairs_drift(self):
+        image = Image.objects.create(title='A', description='',
+            file='images/a.jpg')
+        setTags(image, ['sky', 'sea'])
+        Tag.objects.create(name='unused', image_count=3)
+        Tag.objects.filter(name='sky').update(image_count=5)
+
+        call_command('reconcile_tag_counts', stdout=io.StringIO())
+        self.assertEqual(self.counts(), {'sky': 1, 'sea': 1})
+
+
+class DuplicateTests(SiteTestCase):
+
+    def picture(self, seed: int = 0, size: int = 256) -> io.BytesIO:
+        # Blocks of distinct shades so no neighbouring cells are close
+        im = PIL.Image.new('L', (256, 256))
+        draw = PIL.ImageDraw.Draw(im)
+        for row in range(8):
+            for column in range(9):
+                shade = (row * 37 + column * 101 + seed) % 251
+                draw.rectangle((column * 256 // 9, row * 32,
+                    (column + 1) * 256 // 9, (row + 1) * 32), fill=shade)
+        file = io.BytesIO()
+        im.resize((size, size)).convert('RGB').save(file, 'JPEG')
+        file.seek(0)
+        return file
+
+    def test_near_duplicates_are_found(self):
+        original = duplicates.hashFile(self.picture())
+        resized = duplicates.hashFile(self.picture(size=200))
+        other = duplicates.hashFile(self.picture(seed=90))
+        self.assertLessEqual(duplicates.distance(original, resized),
+            duplicates.DUPLICATE_RADIUS)
+        self.assertGreater(duplicates.distance(original, other),
+            duplicates.DUPLICATE_RADIUS)
+
+        first = Image(title='A', description='', file='images/a.jpg')
+        duplicates.assignHash(first, original)
+        first.save()
+        second = Image(title='B', description='', file='images/b.jpg')
+        duplicates.assignHash(second, other)
+        second.save()
+
+        self.assertEqual(
+            [image.id for image in duplicates.findDuplicates(resized)],
+            [first.id])
+        self.assertEqual(
+            duplicates.findDuplicates(original, exclude_id=first.id), [])
+
+    def test_signed_storage_round_trips(self):
+        value = (1 << 63) | 0xF0F0
+        image = Image(title='A', description='', file='images/a.jpg')
+        duplicates.assignHash(image, value)
+        image.save()
+        image.refresh_from_db()
+        self.assertEqual(duplicates.distance(image.phash, value), 0)
+        self.assertEqual(duplicates.findDuplicates(value), [image])
+
+    def test_clusters(self):
+        hashes = {1: 0, 2: 0b111, 3: 0b111000, 4: -1, 5: (1 << 63) - 1}
+        self.assertEqual(duplicates.findClusters(hashes, 3),
+            [[1, 2, 3], [4, 5]])
+
+    def test_upload_flags_duplicates(self):
+        existing = Image(title='Original', description='',
+            file='images/a.jpg')
+        duplicates.assignHash(existing, duplicates.hashFile(self.picture()))
+        existing.save()
+
+        file = self.picture(size=200)
+        file.name = 'copy.jpg'
+        with tempfile.TemporaryDirectory() as media_root, \
+                self.settings(MEDIA_ROOT=media_root):
+            response = self.client.post(reverse('upload'), {'file': file,
+                'title': 'Copy', 'tags': '', 'description': ''}, follow=True)
+        self.assertContains(response,
+            f'looks like a duplicate of &quot;Original&quot; (#{existing.id})')
+
+
+class SemanticSearchTests(SiteTestCase):
+
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.store = embeddings.EmbeddingStore(Path(directory.name) / 'a.bin')
+
+    def vector(self, *values: float) -> np.ndarray:
+        vector = np.zeros(embeddings.EMBEDDING_SIZE, np.float16)
+        vector[:len(values)] = values
+        return vector
+
+    def test_store_ranks_latest_embeddings(self):
+        self.assertEqual(self.store.search(self.vector(1), 5), [])
+
+        self.store.append([1, 2, 3], np.stack([
+            self.vector(1, 0), self.vector(0.6, 0.8), self.vector(0, 1)]))
+        self.assertEqual(self.store.search(self.vector(1), 5), [1, 2, 3])
+        self.assertEqual(self.store.search(self.vector(1), 2), [1, 2])
+
+        # Replacing an image's embedding hides the old one
+        self.store.append([1], self.vector(-1, 0)[None])
+        self.assertEqual(self.store.search(self.vector(1), 5), [2, 3, 1])
+
+        self.assertEqual(self.store.compact({1, 2}), 2)
+        self.assertEqual(self.store.ids(), {1, 2})
+        self.assertEqual(self.store.search(self.vector(1), 5), [2, 1])
+
+    def test_appends_extend_the_live_rows(self):
+        generator = np.random.default_rng(2)
+        for _ in range(20):
+            ids = generator.choice(30, 3, replace=False) + 1
+            self.store.append(ids.tolist(), generator.normal(
+                size=(3, embeddings.EMBEDDING_SIZE)))
+            rows, live = self.store.load()
+
+        # Only the new rows are looked at after the first load
+        with mock.patch.object(np, 'unique') as unique:
+            self.store.append([1], self.vector(1)[None])
+            rows, live = self.store.load()
+        unique.assert_not_called()
+
+        # The same rows are live as when the whole file is read again
+        fresh = embeddings.EmbeddingStore(self.store.path)
+        self.assertEqual(live.tolist(), fresh.load()[1].tolist())
+        self.assertEqual(int(live.sum()), len(set(rows['id'].tolist())))
+
+    def test_clustered_index_matches_exact_search(self):
+        generator = np.random.default_rng(1)
+        centers = generator.normal(size=(8, embeddings.EMBEDDING_SIZE))
+        vectors = np.repeat(centers, 50, axis=0) + \
+            generator.normal(scale=0.3, size=(400, embeddings.EMBEDDING_SIZE))
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        self.store.append(list(range(1, 401)), vectors)
+        query = vectors[0].astype(np.float16)
+        exact = self.store.search(query, 10)
+
+        scored = []
+        def candidates(*args):
+            scored.append(len(rows := original(*args)))
+            return rows
+
+        original = self.store.candidates
+        with mock.patch.object(embeddings, 'IVF_MIN_ROWS', 100), \
+                mock.patch.object(embeddings, 'IVF_PROBES', 5), \
+                mock.patch.object(self.store, 'candidates', candidates):
+            self.assertEqual(self.store.buildIndex(), 20)
+            self.assertEqual(self.store.search(query, 10), exact)
+            self.assertLess(scored[0], 400)
+
+            # Rows added after the index was built are still searched
+            self.store.append([401], query[None])
+            self.assertEqual(self.store.search(query, 2), [1, 401])
+
+            # Compacting moves rows, so the index is unused until rebuilt
+            self.store.compact(set(range(1, 402)))
+            self.assertFalse(self.store.indexPath.exists())
+            self.assertEqual(self.store.search(query, 2), [1, 401])
+
+    def test_view_pages_through_ranked_ids(self):
+        images = [Image.objects.create(title=f'Image {i}', description='',
+                      file=f'images/{i}.jpg') for i in range(15)]
+        ranked = [image.id for image in reversed(images)]
+
+        with mock.patch.object(embeddings, 'searchText',
+                               return_value=ranked) as searchText:
+            # The page rows and their tags
+            with self.assertNumQueries(2):
+                response = self.client.get(reverse('home'),
+                    {'q': 'dog on a beach', 'mode': 'semantic', 'p': 2})
+        searchText.assert_called_once()
+        self.assertEqual(response.context['mode'], 'semantic')
+        self.assertEqual(response.context['page'].paginator.count, 15)
+        self.assertEqual([image.id for image in response.context['page']],
+            ranked[10:])
+
+    def test_falls_back_to_keywords(self):
+        Image.objects.create(title='Dog', description='', file='images/a.jpg')
+
+        with mock.patch.object(embeddings, 'embedText', return_value=None):
+            response = self.client.get(reverse('home'),
+                {'q': 'dog', 'mode': 'semantic'})
+        self.assertEqual(response.context['mode'], 'keywords')
+        self.assertEqual(response.context['page'].paginator.count, 1)
+        self.assertContains(response, 'Semantic search is unavailable')
+
+
+class NeighborTests(SiteTestCase):
+
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        settings = self.settings(MEDIA_ROOT=directory.name)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+        self.images = [Image.objects.create(title=f'Image {i}',
+                           description='', file=f'images/{i}.jpg')
+                       for i in range(5)]
+
+    def stored(self, image: Image) -> list[int]:
+        return list(ImageNeighbor.objects.filter(image=image)
+            .values_list('neighbor_id', flat=True))
+
+    def embed(self, *angles: float) -> None:
+        vectors = np.zeros((len(angles), embeddings.EMBEDDING_SIZE))
+        vectors[:, 0] = np.cos(angles)
+        vectors[:, 1] = np.sin(angles)
+        embeddings.getStore().append(
+            [image.id for image in self.images[:len(angles)]], vectors)
+
+    def test_tag_similarity_without_embeddings(self):
+        a, b, c, d, _ = self.images
+        setTags(a, ['sky', 'sea', 'sand'])
+        setTags(b, ['sky', 'sea', 'sand', 'boat'])
+        setTags(c, ['sky'])
+        setTags(d, ['forest'])
+
+        self.assertEqual(neighbors.jaccardNeighbors(a.id),
+            [(b.id, 0.75), (c.id, 1 / 3)])
+        self.assertEqual(neighbors.jaccardNeighbors(self.images[4].id), [])
+
+    def test_refresh_updates_nearby_images(self):
+        a, b, c, d, e = self.images
+        self.embed(0, 0.1, 0.5, 3, 3.1)
+        with mock.patch.object(neighbors, 'NEIGHBOR_COUNT', 2):
+            for image in self.images:
+                neighbors.refreshNeighbors(image.id, propagate=False)
+            self.assertEqual(self.stored(a), [b.id, c.id])
+            self.assertEqual(self.stored(d), [e.id, c.id])
+
+            # An image embedded next to d enters d's list without a rebuild
+            new = Image.objects.create(title='New', description='',
+                file='images/new.jpg')
+            embeddings.getStore().append([new.id],
+                np.array([[np.cos(2.95), np.sin(2.95)] +
+                          [0] * (embeddings.EMBEDDING_SIZE - 2)]))
+            neighbors.refreshNeighbors(new.id)
+        self.assertEqual(self.stored(new), [d.id, e.id])
+        self.assertEqual(self.stored(d), [new.id, e.id])
+
+        response = self.client.get(reverse('detail', kwargs={
+            'image_id': d.id, 'slug': d.slug()}))
+        self.assertEqual(response.context['similar'], [new, e])
+
+    def test_rebuild(self):
+        a, b, c, d, e = self.images
+        self.embed(0, 0.1, 0.5)
+        setTags(d, ['sky'])
+        setTags(e, ['sky', 'sea'])
+        Image.objects.filter(id=c.id).delete()
+
+        # Keep the test's transaction open when the command forks
+        with mock.patch.object(connections, 'close_all'):
+            call_command('rebuild_neighbors', workers=1, block_size=2,
+                stdout=io.StringIO())
+        self.assertEqual(self.stored(a)[:1], [b.id])
+        self.assertNotIn(c.id, self.stored(a) + self.stored(b))
+        self.assertEqual(self.stored(d), [e.id])
+
+
+class AsyncViewTests(SiteTestCase):
+
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        settings = self.settings(MEDIA_ROOT=directory.name)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+        (Path(directory.name) / 'images').mkdir()
+        PIL.Image.new('RGB', (300, 200), 'red') \
+            .save(Path(directory.name) / 'images' / 'red.png')
+        self.image = Image.objects.create(title='Red', description='',
+            file='images/red.png')
+        self.url = reverse('image', kwargs={'image_id': self.image.id})
+
+        patcher = mock.patch.object(metrics, 'SERVER_TIMING', True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def test_streams_files_asynchronously(self):
+        response = await self.async_client.get(self.url,
+            {'format': 'thumbnail'})
+        self.assertEqual(response.status_code, 200)
+        content = b''.join([chunk async for chunk in
+                            response.streaming_content])
+        self.assertEqual(int(response['Content-Length']), len(content))
+        with PIL.Image.open(io.BytesIO(content)) as im:
+            self.assertEqual(im.size, (128, 85))
+
+        # Work done in the pools is timed as part of the request
+        for step in ['db', 'resize', 'encode', 'total']:
+            self.assertIn(f'{step};dur=', response['Server-Timing'])
+
+        response = await self.async_client.get(self.url,
+            headers={'Range': 'bytes=0-9'})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(len(b''.join([chunk async for chunk in
+                                       response.streaming_content])), 10)
+
+    async def test_disk_access_stays_off_the_event_loop(self):
+        loop = threading.current_thread()
+        threads = {}
+
+        def record(module, name):
+            function = getattr(module, name)
+            def wrapper(*args, **kwargs):
+                threads[name] = threading.current_thread()
+                return function(*args, **kwargs)
+            return mock.patch.object(module, name, wrapper)
+
+        with record(renditions, 'lastModified'), \
+                record(renditions, 'findRendition'), \
+                record(streaming, 'fileResponse'), \
+                record(staging, 'cachedTags'), \
+                mock.patch.object(autotagger, 'tagImage', return_value=[]):
+            response = await self.async_client.get(self.url,
+                {'format': 'thumbnail'})
+            self.assertEqual(response.status_code, 200)
+            b''.join([chunk async for chunk in response.streaming_content])
+
+            file = io.BytesIO(b'image')
+            file.name = 'image.png'
+            response = await self.async_client.post(reverse('autotag'),
+                {'file': file})
+            self.assertEqual(response.status_code, 200)
+
+        self.assertEqual(set(threads), {'lastModified', 'findRendition',
+            'fileResponse', 'cachedTags'})
+        for name, thread in threads.items():
+            self.assertNotEqual(thread, loop, name)
+
+    def test_unchanged_images_are_not_sent_again(self):
+        response = self.client.get(self.url, {'format': 'thumbnail'})
+        etag, last_modified = response['ETag'], response['Last-Modified']
+        response.getvalue()
+
+        response = self.client.get(self.url, {'format': 'thumbnail'},
+            headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        self.assertEqual(response.content, b'')
+
+        response = self.client.get(self.url,
+            headers={'If-Modified-Since': last_modified})
+        self.assertEqual(response.status_code, 304)
+
+        # Replacing the file gives its renditions new validators
+        file = io.BytesIO()
+        PIL.Image.new('RGB', (300, 200), 'green').save(file, 'PNG')
+        file.name = 'green.png'
+        file.seek(0)
+        with mock.patch.object(tasks, 'executor'), \
+                self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('edit', kwargs={
+                'image_id': self.image.id, 'slug': self.image.slug()}),
+                {'title': 'Red', 'tags': '', 'description': '',
+                 'file': file})
+        response = self.client.get(self.url, {'format': 'thumbnail'},
+            headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        response.getvalue()
+
+    def test_renditions_are_negotiated(self):
+        self.assertEqual(renditions.negotiate('image/webp,*/*;q=0.8'), 'webp')
+        self.assertEqual(renditions.negotiate('image/webp;q=0, image/*'),
+            None)
+        self.assertEqual(renditions.negotiate('*/*'), None)
+
+        with mock.patch.object(renditions, 'supportedEncodings',
+                return_value=['webp']):
+            response = self.client.get(self.url, {'format': 'search'},
+                headers={'Accept': 'image/avif,image/webp,*/*'})
+            self.assertEqual(response['Content-Type'], 'image/webp')
+            self.assertEqual(response['Vary'], 'Accept')
+            webp = response['ETag']
+
+            response = self.client.get(self.url, {'format': 'search'},
+                headers={'Accept': 'image/*'})
+            self.assertEqual(response['Content-Type'], 'image/png')
+            self.assertNotEqual(response['ETag'], webp)
+            response.getvalue()
+
+        # The original is never negotiated
+        response = self.client.get(self.url,
+            headers={'Accept': 'image/webp'})
+        self.assertEqual(response['Content-Type'], 'image/png')
+        self.assertFalse(response.has_header('Vary'))
+        response.getvalue()
+
+    def test_allowed_widths_are_served(self):
+        response = self.client.get(self.url, {'w': 256})
+        with PIL.Image.open(io.BytesIO(response.getvalue())) as im:
+            self.assertEqual(im.size, (256, 171))
+
+        # Other widths fall back to the original
+        response = self.client.get(self.url, {'w': 250})
+        with PIL.Image.open(io.BytesIO(response.getvalue())) as im:
+            self.assertEqual(im.size, (300, 200))
+
+        Image.objects.filter(id=self.image.id).update(width=300, height=200)
+        self.assertContains(self.client.get(reverse('home')),
+            f'{self.url}?w=256 256w, {self.url}?w=384 300w"')
+
+    def test_background_work_covers_the_srcset(self):
+        Image.objects.filter(id=self.image.id).update(width=300, height=200)
+        image = Image.objects.get(id=self.image.id)
+        tasks.generateRenditions(image.id, image.file.name, image.width)
+
+        # Nothing the search results or detail page ask for is left to
+        # generate while the request waits
+        encoding = renditions.preferredEncoding()
+        formats = list(renditions.RENDITION_SIZES) + ['w256', 'w384']
+        for format in formats:
+            self.assertNotEqual(renditions.findRendition(image, format,
+                encoding), None)
+        self.assertEqual(renditions.findRendition(image, 'w512', encoding),
+            None)
+
+    def test_saturated_limits_return_503(self):
+        full = threading.BoundedSemaphore(1)
+        full.acquire()
+
+        with mock.patch.object(concurrency, 'renditionSlots', full):
+            response = self.client.get(self.url, {'format': 'search'})
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(response['Retry-After'],
+                str(concurrency.RETRY_AFTER))
+
+            # Originals and existing renditions need no slot
+            response = self.client.get(self.url)
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response.getvalue())
+
+        with mock.patch.object(concurrency, 'autotagSlots', full):
+            response = self.client.post(reverse('autotag'),
+                {'file': io.BytesIO(b'image')})
+            self.assertEqual(response.status_code, 503)
+
+
+class CachingTests(SiteTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.image = Image.objects.create(title='Sky', description='',
+            file='images/sky.jpg')
+        setTags(self.image, ['blue'])
+        self.detail = reverse('detail', kwargs={
+            'image_id': self.image.id, 'slug': self.image.slug()})
+
+    def test_pages_are_served_from_cache_until_changed(self):
+        for url in [reverse('home'), reverse('tags'), self.detail]:
+            self.client.get(url)
+            with self.subTest(url=url), self.assertNumQueries(0):
+                self.client.get(url)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('edit', kwargs={
+                'image_id': self.image.id, 'slug': self.image.slug()}),
+                {'title': 'Sky', 'tags': 'blue cloud', 'description': 'New'})
+
+        self.assertContains(self.client.get(reverse('home')), 'cloud')
+        self.assertContains(self.client.get(reverse('tags')), 'cloud')
+        self.assertContains(self.client.get(self.detail), 'New')
+
+    def test_detail_page_follows_changes_to_similar_images(self):
+        other = Image.objects.create(title='Sea', description='',
+            file='images/sea.jpg')
+        ImageNeighbor.objects.create(image=self.image, neighbor=other,
+            rank=0, score=0.9)
+        self.assertContains(self.client.get(self.detail), 'Sea')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            other.title = 'Ocean'
+            other.save()
+        self.assertContains(self.client.get(self.detail), 'Ocean')
+
+    def test_unchanged_results_reuse_their_fragments(self):
+        other = Image.objects.create(title='Sea', description='',
+            file='images/sea.jpg')
+        setTags(other, ['green'])
+        self.client.get(reverse('home'))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            setTags(other, ['teal'])
+
+        # Count and rows, then tags for the changed image only
+        with self.assertNumQueries(3) as queries:
+            response = self.client.get(reverse('home'))
+        tagQuery = [query['sql'] for query in queries.captured_queries
+                    if 'main_tag' in query['sql']]
+        self.assertEqual(len(tagQuery), 1)
+        self.assertIn(f'IN ({other.id})', tagQuery[0])
+        self.assertContains(response, 'teal')
+        self.assertContains(response, 'blue')
+
+
+class MetricsTests(SiteTestCase):
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.object(metrics, 'SERVER_TIMING', True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        image = Image.objects.create(title='Sky', description='',
+            file='images/sky.jpg')
+        setTags(image, ['blue'])
+
+    def test_responses_report_their_timings(self):
+        timing = self.client.get(reverse('home'))['Server-Timing']
+        self.assertRegex(timing, r'db;dur=[\d.]+;desc="3x"')
+        self.assertIn('template;dur=', timing)
+        self.assertIn('total;dur=', timing)
+
+        response = self.client.get(reverse('metrics'))
+        self.assertEqual(response.status_code, 200)
+        content = response.content.decode()
+        self.assertIn('imagesite_request_queries_bucket{view="home",le="3"}',
+            content)
+        self.assertIn('imagesite_step_duration_seconds_count{view="home",'
+            'step="template"}', content)
+
+    def test_unknown_methods_share_a_label(self):
+        self.client.generic('BREW', reverse('tags'))
+        self.client.generic('PROPFIND', reverse('tags'))
+        content = self.client.get(reverse('metrics')).content.decode()
+        self.assertIn('imagesite_request_duration_seconds_count{view="tags",'
+            'method="other"} 2', content)
+        self.assertNotIn('BREW', content)
+
+    def test_timings_are_private_by_default(self):
+        with mock.patch.object(metrics, 'SERVER_TIMING', None):
+            self.assertNotIn('Server-Timing', self.client.get(reverse('home')))
+        response = self.client.get(reverse('metrics'),
+            REMOTE_ADDR='203.0.113.7')
+        self.assertEqual(response.status_code, 403)
+
+    def test_slow_requests_are_logged_with_their_sql(self):
+        with mock.patch.object(metrics, 'SLOW_REQUEST_MS', 0), \
+                mock.patch.object(metrics, 'SQL_SAMPLE_RATE', 1), \
+                self.assertLogs('main.metrics', 'WARNING') as logs:
+            self.client.get(reverse('tags'))
+        self.assertIn('Slow request: GET /tags/ 200', logs.output[0])
+        self.assertIn('FROM "main_tag"', logs.output[0])
+
+
+class StagingTests(SiteTestCase):
+
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        settings = self.settings(MEDIA_ROOT=directory.name)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+        self.data = io.BytesIO()
+        PIL.Image.new('RGB', (64, 48), 'red').save(self.data, 'PNG')
+
+    def autotag(self) -> dict:
+        file = io.BytesIO(self.data.getvalue())
+        file.name = 'red.png'
+        response = self.client.post(reverse('autotag'), {'file': file})
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_tags_are_inferred_once_per_file(self):
+        with mock.patch.object(autotagger, 'tagImage',
+                return_value=['red']) as tagImage:
+            first = self.autotag()
+            second = self.autotag()
+
+        self.assertEqual((first['tags'], second['tags']), (['red'], ['red']))
+        self.assertNotEqual(first['token'], second['token'])
+        tagImage.assert_called_once_with(self.data.getvalue())
+
+    def test_upload_uses_the_staged_file(self):
+        with mock.patch.object(autotagger, 'tagImage', return_value=[]):
+            token = self.autotag()['token']
+
+        # Only run the commit hooks of the view, not the background work
+        with mock.patch.object(tasks, 'executor'), \
+                self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('upload'), {
+                'staging_token': token, 'title': 'Red', 'tags': 'red',
+                'description': ''})
+        self.assertEqual(response.status_code, 302)
+
+        image = Image.objects.get()
+        with image.file.open('rb') as file:
+            self.assertEqual(file.read(), self.data.getvalue())
+        self.assertEqual(staging.find(token), None)
+
+        # A used or unknown token is no substitute for a file
+        response = self.client.post(reverse('upload'), {
+            'staging_token': token, 'title': 'Red'})
+        self.assertFormError(response.context['form'], 'file',
+            'Choose an image to upload.')
+
+    def test_tabs_staging_the_same_file_are_independent(self):
+        with mock.patch.object(autotagger, 'tagImage', return_value=['red']):
+            first = self.autotag()['token']
+            second = self.autotag()['token']
+
+        for token in [first, second]:
+            with mock.patch.object(tasks, 'executor'), \
+                    self.captureOnCommitCallbacks(execute=True):
+                response = self.client.post(reverse('upload'), {
+                    'staging_token': token, 'title': 'Red', 'tags': 'red',
+                    'description': ''})
+            self.assertEqual(response.status_code, 302)
+        self.assertEqual(Image.objects.count(), 2)
+
+    def test_suggested_tags_are_recorded_as_machine_tags(self):
+        with mock.patch.object(autotagger, 'tagImage',
+                return_value=['red', 'square']):
+            token = self.autotag()['token']
+
+        with mock.patch.object(tasks, 'executor'), \
+                self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('upload'), {
+                'staging_token': token, 'title': 'Red',
+                'tags': 'red flag', 'description': ''})
+
+        image = Image.objects.get()
+        sources = lambda: dict(ImageTag.objects.filter(image=image)
+            .values_list('tag__name', 'source'))
+        self.assertEqual(sources(), {'red': 'auto', 'flag': 'user'})
+
+        # Submitting a machine tag again leaves it a machine tag
+        with mock.patch.object(tasks, 'executor'), \
+                self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('edit', kwargs={'image_id': image.id,
+                'slug': image.slug()}), {'title': 'Red',
+                'tags': 'red flag banner', 'description': ''})
+        self.assertEqual(sources(),
+            {'red': 'auto', 'flag': 'user', 'banner': 'user'})
+
+    def test_expired_files_are_cleared(self):
+        with mock.patch.object(autotagger, 'tagImage', return_value=[]):
+            token = self.autotag()['token']
+        call_command('clear_staging', stdout=io.StringIO())
+        self.assertNotEqual(staging.find(token), None)
+
+        call_command('clear_staging', max_age=0, stdout=io.StringIO())
+        self.assertEqual(staging.find(token), None)
+
+    def test_expired_files_are_not_found(self):
+        with mock.patch.object(autotagger, 'tagImage', return_value=[]):
+            token = self.autotag()['token']
+        self.assertNotEqual(staging.find(token), None)
+
+        # Not cleared yet, but too old to be used
+        expired = time.time() - staging.STAGING_MAX_AGE - 1
+        os.utime(staging.stagingDirectory() / token, (expired, expired))
+        self.assertEqual(staging.find(token), None)
+
+
+class AutotaggerTests(SiteTestCase):
+
+    def server(self, status: int, body: bytes):
+        """Stand in for a connection to the tagging server"""
+
+        connection = mock.Mock()
+        connection.getresponse.return_value = mock.Mock(status=status,
+            reason=http.client.responses[status],
+            read=mock.Mock(return_value=body))
+        return mock.patch.object(autotagger, 'connect',
+            return_value=connection)
+
+    def test_tags_come_from_the_server(self):
+        with self.server(200, b'{"tags": ["red", "square"]}'):
+            self.assertEqual(autotagger.tagImage(b'image'),
+                ['red', 'square'])
+
+    def test_missing_server_gives_no_tags(self):
+        with tempfile.TemporaryDirectory() as directory, \
+                mock.patch.object(autotagger, 'AUTOTAG_SERVER',
+                    f'unix:{directory}/missing.sock'), \
+                self.assertLogs('main.autotagger', 'WARNING') as logs:
+            self.assertEqual(autotagger.tagImage(b'image'), [])
+        self.assertIn('Autotagging failed', logs.output[0])
+
+    def test_server_errors_give_no_tags(self):
+        for status, body in [(500, b'{"error": "Model not loaded"}'),
+                             (502, b'<html>Bad Gateway</html>')]:
+            with self.subTest(status=status), self.server(status, body), \
+                    self.assertLogs('main.autotagger', 'WARNING'):
+                self.assertEqual(autotagger.tagImage(b'image'), [])
+
+        # A server too busy to answer in time
+        with self.server(200, b'{}') as connect, \
+                self.assertLogs('main.autotagger', 'WARNING'):
+            connect.return_value.request.side_effect = \
+                socket.timeout('timed out')
+            self.assertEqual(autotagger.tagImage(b'image'), [])
+
+
+class FakeTagger:
+    """Tags each image with its first value, recording each forward pass"""
+
+    def __init__(self, error: Exception | None = None):
+        self.batches = []
+        self.error = error
+
+    def tag(self, images) -> list[str]:
+        self.batches.append(len(images))
+        if (self.error != None):
+            raise self.error
+        return [f'tag{int(image[0])}' for image in images]
+
+
+@skipIf(inference == None, 'The tagging server packages are not installed')
+class BatchSchedulerTests(SiteTestCase):
+
+    def submit(self, scheduler, count: int) -> list:
+        return [scheduler.submit(inference.torch.full((1,), float(i)))
+                for i in range(count)]
+
+    def test_concurrent_requests_share_a_forward_pass(self):
+        tagger = FakeTagger()
+        scheduler = inference.BatchScheduler(tagger, max_batch_size=4,
+            max_wait_ms=5000)
+        futures = self.submit(scheduler, 4)
+
+        # A full batch runs without waiting out max_wait
+        self.assertEqual([future.result(timeout=2) for future in futures],
+            [['tag0'], ['tag1'], ['tag2'], ['tag3']])
+        self.assertEqual(tagger.batches, [4])
+        self.assertEqual(scheduler.stats()['batch_sizes'], {4: 1})
+
+    def test_max_wait_flushes_a_partial_batch(self):
+        tagger = FakeTagger()
+        scheduler = inference.BatchScheduler(tagger, max_batch_size=8,
+            max_wait_ms=20)
+        futures = self.submit(scheduler, 3)
+
+        self.assertEqual([future.result(timeout=2) for future in futures],
+            [['tag0'], ['tag1'], ['tag2']])
+        self.assertEqual(tagger.batches, [3])
+
+    def test_errors_reach_every_waiter(self):
+        tagger = FakeTagger(RuntimeError('out of memory'))
+        scheduler = inference.BatchScheduler(tagger, max_batch_size=3,
+            max_wait_ms=5000)
+        for future in self.submit(scheduler, 3):
+            with self.assertRaisesMessage(RuntimeError, 'out of memory'):
+                future.result(timeout=2)
+        self.assertEqual(tagger.batches, [3])
+
+        # The scheduler keeps serving after a failed batch
+        tagger.error = None
+        futures = self.submit(scheduler, 3)
+        self.assertEqual(futures[0].result(timeout=2), ['tag0'])
+
+
+class IngestTests(SiteTestCase):
+
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        settings = self.settings(MEDIA_ROOT=directory.name)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+        # Background work would race the removal of the media directory
+        patcher = mock.patch.object(tasks, 'executor')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def upload(self, data: bytes, name: str = 'photo.jpg'):
+        file = io.BytesIO(data)
+        file.name = name
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post(reverse('upload'), {'file': file,
+                'title': 'Photo', 'tags': '', 'description': ''})
+
+    def photo(self, size: tuple[int, int], orientation: int = 1) -> bytes:
+        data = io.BytesIO()
+        exif = PIL.Image.Exif()
+        exif[PIL.ExifTags.Base.Orientation] = orientation
+        PIL.Image.new('RGB', size, 'blue').save(data, 'JPEG', exif=exif)
+        return data.getvalue()
+
+    def test_originals_are_rotated_and_shrunk(self):
+        with mock.patch.object(ingest, 'MAX_EDGE', 100):
+            self.upload(self.photo((300, 200), orientation=6))
+
+        image = Image.objects.get()
+        self.assertRegex(image.file.name, r'^images/../../[0-9a-f]{64}\.jpg$')
+        with PIL.Image.open(image.file.path) as im:
+            self.assertEqual(im.size, (67, 100))
+            self.assertEqual(im.getexif().get(PIL.ExifTags.Base.Orientation,
+                1), 1)
+
+    def test_details_are_recorded_and_backfilled(self):
+        self.upload(self.photo((600, 400)))
+        image = Image.objects.get()
+        self.assertEqual((image.width, image.height), (600, 400))
+        self.assertEqual(image.mime_type, 'image/jpeg')
+        self.assertEqual(image.byte_size, Path(image.file.path).stat().st_size)
+        self.assertRegex(image.dominant_color, r'^#[0-9a-f]{6}$')
+        self.assertTrue(image.placeholder.startswith('data:image/webp;'))
+        # Hashed from the preview, close to a hash of the stored file
+        self.assertLessEqual(duplicates.distance(image.phash,
+            duplicates.hashFile(image.file.path)), duplicates.DUPLICATE_RADIUS)
+        self.assertContains(self.client.get(reverse('home')),
+            'width="512" height="341"')
+
+        Image.objects.update(width=None, height=None, mime_type='',
+            placeholder='')
+        with mock.patch.object(connections, 'close_all'):
+            call_command('backfill_image_details', workers=1,
+                stdout=io.StringIO())
+        image.refresh_from_db()
+        self.assertEqual((image.width, image.height), (600, 400))
+        self.assertEqual(image.mime_type, 'image/jpeg')
+        self.assertTrue(image.placeholder)
+
+    def test_backfilled_hash_matches_upload(self):
+        # Fine detail, so hashes taken at different scales disagree
+        data = io.BytesIO()
+        PIL.Image.effect_noise((1200, 800), 64).convert('RGB') \
+            .save(data, 'JPEG')
+        self.upload(data.getvalue())
+        uploaded = Image.objects.get()
+
+        Image.objects.update(phash=None)
+        with mock.patch.object(connections, 'close_all'):
+            call_command('hash_images', workers=1, stdout=io.StringIO())
+        image = Image.objects.get()
+        self.assertEqual(image.phash, uploaded.phash)
+        self.assertEqual([getattr(image, field)
+                          for field in duplicates.CHUNK_FIELDS],
+            [getattr(uploaded, field) for field in duplicates.CHUNK_FIELDS])
+
+    def test_identical_files_are_stored_once(self):
+        data = self.photo((60, 40))
+        self.upload(data)
+        self.upload(data, 'copy.jpg')
+        first, second = Image.objects.order_by('id')
+        self.assertEqual(first.file.name, second.file.name)
+        path = Path(first.file.path)
+        self.assertEqual(path.read_bytes(), data)
+
+        for image in [first, second]:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.client.post(reverse('delete', kwargs={
+                    'image_id': image.id, 'slug': image.slug()}))
+            self.assertTrue(path.exists())
+
+        # Unused originals are only removed by the sweep, once old enough
+        call_command('sweep_originals', stdout=io.StringIO())
+        self.assertTrue(path.exists())
+        call_command('sweep_originals', min_age=0, stdout=io.StringIO())
+        self.assertFalse(path.exists())
+        self.assertEqual(list(path.parent.iterdir()), [])
+
+    def test_limits_are_enforced(self):
+        with mock.patch.object(ingest, 'MAX_PIXELS', 1000):
+            response = self.upload(self.photo((60, 40)))
+        self.assertFormError(response.context['form'], 'file',
+            'Images can have at most 0 million pixels.')
+
+        with mock.patch.object(ingest, 'MAX_UPLOAD_BYTES', 10):
+            response = self.upload(self.photo((60, 40)))
+        self.assertFormError(response.context['form'], 'file',
+            'Images can be at most 0 MB.')
+        self.assertFalse(Image.objects.exists())
+
+
+class ImportTests(SiteTestCase):
+
+    def setUp(self):
+        super().setUp()
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        settings = self.settings(MEDIA_ROOT=media.name)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+        source = tempfile.TemporaryDirectory()
+        self.addCleanup(source.cleanup)
+        self.root = Path(source.name)
+        (self.root / 'b').mkdir()
+        for name, color in [('a_beach.png', 'blue'), ('b/c-forest.png', 'green'),
+                            ('b/copy.png', 'blue'), ('d.png', 'red')]:
+            PIL.Image.new('RGB', (40, 30), color).save(self.root / name)
+        (self.root / 'notes.txt').write_text('not an image')
+        (self.root / 'broken.png').write_bytes(b'not an image either')
+
+    def importImages(self, **options):
+        output = io.StringIO()
+        with mock.patch.object(connections, 'close_all'), \
+                mock.patch.object(autotagger, 'stats', return_value={}), \
+                mock.patch.object(autotagger, 'tagImage',
+                    return_value=['outdoors']), \
+                self.captureOnCommitCallbacks(execute=True):
+            call_command('import_images', str(self.root), workers=1,
+                batch_size=2, tags='archive', stdout=output,
+                stderr=io.StringIO(), **options)
+        return output.getvalue()
+
+    def test_directory_is_imported_once(self):
+        output = self.importImages()
+        self.assertIn('Imported 3 images, skipped 1 already in the library, '
+            '1 failed', output)
+        self.assertEqual(sorted(Image.objects.values_list('title', flat=True)),
+            ['a beach', 'c forest', 'd'])
+        self.assertEqual(dict(Tag.objects.values_list('name', 'image_count')),
+            {'archive': 3, 'outdoors': 3})
+        image = Image.objects.get(title='d')
+        self.assertEqual((image.width, image.height), (40, 30))
+        self.assertEqual(searchImages('forest').get().title, 'c forest')
+
+        # The checkpoint is at the end, so nothing is walked again
+        PIL.Image.new('RGB', (40, 30), 'white').save(self.root / 'a0.png')
+        output = self.importImages()
+        self.assertIn('Imported 3 images', output)
+        self.assertEqual(Image.objects.count(), 3)
+
+        # Restarting walks everything and only adds the new file
+        output = self.importImages(restart=True)
+        self.assertIn('Imported 1 images, skipped 4', output)
+        self.assertEqual(Tag.objects.get(name='archive').image_count, 4)
+
+    def test_untagged_images_appear_on_the_home_page(self):
+        self.client.get(reverse('home'))
+        with mock.patch.object(connections, 'close_all'), \
+                self.captureOnCommitCallbacks(execute=True):
+            call_command('import_images', str(self.root), workers=1,
+                no_autotag=True, stdout=io.StringIO(), stderr=io.StringIO())
+
+        self.assertFalse(Tag.objects.exists())
+        self.assertContains(self.client.get(reverse('home')), 'c forest')
+
+
+class RetagTests(SiteTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.beach = Image.objects.create(title='Beach', description='',
+            file='images/beach.jpg')
+        self.forest = Image.objects.create(title='Forest', description='',
+            file='images/forest.jpg')
+        setTags(self.beach, ['holiday'])
+        setTags(self.forest, ['walk'])
+        addTags({self.beach.id: {'sand'}, self.forest.id: {'tree', 'sand'}},
+            ImageTag.AUTO)
+
+    def tags(self, image: Image) -> dict[str, str]:
+        return dict(ImageTag.objects.filter(image=image)
+            .values_list('tag__name', 'source'))
+
+    def retag(self, suggestions: dict[str, list[str]], **options):
+        def suggestTags(data: bytes) -> list[str]:
+            name = Path(data.decode()).stem
+            suggestion = suggestions[name]
+            if (isinstance(suggestion, Exception)):
+                raise suggestion
+            return suggestion() if callable(suggestion) else suggestion
+
+        with mock.patch.object(autotagger, 'stats', return_value={}), \
+                mock.patch.object(autotagger, 'preview',
+                    side_effect=lambda path: path.encode()), \
+                mock.patch.object(autotagger, 'suggestTags',
+                    side_effect=suggestTags), \
+                self.captureOnCommitCallbacks(execute=True):
+            stderr = io.StringIO()
+            call_command('retag_images', stdout=io.StringIO(), stderr=stderr,
+                checkpoint=self.checkpoint, **options)
+        return stderr.getvalue()
+
+    def test_machine_tags_are_replaced_and_user_tags_kept(self):
+        self.checkpoint = Path(self.enterContext(
+            tempfile.TemporaryDirectory())) / 'checkpoint.json'
+        self.retag({'beach': ['sea', 'holiday'], 'forest': ['tree']},
+            mode='replace')
+
+        self.assertEqual(self.tags(self.beach),
+            {'holiday': 'user', 'sea': 'auto'})
+        self.assertEqual(self.tags(self.forest),
+            {'walk': 'user', 'tree': 'auto'})
+        self.assertEqual(dict(Tag.objects.values_list('name', 'image_count')),
+            {'holiday': 1, 'sea': 1, 'tree': 1, 'walk': 1})
+        self.assertEqual(searchImages('sea').get(), self.beach)
+        self.assertFalse(self.checkpoint.exists())
+
+        # Editing the tags keeps the source of those left in place
+        setTags(self.beach, ['holiday', 'sea', 'sunset'])
+        self.assertEqual(self.tags(self.beach),
+            {'holiday': 'user', 'sea': 'auto', 'sunset': 'user'})
+
+    def test_paused_job_resumes_after_checkpoint(self):
+        self.checkpoint = Path(self.enterContext(
+            tempfile.TemporaryDirectory())) / 'checkpoint.json'
+
+        def interrupt():
+            os.kill(os.getpid(), signal.SIGINT)
+            return ['sea']
+
+        self.retag({'beach': interrupt, 'forest': ['moss']}, chunk_size=1)
+        self.assertEqual(json.loads(self.checkpoint.read_text())['last_id'],
+            self.beach.id)
+        self.assertEqual(self.tags(self.beach),
+            {'holiday': 'user', 'sand': 'auto', 'sea': 'auto'})
+        self.assertEqual(self.tags(self.forest),
+            {'walk': 'user', 'tree': 'auto', 'sand': 'auto'})
+
+        # The finished image is not sent again
+        self.retag({'beach': OSError('sent again'), 'forest': ['moss']},
+            chunk_size=1)
+        self.assertEqual(self.tags(self.forest),
+            {'walk': 'user', 'tree': 'auto', 'sand': 'auto', 'moss': 'auto'})
+        self.assertFalse(self.checkpoint.exists())
+
+    def test_failed_images_are_skipped_and_reported(self):
+        self.checkpoint = Path(self.enterContext(
+            tempfile.TemporaryDirectory())) / 'checkpoint.json'
+        stderr = self.retag({'beach': http.client.BadStatusLine('corrupt'),
+            'forest': ['moss']}, chunk_size=1)
+        self.assertIn(f'1 images could not be tagged: {self.beach.id}',
+            stderr)
+        self.assertEqual(self.tags(self.beach),
+            {'holiday': 'user', 'sand': 'auto'})
+        self.assertIn('moss', self.tags(self.forest))
+        self.assertFalse(self.checkpoint.exists())
+
+
+class BenchmarkTests(SiteTestCase):
+
+    def result(self, p50: float, queries: int = 3) -> dict:
+        return {'scenarios': {'search': benchmark.summarize(
+            [p50] * 10, [queries] * 10)}}
+
+    def test_regressions_are_reported(self):
+        baseline = self.result(10.0)
+        self.assertEqual(benchmark.compare(baseline, self.result(11.0)), [])
+        self.assertEqual(benchmark.compare(baseline, self.result(8.0)), [])
+        # Tiny scenarios need to slow down by more than noise
+        self.assertEqual(benchmark.compare(self.result(1.0),
+            self.result(1.5)), [])
+
+        self.assertEqual(len(benchmark.compare(baseline, self.result(15.0))), 2)
+        self.assertEqual(benchmark.compare(baseline, self.result(10.0, 4)),
+            ['search: queries 3 -> 4'])
+
+    def test_compare_command_fails_on_regressions(self):
+        with tempfile.TemporaryDirectory() as directory:
+            baseline = Path(directory, 'baseline.json')
+            current = Path(directory, 'current.json')
+            for path, p50 in [(baseline, 10.0), (current, 20.0)]:
+                benchmark.saveResults(path, self.result(p50) | {'library': {}})
+
+            call_command('benchmark', results=baseline, baseline=baseline,
+                stdout=io.StringIO())
+            with self.assertRaises(CommandError):
+                call_command('benchmark', results=current, baseline=baseline,
+                    stdout=io.StringIO(), stderr=io.StringIO())
@@ -9,6 +9,8 @@ urlpatterns = [
     path('upload/', views.upload, name='upload'),
     path('autocomplete/', views.autocomplete, name='autocomplete'),
     path('autotag/', views.autotag, name='autotag'),
+    path('autotag/stats/', views.autotagStats, name='autotag_stats'),
+    path('metrics/', views.serverMetrics, name='metrics'),
     path('image/<int:image_id>/', views.image, name='image'),
     path('detail/<int:image_id>/', views.detail, name='detail'),
     path('detail/<int:image_id>/<str:slug>/', views.detail, name='detail'),
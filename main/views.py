@@ -1,89 +1,139 @@
-import io, json
+import asyncio, json, mimetypes
+from pathlib import Path
 
+from django.contrib import messages
+from django.core.exceptions import PermissionDenied
+from django.core.cache import cache
 from django.core.paginator import Paginator
-from django.db.models import Case, Q, When
-from django.db.models.functions import Lower, Substr
 from django.http import HttpRequest, HttpResponse, HttpResponseRedirect, Http404
-from django.shortcuts import get_object_or_404, render
+from django.db import transaction
+from django.db.models import prefetch_related_objects
+from django.shortcuts import aget_object_or_404, get_object_or_404, render
+from django.template.loader import render_to_string
 from django.urls import reverse
+from django.utils.cache import (get_conditional_response, patch_cache_control,
+    patch_vary_headers)
+from django.utils.http import http_date
 
-import PIL.Image
-
-import torch
-from ram.models import ram_plus
-from ram import inference_ram, get_transform
-
+from . import (autotagger, caching, concurrency, duplicates, embeddings,
+    ingest, metrics, neighbors, renditions, staging, streaming, tagindex,
+    tasks)
 from .models import Image, Tag
+from .pagination import KeysetPaginator
+from .search import searchImages
+from .tagging import setTags
 from .forms import ImageUploadForm
 
 
 ENABLE_AUTOTAGGING = True
 SEARCH_RESULTS_PER_PAGE = 10
+AUTOCOMPLETE_SUGGESTIONS = 7
 
+# 'keyset' pages with cursors that stay fast at any depth; 'offset' shows
+# numbered pages
+SEARCH_PAGINATION = 'keyset'
 
-if (ENABLE_AUTOTAGGING):
-    """Initialize the image tagging model"""
-    IMAGE_SIZE = 384
-    device = torch.device('cpu')
-    transform = get_transform(image_size=IMAGE_SIZE)
-    model = ram_plus(pretrained='pretrained/ram_plus_swin_large_14m.pth',
-        image_size=IMAGE_SIZE, vit='swin_l')
-    model.eval()
-    model = model.to(device)
+# Semantic search ranks every embedded image but only pages through the
+# closest ones
+SEMANTIC_SEARCH_RESULTS = 500
 
 
-def image(request: HttpRequest, image_id: int) -> HttpResponse:
+async def image(request: HttpRequest, image_id: int) -> HttpResponse:
     """Return the image file associated with an id, resizing it if specified"""
 
-    image = get_object_or_404(Image, pk=image_id)
+    image = await aget_object_or_404(
+        Image.objects.defer('search_vector', 'placeholder'), pk=image_id)
     format = request.GET.get('format', 'original')
+    if (format not in renditions.RENDITION_SIZES):
+        format = 'original'
+    width = request.GET.get('w', '')
+    if (width.isdigit() and int(width) in renditions.RENDITION_WIDTHS):
+        format = renditions.widthFormat(int(width))
+
+    # Renditions are sent in the best encoding the client accepts
+    encoding = None
+    if (format != 'original'):
+        encoding = renditions.negotiate(request.headers.get('Accept', ''))
+
+    # Let the client reuse its copy if the original has not been replaced.
+    # Anything touching the disk runs in a thread so the event loop stays
+    # free for other requests.
+    etag = renditions.etag(image, format, encoding)
+    last_modified = await asyncio.to_thread(renditions.lastModified, image)
+    response = get_conditional_response(request, etag=etag,
+        last_modified=last_modified)
+    if (response != None):
+        return setCacheHeaders(response, etag, last_modified,
+            format != 'original')
+
+    # Only real resize formats are decoded; originals are sent untouched
+    if (format != 'original'):
+        path = await asyncio.to_thread(renditions.findRendition, image,
+            format, encoding)
+        if (path == None):
+            # Resizing is CPU bound, so it runs in a bounded pool
+            try:
+                with concurrency.slot(concurrency.renditionSlots):
+                    path = await concurrency.run(concurrency.renditionPool,
+                        renditions.getRendition, image, format, encoding)
+            except concurrency.Saturated:
+                return concurrency.unavailable()
+        content_type = 'image/' + path.suffix[1:]
+    else:
+        path = Path(image.file.path)
+        content_type = image.mime_type
+        if (content_type == ''):
+            content_type, _ = mimetypes.guess_type(image.file.name)
+        if (content_type == None):
+            content_type = 'application/octet-stream'
 
-    im = PIL.Image.open(image.file)
-
-    match format:
-        case 'thumbnail':
-            im.thumbnail((128, 128))
-        case 'search':
-            im.thumbnail((512, 512))
-        case 'theater':
-            im.thumbnail((1080, 1080))
+    response = await asyncio.to_thread(streaming.fileResponse, request, path,
+        content_type, etag, last_modified)
+    return setCacheHeaders(response, etag, last_modified,
+        format != 'original')
 
-    buffer = io.BytesIO()
-    content_type = im.get_format_mimetype()
-    file_extension = content_type.split("/")[1]
 
-    im.save(buffer, file_extension)
-    im.close()
+def setCacheHeaders(response: HttpResponse, etag: str, last_modified: int,
+                    negotiated: bool = False) -> HttpResponse:
+    """Add the validators a client needs to revalidate an image"""
 
-    return HttpResponse(buffer.getvalue(), content_type=content_type)
+    response.headers['ETag'] = etag
+    response.headers['Last-Modified'] = http_date(last_modified)
+    patch_cache_control(response, public=True, no_cache=True)
+    if (negotiated):
+        # Caches must keep a copy per encoding
+        patch_vary_headers(response, ['Accept'])
+    return response
 
 
 def autocomplete(request: HttpRequest) -> HttpResponse:
     """Provide search suggestions based on a query and existing tags"""
     
     query = request.GET.get('q', '')
+    tokens = query.split()
+    last_token = ''
 
-    if (query == ''):
-        suggestions = []
+    if (len(tokens) == 0):
+        tags = []
     else:
-        tokens = query.split()
-
         last_token = tokens[-1]
         if (last_token.startswith('-')):
             last_token = last_token[1:]
 
-        tags = Tag.objects.all()
-        tags = tags.filter(name__startswith=last_token)
-        tags = tags.exclude(name__in=tokens)
-        tags = tags[:7]
+        # Served from an in-memory index ranked by how often tags are used
+        exclude = set(tokens) | {last_token}
+        tags = tagindex.suggest(last_token, AUTOCOMPLETE_SUGGESTIONS,
+            exclude)
+
+    if (request.GET.get('format') == 'json'):
+        data = {
+            'query': query,
+            'suggestions': [{'name': name, 'count': count}
+                            for name, count in tags],
+        }
+        return HttpResponse(json.dumps(data), content_type='application/json')
 
-        suggestions = []
-        for tag in tags:
-            name = tag.name
-            diff = len(name) - len(last_token)
-            if (diff > 0):
-                suggestion = name[-diff:]
-                suggestions.append(suggestion)
+    suggestions = [name[len(last_token):] for name, _ in tags]
 
     context = {
         'query': query,
@@ -93,71 +143,152 @@ def autocomplete(request: HttpRequest) -> HttpResponse:
     return render(request, 'autocomplete.html', context)
 
 
-def autotag(request: HttpRequest) -> HttpResponse:
-    """Generate tags for an image"""
+async def autotag(request: HttpRequest) -> HttpResponse:
+    """Stage an image for upload and generate tags for it"""
 
     if (request.method != 'POST'):
         return Http404()
-    
-    if (not ENABLE_AUTOTAGGING):
-        tags = []
-    else:
-        file = request.FILES.get('file', None)
-        if (file == None):
-            return Http404()
-        
-        try:
-            image = transform(PIL.Image.open(file)).unsqueeze(0).to(device)
-        except:
-            return Http404()
-        
-        result = inference_ram(image, model)
-        tokens = result[0].split('|')
-        tags = []
-        for token in tokens:
-            tag = token.strip().replace(' ', '-')
-            tags.append(tag)
 
-    return HttpResponse(json.dumps(tags), content_type='application/json')
+    # Parsing the form may spool the upload to disk
+    files = await asyncio.to_thread(lambda: request.FILES)
+    file = files.get('file', None)
+    if (file == None):
+        return Http404()
+    if (file.size > ingest.MAX_UPLOAD_BYTES):
+        return HttpResponse('The file is too large', status=413,
+            content_type='text/plain')
+
+    # Keep the file so the form can send back the token instead of the bytes
+    token = await asyncio.to_thread(staging.stage, file)
+
+    tags = []
+    if (ENABLE_AUTOTAGGING):
+        tags = await asyncio.to_thread(staging.cachedTags, token)
+        if (tags == None):
+            # The model runs in its own process shared by every web worker;
+            # wait for it in a bounded pool so the event loop stays free
+            try:
+                with concurrency.slot(concurrency.autotagSlots):
+                    tags = await concurrency.run(concurrency.autotagPool,
+                        tagStagedFile, token)
+            except concurrency.Saturated:
+                return concurrency.unavailable()
+
+    return HttpResponse(json.dumps({'tags': tags, 'token': token}),
+        content_type='application/json')
+
+
+def tagStagedFile(token: str) -> list[str]:
+    """Suggest tags for a staged file, remembering them for its hash"""
+
+    tags = autotagger.tagImage(staging.find(token).read_bytes())
+
+    # No tags usually means the server failed, so let the next request retry
+    if (tags):
+        staging.cacheTags(token, tags)
+    return tags
+
+
+def autotagStats(request: HttpRequest) -> HttpResponse:
+    """Report queueing and batching statistics for the tagging model"""
+
+    stats = autotagger.stats() if ENABLE_AUTOTAGGING else {}
+    return HttpResponse(json.dumps(stats), content_type='application/json')
+
+
+def serverMetrics(request: HttpRequest) -> HttpResponse:
+    """Expose this process's timing histograms in the Prometheus text format"""
+
+    if (not metrics.canRead(request)):
+        raise PermissionDenied
+    return HttpResponse(metrics.exposition(),
+        content_type='text/plain; version=0.0.4; charset=utf-8')
 
 
 def detail(request: HttpRequest, image_id: int, slug: str = '') -> HttpResponse:
     """Render the detail page for an individual image"""
 
-    image = get_object_or_404(Image, pk=image_id)
-
+    # The page embeds a CSRF token, so cache its data rather than the HTML.
+    # The similar images shown can be edited or deleted too, which bumps
+    # the catalog version.
+    key = caching.fragmentKey('detail', image_id, caching.versions(
+        caching.CATALOG_VERSION,
+        caching.imageVersionKey(image_id),
+        caching.neighborsVersionKey(image_id),
+        caching.NEIGHBORS_VERSION))
+    data = cache.get(key)
+
+    if (data == None):
+        image = get_object_or_404(Image.objects.defer('search_vector'),
+            pk=image_id)
+        similar = image.neighbors.select_related('neighbor') \
+            .defer('neighbor__search_vector')
+        data = {
+            'image': image,
+            'tags': list(image.tags.all()),
+            'similar': [neighbor.neighbor for neighbor in similar],
+        }
+        cache.set(key, data, caching.FRAGMENT_TIMEOUT)
+
+    image = data['image']
     if (slug != image.slug()):
         return HttpResponseRedirect(reverse('detail', kwargs={
             'image_id': image_id, 'slug': image.slug()
         }))
 
-    return render(request, 'detail.html', {'image': image})
+    return render(request, 'detail.html', data)
 
 
 def tags(request: HttpRequest) -> HttpResponse:
     """Display a page listing all tags"""
 
-    return render(request, 'tags.html', {'tags': Tag.objects.all()})
+    sort_by = request.GET.get('sort_by', 'name')
+    try:
+        min_count = max(int(request.GET.get('min_count', 1)), 1)
+    except ValueError:
+        min_count = 1
 
+    tags = Tag.objects.filter(image_count__gte=min_count)
+    if (sort_by == 'count'):
+        tags = tags.order_by('-image_count', 'name')
+    else:
+        sort_by = 'name'
 
-def setTags(image: Image, tagNames: list[str]) -> None:
-    """Set the tags for a given image"""
+    # The list is cached in the template, so the query only runs on a miss
+    return render(request, 'tags.html', {
+        'tags': tags,
+        'sort_by': sort_by,
+        'min_count': min_count,
+        'tags_version': caching.versions(caching.TAGS_VERSION)[0],
+        'cache_timeout': caching.FRAGMENT_TIMEOUT,
+    })
+
+
+def flagDuplicates(request: HttpRequest, image: Image) -> None:
+    """Warn the uploader about existing images that look the same"""
+
+    if (image.phash == None):
+        return
+
+    matches = duplicates.findDuplicates(image.phash, exclude_id=image.id)
+    if (matches):
+        titles = ', '.join(f'"{match.title}" (#{match.id})'
+            for match in matches[:5])
+        messages.warning(request,
+            f'This image looks like a duplicate of {titles}.')
+
+
+def suggestedTags(token: str) -> set[str]:
+    """Get the tags the model suggested for a staged file, if any"""
+
+    return set(staging.cachedTags(token) or []) if token else set()
 
-    for tag in image.tags.all():
-        count = Image.objects.filter(tags__id=tag.id).count()
-        if (count == 1):
-            tag.delete()
-    
-    image.tags.clear()
-    
-    for tagName in tagNames:
-        tag = Tag.objects.filter(name=tagName).first()
-        if (tag == None):
-            tag = Tag(name=tagName)
-            tag.save()
-        image.tags.add(tag.id)
-    
-    image.save()
+
+def discardStagedFile(token: str) -> None:
+    """Remove the staged copy of a file once the image using it commits"""
+
+    if (token):
+        transaction.on_commit(lambda: staging.discard(token))
 
 
 def upload(request: HttpRequest) -> HttpResponse:
@@ -167,15 +298,28 @@ def upload(request: HttpRequest) -> HttpResponse:
         form = ImageUploadForm(request.POST, request.FILES)
 
         if (form.is_valid()):
-            file = request.FILES['file']
+            # A refused file makes the form invalid with the reason
+            try:
+                with form.cleaned_data['file'] as file:
+                    name, details = ingest.ingest(file)
+            except ingest.IngestError as error:
+                form.add_error('file', str(error))
+
+        if (form.is_valid()):
             title = form.cleaned_data['title']
             tagsString = form.cleaned_data['tags']
             tagNames = set(tagsString.split())
             description = form.cleaned_data['description']
 
-            image = Image(file=file, title=title, description=description)
+            image = Image(file=name, title=title, description=description)
+            ingest.assignDetails(image, details)
             image.save()
-            setTags(image, tagNames)
+            setTags(image, tagNames,
+                suggestedTags(form.cleaned_data['staging_token']))
+            tasks.queueRenditions(image)
+            tasks.queueEmbedding(image)
+            discardStagedFile(form.cleaned_data['staging_token'])
+            flagDuplicates(request, image)
 
             return HttpResponseRedirect(reverse('detail', kwargs={
                 'image_id': image.id, 'slug': image.slug()
@@ -196,16 +340,42 @@ def edit(request: HttpRequest, image_id: int, slug: str) -> HttpResponse:
         tags = request.POST.get('tags').split()
         description = request.POST.get('description')
         file = request.FILES.get('file')
+        token = request.POST.get('staging_token', '')
+        if (file == None):
+            # The file was already sent when it was tagged
+            file = staging.openStaged(token)
+
+        name = None
+        if (file != None):
+            try:
+                with file:
+                    name, details = ingest.ingest(file)
+            except ingest.IngestError as error:
+                messages.error(request, str(error))
+                return HttpResponseRedirect(reverse('edit', kwargs={
+                    'image_id': image.id, 'slug': image.slug()
+                }))
 
         image.title = title
-        setTags(image, tags)
+        setTags(image, tags, suggestedTags(token))
         image.description = description
 
-        if (file != None):
-            image.file = file
+        if (name != None):
+            image.file = name
+            ingest.assignDetails(image, details)
 
         image.save()
 
+        if (name != None):
+            # The previous file may be shared, so sweep_originals removes it
+            discardStagedFile(token)
+            renditions.deleteRenditions(image.id)
+            tasks.queueRenditions(image)
+            tasks.queueEmbedding(image)
+            flagDuplicates(request, image)
+        else:
+            tasks.queueNeighbors([image.id])
+
         return HttpResponseRedirect(reverse('detail', kwargs={
             'image_id': image.id, 'slug': image.slug()
         }))
@@ -229,8 +399,11 @@ def delete(request: HttpRequest, image_id: int, slug: str) -> HttpResponse:
         }))
 
     if (request.method == "POST"):
+        affected = neighbors.referencingImages(image.id)
         setTags(image, [])
+        renditions.deleteRenditions(image.id)
         image.delete()
+        tasks.queueNeighbors(affected, propagate=False)
         return HttpResponseRedirect(reverse('home'))
     else:
         return render(request, 'delete.html', {'image': image})
@@ -239,76 +412,32 @@ def delete(request: HttpRequest, image_id: int, slug: str) -> HttpResponse:
 def search(request: HttpRequest) -> HttpResponse:
     """Process a search query and render the results"""
 
-    # Get the search parameters
-    query = request.GET.get('q', '')
-    include_tags = request.GET.get('include_tags', 'on')
-    include_titles = request.GET.get('include_titles', 'on')
-    include_descriptions = request.GET.get('include_descriptions', 'on')
+    # Get the search parameters, normalized so equivalent requests share a
+    # cache entry
+    query = ' '.join(request.GET.get('q', '').split())
+    include_tags = onOff(request.GET.get('include_tags', 'on'))
+    include_titles = onOff(request.GET.get('include_titles', 'on'))
+    include_descriptions = onOff(request.GET.get('include_descriptions', 'on'))
     sort_by = request.GET.get('sort_by', 'date')
-    reverse_sort = request.GET.get('reverse_sort', 'on')
+    if (sort_by not in ('date', 'title', 'relevance')):
+        sort_by = 'date'
+    reverse_sort = onOff(request.GET.get('reverse_sort', 'on'))
+    mode = request.GET.get('mode', 'keywords')
+    cursor = request.GET.get('cursor')
 
     try:
         page_number = int(request.GET.get('p', 1))
     except:
         page_number = 1
 
-    tokens = query.split()
-
-    positiveTokens = filter(lambda t: not t.startswith('-'), tokens)
-    negativeTokens = filter(lambda t: t.startswith('-'), tokens)
-    negativeTokens = map(lambda t: t[1:], negativeTokens)
-
-    # Build the result set
-    images = Image.objects.all()
-
-    # Add positive filters
-    for token in positiveTokens:
-        tokenQuery = Q()
-        if (include_tags == 'on'):
-            tokenQuery |= Q(tags__name=token)
-        if (include_titles == 'on'):
-            tokenQuery |= Q(title__icontains=token)
-        if (include_descriptions == 'on'):
-            tokenQuery |= Q(description__icontains=token)
-        images = images.filter(tokenQuery)
-    
-    # Add negative filters
-    for token in negativeTokens:
-        tokenQuery = Q()
-        if (include_tags == 'on'):
-            tokenQuery |= Q(tags__name=token)
-        if (include_titles == 'on'):
-            tokenQuery |= Q(title__icontains=token)
-        if (include_descriptions == 'on'):
-            tokenQuery |= Q(description__icontains=token)
-        images = images.exclude(tokenQuery)
-
-    images = images.distinct()
-
-    # Add sorting
-    if (sort_by == 'title'):
-        images = images.annotate(
-            title_normalized=Case(
-                When(title__istartswith='a ',
-                     then=Lower(Substr('title', 3))),
-                When(title__istartswith='an ',
-                     then=Lower(Substr('title', 4))),
-                When(title__istartswith='the ',
-                     then=Lower(Substr('title', 5))),
-                default=Lower('title')
-            )
-        )
-        images = images.order_by('title_normalized')
-    elif (sort_by == 'date'):
-        images = images.order_by('date')
-
-    # Reverse sort
-    if (reverse_sort == 'on'):
-        images = images.reverse()
-
-    # Paginate the data
-    paginator = Paginator(images, SEARCH_RESULTS_PER_PAGE)
-    page = paginator.get_page(page_number)
+    ranked = None
+    if (mode == 'semantic' and query != ''):
+        ranked = embeddings.searchText(query, SEMANTIC_SEARCH_RESULTS)
+        if (ranked == None):
+            messages.warning(request, 'Semantic search is unavailable, so '
+                'these results match keywords instead.')
+    if (ranked == None):
+        mode = 'keywords'
 
     context = {
         'query': query,
@@ -317,7 +446,75 @@ def search(request: HttpRequest) -> HttpResponse:
         'include_descriptions': include_descriptions,
         'sort_by': sort_by,
         'reverse_sort': reverse_sort,
-        'page': page
+        'mode': mode,
     }
 
-    return render(request, 'search.html', context)
+    # Keyword results only change with the catalog. Semantic results also
+    # follow the embeddings, which change in the background, so they are
+    # only cached per image.
+    key = None
+    if (ranked == None):
+        key = caching.fragmentKey('search', caching.versions(
+            caching.CATALOG_VERSION), context, page_number, cursor,
+            SEARCH_PAGINATION)
+        results = cache.get(key)
+        if (results != None):
+            return render(request, 'search.html',
+                {**context, 'results': results})
+
+    if (ranked != None):
+        # Page through the ranked ids and load only the current page
+        paginator = Paginator(ranked, SEARCH_RESULTS_PER_PAGE)
+        page = paginator.get_page(page_number)
+        found = Image.objects.defer('search_vector') \
+            .in_bulk(page.object_list)
+        page.object_list = [found[id] for id in page.object_list
+                            if id in found]
+    else:
+        images = searchImages(query, include_tags, include_titles,
+            include_descriptions, sort_by, reverse_sort)
+
+        # Paginate the data
+        if (SEARCH_PAGINATION == 'keyset'):
+            paginator = KeysetPaginator(images, SEARCH_RESULTS_PER_PAGE)
+            page = paginator.page(cursor)
+        else:
+            paginator = Paginator(images, SEARCH_RESULTS_PER_PAGE)
+            page = paginator.get_page(page_number)
+
+    results = render_to_string('_search_results.html', {
+        **context,
+        'page': page,
+        'items': renderResultItems(page.object_list),
+    })
+    if (key != None):
+        cache.set(key, results, caching.FRAGMENT_TIMEOUT)
+
+    return render(request, 'search.html', {**context, 'results': results})
+
+
+def onOff(value: str) -> str:
+    return 'off' if value == 'off' else 'on'
+
+
+def renderResultItems(images: list[Image]) -> list[str]:
+    """Render each search result, reusing the cached HTML of unchanged images"""
+
+    imageVersions = caching.versions(
+        *[caching.imageVersionKey(image.id) for image in images])
+    keys = [caching.fragmentKey('search-item', image.id, version)
+            for image, version in zip(images, imageVersions)]
+    found = cache.get_many(keys)
+
+    # Only the images that have to be rendered need their tags
+    missing = [image for image, key in zip(images, keys) if key not in found]
+    prefetch_related_objects(missing, 'tags')
+
+    rendered = {}
+    for image, key in zip(images, keys):
+        if (key not in found):
+            rendered[key] = render_to_string('_search_result.html',
+                {'image': image})
+    cache.set_many(rendered, caching.FRAGMENT_TIMEOUT)
+
+    return [found.get(key) or rendered[key] for key in keys]